@@ -0,0 +1,94 @@
+<?php
+
+namespace App\Console\Commands;
+
+use App\Jobs\Asq3ImageGeneratorJob;
+use App\Models\Asq3Question;
+use Illuminate\Console\Command;
+use Illuminate\Support\Facades\Queue;
+use Illuminate\Support\Str;
+
+class QueueAsq3ImagesCommand extends Command
+{
+    protected $signature = 'asq3:queue-images
+        {ids?* : asq3_questions IDs to queue (default: questions without an image)}
+        {--all : Queue every question}
+        {--force : Regenerate images that are already up to date}
+        {--queue=asq3-images : Queue read by `generate_asq3_images.py --worker`}
+        {--dry-run : Show what would be queued without pushing jobs}';
+
+    protected $description = 'Queue ASQ-3 question image generation jobs on the asq3-images queue, '
+        .'which `generate_asq3_images.py --worker` reads and `php artisan queue:work` does not';
+
+    /**
+     * Job name the generator worker expects in the payload.
+     */
+    private const DISPLAY_NAME = 'asq3-images:generate';
+
+    public function handle(): int
+    {
+        // `php artisan queue:work` reads the connection's default queue, and
+        // these payloads are only meant for the Python worker
+        $workerQueue = config('queue.connections.database.queue', 'default');
+        if ($this->option('queue') === $workerQueue) {
+            $this->error("Refusing to push to '{$workerQueue}', the queue `php artisan queue:work` reads by default");
+
+            return Command::FAILURE;
+        }
+
+        $query = Asq3Question::with(['ageInterval:id,age_months', 'domain:id,code'])
+            ->select(['id', 'age_interval_id', 'domain_id', 'question_number', 'question_text']);
+
+        if ($ids = $this->argument('ids')) {
+            $query->whereIn('id', $ids);
+        } elseif (! $this->option('all')) {
+            $query->whereNull('image_url');
+        }
+
+        $queue = Queue::connection('database');
+        $queued = 0;
+        $skipped = 0;
+
+        $query->chunkById(500, function ($questions) use ($queue, &$queued, &$skipped) {
+            foreach ($questions as $question) {
+                if (! $question->ageInterval || ! $question->domain) {
+                    $this->warn("Question #{$question->id} has no age interval or domain");
+                    $skipped++;
+
+                    continue;
+                }
+
+                $data = [
+                    'age_months' => $question->ageInterval->age_months,
+                    'domain_code' => $question->domain->code,
+                    'question_number' => $question->question_number,
+                    'question_text' => $question->question_text,
+                    'force' => (bool) $this->option('force'),
+                ];
+
+                if ($this->option('dry-run')) {
+                    $this->line("Would queue question #{$question->id}: "
+                        ."{$data['age_months']} months {$data['domain_code']} #{$data['question_number']}");
+                } else {
+                    $queue->pushRaw(json_encode([
+                        'uuid' => (string) Str::uuid(),
+                        'displayName' => self::DISPLAY_NAME,
+                        'job' => Asq3ImageGeneratorJob::class,
+                        'data' => $data,
+                    ]), $this->option('queue'));
+                }
+
+                $queued++;
+            }
+        });
+
+        $this->info("Queued: {$queued}");
+        $this->info("Skipped: {$skipped}");
+
+        if ($this->option('dry-run')) {
+            $this->warn('Dry-run mode - no jobs were pushed');
+        }
+
+        return Command::SUCCESS;
+    }
+}
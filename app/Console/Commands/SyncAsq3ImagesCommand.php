@@ -6,14 +6,22 @@ use App\Models\Asq3AgeInterval;
 use App\Models\Asq3Domain;
 use App\Models\Asq3Question;
 use Illuminate\Console\Command;
+use Illuminate\Support\Facades\DB;
+use Illuminate\Support\Facades\Schema;
 
 class SyncAsq3ImagesCommand extends Command
 {
     protected $signature = 'asq3:sync-images 
-        {--dry-run : Show what would be updated without making changes}';
+        {--dry-run : Show what would be updated without making changes}
+        {--glob : Ignore manifest.json and scan for <question_id>.png files}';
 
     protected $description = 'Sync generated ASQ-3 question images to database';
 
+    /**
+     * Rows per UPDATE ... CASE statement, keeping bindings well below driver limits.
+     */
+    private const UPDATE_CHUNK_SIZE = 500;
+
     private array $domainMapping = [
         'komunikasi' => 'communication',
         'motorik-kasar' => 'gross_motor',
@@ -58,91 +66,109 @@ class SyncAsq3ImagesCommand extends Command
             return Command::FAILURE;
         }
 
-        $files = glob("{$imagesPath}/*.png");
-        $this->info('Found '.count($files).' image files');
+        $manifestPath = "{$imagesPath}/manifest.json";
+        $useManifest = ! $this->option('glob') && is_file($manifestPath);
+
+        if ($useManifest) {
+            $images = $this->loadManifest($manifestPath);
+            if ($images === null) {
+                $this->error("Invalid manifest: {$manifestPath}");
+
+                return Command::FAILURE;
+            }
+            $this->info('Found '.count($images).' questions in manifest.json');
+        } else {
+            $images = [];
+            foreach (glob("{$imagesPath}/*.png") as $file) {
+                $images[basename($file, '.png')] = ['path' => basename($file)];
+            }
+            $this->info('Found '.count($images).' image files');
+        }
 
         $synced = 0;
         $notFound = 0;
         $alreadyHadImage = 0;
         $errors = 0;
 
-        foreach ($files as $file) {
-            $filename = basename($file, '.png');
-
-            $parts = explode('_', $filename);
-            if (count($parts) !== 3) {
-                $this->warn("Invalid filename format: {$filename}");
+        // Resolve every entry to (age months, domain code, item number) first,
+        // then look up intervals, domains and questions with one query each.
+        $resolved = [];
+        foreach ($images as $questionId => $entry) {
+            $key = $this->resolveEntry($questionId, $entry);
+            if ($key === null) {
                 $errors++;
 
                 continue;
             }
+            $resolved[$questionId] = $key + ['url' => "/storage/asq3-images/{$entry['path']}"];
+        }
 
-            [$agePart, $domainPart, $numberPart] = $parts;
-
-            $ageMonths = $this->ageMapping[$agePart] ?? null;
-            if (! $ageMonths) {
-                $this->warn("Unknown age: {$agePart}");
-                $errors++;
-
-                continue;
-            }
-
-            $ageInterval = Asq3AgeInterval::where('min_age_months', '<=', $ageMonths)
-                ->where('max_age_months', '>=', $ageMonths)
-                ->first();
-
-            if (! $ageInterval) {
-                $this->warn("Age interval not found for {$ageMonths} months");
-                $errors++;
+        $domainIds = Asq3Domain::whereIn('code', array_unique(array_column($resolved, 'domain_code')))
+            ->pluck('id', 'code');
+        $intervals = Asq3AgeInterval::orderBy('id')->get(['id', 'min_age_months', 'max_age_months']);
+
+        $intervalIds = [];
+        foreach (array_unique(array_column($resolved, 'age_months')) as $ageMonths) {
+            $interval = $intervals->first(
+                fn ($interval) => $interval->min_age_months <= $ageMonths
+                    && $interval->max_age_months >= $ageMonths
+            );
+            $intervalIds[$ageMonths] = $interval?->id;
+        }
 
-                continue;
-            }
+        $questions = Asq3Question::whereIn('age_interval_id', array_filter($intervalIds))
+            ->whereIn('domain_id', $domainIds->values())
+            ->get(['id', 'age_interval_id', 'domain_id', 'question_number', 'image_url'])
+            ->keyBy(fn ($question) => "{$question->age_interval_id}:{$question->domain_id}:{$question->question_number}");
 
-            $domainCode = $this->domainMapping[$domainPart] ?? null;
-            if (! $domainCode) {
-                $this->warn("Unknown domain: {$domainPart}");
+        $updates = [];
+        foreach ($resolved as $questionId => $key) {
+            $intervalId = $intervalIds[$key['age_months']] ?? null;
+            if (! $intervalId) {
+                $this->warn("Age interval not found for {$key['age_months']} months");
                 $errors++;
 
                 continue;
             }
 
-            $domain = Asq3Domain::where('code', $domainCode)->first();
-            if (! $domain) {
-                $this->warn("Domain not found: {$domainCode}");
+            $domainId = $domainIds[$key['domain_code']] ?? null;
+            if (! $domainId) {
+                $this->warn("Domain not found: {$key['domain_code']}");
                 $errors++;
 
                 continue;
             }
 
-            $question = Asq3Question::where('age_interval_id', $ageInterval->id)
-                ->where('domain_id', $domain->id)
-                ->where('question_number', (int) $numberPart)
-                ->first();
-
+            $question = $questions->get("{$intervalId}:{$domainId}:{$key['question_number']}");
             if (! $question) {
-                $this->warn("Question not found: {$filename}");
+                $this->warn("Question not found: {$questionId}");
                 $notFound++;
 
                 continue;
             }
 
-            if ($question->image_url && ! $this->option('dry-run')) {
+            $imageUrl = $key['url'];
+
+            if ($question->image_url && ! $this->option('dry-run')
+                && ! ($useManifest && $this->isStaleGeneratedUrl($question->image_url, $imageUrl))) {
                 $alreadyHadImage++;
 
                 continue;
             }
 
-            $imageUrl = "/storage/asq3-images/{$filename}.png";
-
             if ($this->option('dry-run')) {
                 $this->line("Would update question #{$question->id}: {$imageUrl}");
             } else {
-                $question->update(['image_url' => $imageUrl]);
+                $updates[$question->id] = $imageUrl;
             }
 
             $synced++;
         }
 
+        if ($updates) {
+            $this->applyUpdates($updates);
+        }
+
         $this->newLine();
         $this->info('=== Sync Summary ===');
         $this->info("Synced: {$synced}");
@@ -156,4 +182,129 @@ class SyncAsq3ImagesCommand extends Command
 
         return Command::SUCCESS;
     }
+
+    /**
+     * Load question_id => entry pairs from the generator's manifest.json.
+     *
+     * Version 2 manifests carry age_months, domain_code and question_number;
+     * older entries only have the object path and are resolved from the
+     * question ID.
+     *
+     * @return array<string, array<string, mixed>>|null
+     */
+    private function loadManifest(string $manifestPath): ?array
+    {
+        $manifest = json_decode((string) file_get_contents($manifestPath), true);
+
+        if (! is_array($manifest) || ! is_array($manifest['entries'] ?? null)) {
+            return null;
+        }
+
+        $images = [];
+        foreach ($manifest['entries'] as $questionId => $entry) {
+            if (is_array($entry) && is_string($entry['object'] ?? null)) {
+                $images[$questionId] = ['path' => $entry['object']] + array_intersect_key(
+                    $entry,
+                    array_flip(['age_months', 'domain_code', 'question_number'])
+                );
+            }
+        }
+
+        return $images;
+    }
+
+    /**
+     * Identify the question an image belongs to.
+     *
+     * Uses the resolved manifest fields when present, otherwise parses a
+     * '<age>-bulan_<domain>_<number>' question ID.
+     *
+     * @param  array<string, mixed>  $entry
+     * @return array{age_months: int, domain_code: string, question_number: int}|null
+     */
+    private function resolveEntry(string $questionId, array $entry): ?array
+    {
+        if (isset($entry['age_months'], $entry['domain_code'], $entry['question_number'])) {
+            return [
+                'age_months' => (int) $entry['age_months'],
+                'domain_code' => (string) $entry['domain_code'],
+                'question_number' => (int) $entry['question_number'],
+            ];
+        }
+
+        $parts = explode('_', $questionId);
+        if (count($parts) !== 3) {
+            $this->warn("Invalid filename format: {$questionId}");
+
+            return null;
+        }
+
+        [$agePart, $domainPart, $numberPart] = $parts;
+
+        $ageMonths = $this->ageMapping[$agePart] ?? null;
+        if (! $ageMonths) {
+            $this->warn("Unknown age: {$agePart}");
+
+            return null;
+        }
+
+        $domainCode = $this->domainMapping[$domainPart] ?? null;
+        if (! $domainCode) {
+            $this->warn("Unknown domain: {$domainPart}");
+
+            return null;
+        }
+
+        return [
+            'age_months' => $ageMonths,
+            'domain_code' => $domainCode,
+            'question_number' => (int) $numberPart,
+        ];
+    }
+
+    /**
+     * Write all image URLs in one transaction with one UPDATE ... CASE per chunk.
+     *
+     * The query bypasses Eloquent, so updated_at is set here whenever the
+     * table has the column. Model events do not fire for these rows.
+     *
+     * @param  array<int, string>  $updates  question id => image URL
+     */
+    private function applyUpdates(array $updates): void
+    {
+        $model = new Asq3Question;
+        $touch = Schema::hasColumn($model->getTable(), $model->getUpdatedAtColumn())
+            ? [$model->getUpdatedAtColumn() => now()]
+            : [];
+
+        DB::transaction(function () use ($updates, $touch) {
+            foreach (array_chunk($updates, self::UPDATE_CHUNK_SIZE, true) as $chunk) {
+                $cases = '';
+                $bindings = [];
+                foreach ($chunk as $id => $imageUrl) {
+                    $cases .= 'WHEN ? THEN ? ';
+                    $bindings[] = $id;
+                    $bindings[] = $imageUrl;
+                }
+                $placeholders = implode(', ', array_fill(0, count($chunk), '?'));
+                $touchSql = $touch ? ', '.array_key_first($touch).' = ?' : '';
+
+                DB::update(
+                    "UPDATE asq3_questions SET image_url = CASE id {$cases}END{$touchSql} WHERE id IN ({$placeholders})",
+                    array_merge($bindings, array_values($touch), array_keys($chunk))
+                );
+            }
+        });
+    }
+
+    /**
+     * Generated images are content-addressed, so a different URL under the
+     * generator's directory means the image was regenerated and should be
+     * replaced. URLs pointing elsewhere were set by hand and are kept.
+     */
+    private function isStaleGeneratedUrl(string $currentUrl, string $imageUrl): bool
+    {
+        return $currentUrl !== $imageUrl
+            && str_starts_with($currentUrl, '/storage/asq3-images/');
+    }
 }
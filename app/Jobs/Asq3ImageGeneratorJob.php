@@ -0,0 +1,25 @@
+<?php
+
+namespace App\Jobs;
+
+use Illuminate\Contracts\Queue\Job;
+use RuntimeException;
+
+/**
+ * Handler named in the payloads asq3:queue-images pushes.
+ *
+ * Those jobs are consumed by `generate_asq3_images.py --worker`, not by a
+ * Laravel worker. If `php artisan queue:work` is ever pointed at their
+ * queue, each job fails at once with a clear message instead of an
+ * unresolvable handler error.
+ */
+class Asq3ImageGeneratorJob
+{
+    public function fire(Job $job, array $data): void
+    {
+        $job->fail(new RuntimeException(
+            "ASQ-3 image jobs on queue '{$job->getQueue()}' are processed by "
+            .'`python scripts/generate_asq3_images.py --worker`, not `php artisan queue:work`.'
+        ));
+    }
+}
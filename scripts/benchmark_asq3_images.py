@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+"""
+ASQ-3 Image Generator Benchmark
+
+Measures generate_asq3_images.py throughput without spending API quota.
+Starts a local OpenAI-compatible stand-in server (chat completions and
+images.generate with base64 PNGs) with configurable latency, 429 and 5xx
+injection, then runs the real generator against asq3.csv at several
+--limit/--concurrency settings and records questions/min, wall-clock time
+and peak RSS. Results can be saved and compared across commits.
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPT_DIR)
+GENERATOR = os.path.join(SCRIPT_DIR, "generate_asq3_images.py")
+
+# Question ids listed by clustering and batch prompt requests ("1. [id] ...").
+LISTED_ID_PATTERN = re.compile(r"^\d+\. \[([^\]]+)\]", re.M)
+
+
+def setup_logging() -> logging.Logger:
+    """
+    Configure logging with timestamps.
+
+    Returns:
+        logging.Logger: Configured logger instance
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    return logging.getLogger(__name__)
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parse a latency distribution spec into a sampler.
+
+    Supported forms (all values in seconds):
+        fixed:S                   always S
+        uniform:LO,HI             uniformly between LO and HI
+        lognormal:MEDIAN,SIGMA    log-normal with the given median
+        longtail:LO,HI,P,SLOW     uniform LO..HI, but SLOW with probability P
+
+    Args:
+        spec: Distribution spec
+
+    Returns:
+        Function taking a random.Random and returning a delay in seconds
+
+    Raises:
+        argparse.ArgumentTypeError: If the spec is malformed (the caller
+            reports it through parser.error)
+    """
+    name, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",")] if params else []
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid latency parameters: {spec}")
+
+    arity = {"fixed": 1, "uniform": 2, "lognormal": 2, "longtail": 4}
+    if name not in arity or len(values) != arity[name] or any(v < 0 for v in values):
+        raise argparse.ArgumentTypeError(
+            f"Invalid latency spec '{spec}' (expected fixed:S, uniform:LO,HI, "
+            f"lognormal:MEDIAN,SIGMA or longtail:LO,HI,P,SLOW)"
+        )
+
+    if name == "fixed":
+        return lambda rng: values[0]
+    if name == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "lognormal":
+        mu = math.log(max(values[0], 1e-6))
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    lo, hi, p, slow = values
+    return lambda rng: slow if rng.random() < p else rng.uniform(lo, hi)
+
+
+def parse_int_list(value: str) -> list[int]:
+    """Parse a comma-separated list of positive integers."""
+    try:
+        numbers = [int(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected comma-separated integers: {value}")
+    if not numbers or any(n <= 0 for n in numbers):
+        raise argparse.ArgumentTypeError(f"Expected positive integers: {value}")
+    return numbers
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def make_png_parts(size: int, seed: int) -> tuple[bytes, bytes]:
+    """
+    Build a noisy RGB PNG of size x size pixels, split before IEND.
+
+    Noise does not compress, so the file is about as large as a real
+    rendered image. Callers insert a unique tEXt chunk between the two
+    parts so every response is a distinct object in the store.
+
+    Returns:
+        Tuple of (signature through IDAT, IEND chunk)
+    """
+    rng = random.Random(seed)
+    row_bytes = size * 3
+    raw = b"".join(b"\x00" + rng.randbytes(row_bytes) for _ in range(size))
+    head = (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+    )
+    return head, _png_chunk(b"IEND", b"")
+
+
+class MockOpenAIServer:
+    """
+    Local OpenAI-compatible stand-in for benchmarking.
+
+    Serves POST /v1/chat/completions and POST /v1/images/generations (b64_json
+    or url responses, with the url served from GET /v1/mock-images/<id>.png).
+    Every request sleeps for a delay drawn from its latency distribution, and
+    a seeded fraction is answered with 429 (with Retry-After) or a random 5xx
+    instead. Chat replies understand the generator's clustering and batch
+    prompt requests, putting every question in its own cluster.
+    """
+
+    def __init__(
+        self,
+        chat_latency: Callable[[random.Random], float],
+        image_latency: Callable[[random.Random], float],
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: float = 1.0,
+        image_px: int = 512,
+        seed: int = 0,
+        port: int = 0,
+    ) -> None:
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.image_px = image_px
+        self.seed = seed
+        self.port = port
+
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.png_parts: dict[int, tuple[bytes, bytes]] = {}
+        self.url_images: dict[str, bytes] = {}
+        self.sequence = itertools.count(1)
+        self.stats: dict[str, int] = {}
+        self.httpd: Optional[ThreadingHTTPServer] = None
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def start(self) -> None:
+        """Start serving in a background thread."""
+        handler = type("MockHandler", (_MockHandler,), {"server_state": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop serving."""
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def reset(self) -> None:
+        """Reseed the random source and clear statistics between runs."""
+        with self.lock:
+            self.rng = random.Random(self.seed)
+            self.stats = {}
+            self.url_images.clear()
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def draw(self, kind: str) -> tuple[float, Optional[int]]:
+        """Draw a delay and an injected status code (None for success)."""
+        with self.lock:
+            sampler = self.image_latency if kind == "image" else self.chat_latency
+            delay = sampler(self.rng)
+            roll = self.rng.random()
+            if roll < self.throttle_rate:
+                return delay, 429
+            if roll < self.throttle_rate + self.error_rate:
+                return delay, self.rng.choice((500, 502, 503))
+            return delay, None
+
+    def png(self, size: int) -> bytes:
+        """Return a distinct PNG of the given size."""
+        with self.lock:
+            if size not in self.png_parts:
+                self.png_parts[size] = make_png_parts(size, self.seed)
+            head, tail = self.png_parts[size]
+            serial = next(self.sequence)
+        return head + _png_chunk(b"tEXt", f"Comment\x00mock {serial}".encode()) + tail
+
+    def chat_content(self, body: dict) -> str:
+        """Reply text for a chat completion request."""
+        user = body.get("messages", [{}])[-1].get("content", "")
+        ids = LISTED_ID_PATTERN.findall(user)
+        if '"clusters"' in user:
+            return json.dumps(
+                {
+                    "clusters": [
+                        {"canonical_id": qid, "question_ids": [qid], "reason": "mock"}
+                        for qid in ids
+                    ]
+                }
+            )
+        if '"prompts"' in user:
+            return json.dumps({"prompts": {qid: f"Mock illustration for {qid}" for qid in ids}})
+        return f"Mock illustration: {user[:200]}"
+
+    def image_size(self, body: dict) -> int:
+        """Pixel size of a generated image (--image-px, or the requested size)."""
+        if self.image_px:
+            return self.image_px
+        match = re.match(r"(\d+)x\d+", str(body.get("size", "")))
+        return int(match.group(1)) if match else 1024
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state: MockOpenAIServer
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        state = self.server_state
+        image_id = self.path.rsplit("/", 1)[-1].removesuffix(".png")
+        with state.lock:
+            data = state.url_images.pop(image_id, None)
+        if data is None:
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        state = self.server_state
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid JSON"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            kind = "chat"
+        elif self.path.endswith("/images/generations"):
+            kind = "image"
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        delay, status = state.draw(kind)
+        time.sleep(delay)
+        state.count(f"{kind}_requests")
+
+        if status == 429:
+            state.count("throttled")
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit exceeded (mock)", "type": "rate_limit"}},
+                {"Retry-After": f"{state.retry_after:g}"},
+            )
+            return
+        if status is not None:
+            state.count("server_errors")
+            self._send_json(status, {"error": {"message": "Injected server error (mock)"}})
+            return
+
+        if kind == "chat":
+            content = state.chat_content(body)
+            messages = body.get("messages", [])
+            prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+            completion_tokens = len(content) // 4
+            self._send_json(
+                200,
+                {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+            )
+            return
+
+        png = state.png(state.image_size(body))
+        if body.get("response_format") == "url":
+            image_id = f"img{next(state.sequence)}"
+            with state.lock:
+                state.url_images[image_id] = png
+            host, port = self.server.server_address[:2]
+            entry = {"url": f"http://{host}:{port}/v1/mock-images/{image_id}.png"}
+        else:
+            entry = {"b64_json": base64.b64encode(png).decode()}
+        self._send_json(200, {"created": int(time.time()), "data": [entry]})
+
+
+def git_revision() -> dict:
+    """Commit hash and dirty flag of the repository, if available."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        return {"commit": commit, "dirty": bool(dirty)}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def _maxrss_mib(rusage) -> float:
+    """Convert ru_maxrss (KiB on Linux, bytes on macOS) to MiB."""
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return rusage.ru_maxrss / divisor
+
+
+def run_case(
+    server: MockOpenAIServer,
+    csv_path: str,
+    limit: int,
+    concurrency: int,
+    extra_args: list[str],
+    env_overrides: dict[str, str],
+    keep: bool,
+    logger: logging.Logger,
+) -> dict:
+    """
+    Run the generator once in a fresh working directory.
+
+    The generator runs as a child process so its peak RSS can be measured
+    on its own via wait4().
+
+    Args:
+        server: Running mock server
+        csv_path: Questions CSV copied into the working directory as asq3.csv
+        limit: --limit passed to the generator
+        concurrency: --concurrency passed to the generator
+        extra_args: Further generator arguments
+        env_overrides: Environment variables set for the generator
+        keep: Keep the working directory instead of deleting it
+        logger: Logger instance
+
+    Returns:
+        Result dictionary for this case
+    """
+    server.reset()
+    workdir = tempfile.mkdtemp(prefix="asq3-bench-")
+    shutil.copyfile(csv_path, os.path.join(workdir, "asq3.csv"))
+    output_dir = os.path.join(workdir, "out")
+    report_path = os.path.join(workdir, "run-report.json")
+    log_path = os.path.join(workdir, "generator.log")
+
+    cmd = [
+        sys.executable,
+        GENERATOR,
+        "--output-dir",
+        output_dir,
+        "--report-file",
+        report_path,
+        "--limit",
+        str(limit),
+        "--concurrency",
+        str(concurrency),
+        *extra_args,
+    ]
+    env = {**os.environ, **env_overrides, "LLM_BASE_URL": server.base_url}
+
+    logger.info(f"Running limit={limit} concurrency={concurrency} ({workdir})")
+    started = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        proc = subprocess.Popen(
+            cmd, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - started
+
+    report = {}
+    if os.path.exists(report_path):
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+    questions = report.get("questions", {})
+    processed = questions.get("total", 0)
+
+    api_calls = {}
+    for entry in report.get("latency", {}).get("api_call_seconds", []):
+        api_calls[entry["labels"].get("kind", "api")] = {
+            key: entry[key] for key in ("count", "p50", "p95", "p99")
+        }
+
+    result = {
+        "limit": limit,
+        "concurrency": concurrency,
+        "extra_args": extra_args,
+        "exit_code": proc.returncode,
+        "wall_seconds": round(wall, 3),
+        "questions": processed,
+        "generated": questions.get("success", 0),
+        "errors": questions.get("error", 0),
+        "questions_per_min": round(processed / wall * 60, 2) if wall > 0 else 0.0,
+        "peak_rss_mib": round(_maxrss_mib(rusage), 1),
+        "phases": report.get("phases", {}),
+        "api_calls": api_calls,
+        "server": dict(server.stats),
+    }
+    if proc.returncode not in (0, 1) or not report:
+        logger.warning(f"  Generator failed (exit {proc.returncode}); see {log_path}")
+        keep = True
+    logger.info(
+        f"  {processed} questions in {wall:.1f}s = {result['questions_per_min']:.1f}/min, "
+        f"peak RSS {result['peak_rss_mib']:.0f} MiB, {result['errors']} errors"
+    )
+
+    if keep:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def case_key(result: dict) -> tuple:
+    return (result["limit"], result["concurrency"], tuple(result.get("extra_args", [])))
+
+
+def compare_results(previous: dict, results: list[dict], logger: logging.Logger) -> None:
+    """Log throughput and memory changes against an earlier results file."""
+    baseline = {case_key(r): r for r in previous.get("results", [])}
+    revision = previous.get("revision", {}).get("commit") or "baseline"
+    logger.info(f"Compared with {revision[:12]}:")
+    for result in results:
+        old = baseline.get(case_key(result))
+        label = f"limit={result['limit']} concurrency={result['concurrency']}"
+        if old is None:
+            logger.info(f"  {label}: no baseline")
+            continue
+
+        def change(key: str) -> str:
+            before, after = old.get(key) or 0, result.get(key) or 0
+            pct = f" ({(after - before) / before:+.1%})" if before else ""
+            return f"{before:g} -> {after:g}{pct}"
+
+        logger.info(
+            f"  {label}: questions/min {change('questions_per_min')}, "
+            f"wall {change('wall_seconds')}s, peak RSS {change('peak_rss_mib')} MiB"
+        )
+
+
+def main() -> int:
+    """
+    Main entry point for the script.
+
+    Returns:
+        Exit code (0 for success, 1 for error)
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark generate_asq3_images.py against a local mock API",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Default matrix: limits 50,200 x concurrency 1,4,8
+  python scripts/benchmark_asq3_images.py
+
+  # Save results, then compare a later commit against them
+  python scripts/benchmark_asq3_images.py --output bench-main.json
+  python scripts/benchmark_asq3_images.py --compare bench-main.json
+
+  # Slow, flaky API: long-tail image latency, 5% 429s and 2% 5xx
+  python scripts/benchmark_asq3_images.py --image-latency longtail:1,2,0.05,20 \\
+      --throttle-rate 0.05 --error-rate 0.02
+
+  # Pass extra generator flags after --
+  python scripts/benchmark_asq3_images.py --limits 100 -- --prompt-batch-size 10
+
+  # Only run the mock server (point LLM_BASE_URL at it yourself)
+  python scripts/benchmark_asq3_images.py --serve 8790
+        """,
+    )
+
+    parser.add_argument(
+        "--limits",
+        type=parse_int_list,
+        default=[50, 200],
+        help="Comma-separated --limit values (default: 50,200)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=parse_int_list,
+        default=[1, 4, 8],
+        help="Comma-separated --concurrency values (default: 1,4,8)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs per setting (default: 1)"
+    )
+    parser.add_argument(
+        "--csv",
+        default=os.path.join(REPO_ROOT, "asq3.csv"),
+        help="Questions CSV (default: asq3.csv in the repository root)",
+    )
+    parser.add_argument(
+        "--chat-latency",
+        default="lognormal:0.3,0.4",
+        help="Chat completion latency distribution (default: lognormal:0.3,0.4)",
+    )
+    parser.add_argument(
+        "--image-latency",
+        default="lognormal:1.0,0.4",
+        help="Image generation latency distribution (default: lognormal:1.0,0.4)",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with 429 (default: 0)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with 500/502/503 (default: 0)",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1.0,
+        help="Retry-After seconds sent with injected 429s (default: 1)",
+    )
+    parser.add_argument(
+        "--image-px",
+        type=int,
+        default=512,
+        help="Width/height of returned PNGs; 0 uses the requested size (default: 512)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for latencies and faults (default: 0)"
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="PROMPT_RPM/IMAGE_RPM for the generator (default: 0, unlimited)",
+    )
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Compare with a results file from --output")
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep each run's working directory"
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="Only run the mock server on PORT until interrupted",
+    )
+    parser.add_argument(
+        "extra_args",
+        nargs="*",
+        help="Extra generate_asq3_images.py arguments (after --)",
+    )
+
+    args = parser.parse_args()
+    try:
+        chat_latency = parse_latency(args.chat_latency)
+        image_latency = parse_latency(args.image_latency)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    logger = setup_logging()
+
+    server = MockOpenAIServer(
+        chat_latency=chat_latency,
+        image_latency=image_latency,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        image_px=args.image_px,
+        seed=args.seed,
+        port=args.serve or 0,
+    )
+    server.start()
+    logger.info(f"Mock API listening on {server.base_url}")
+
+    if args.serve:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+        return 0
+
+    if not os.path.exists(args.csv):
+        logger.error(f"CSV file not found: {args.csv}")
+        server.stop()
+        return 1
+
+    rpm = str(args.rpm)
+    env_overrides = {
+        "LLM_API_KEY": "benchmark",
+        "LLM_ENDPOINTS": "",
+        "PROMPT_RPM": rpm,
+        "IMAGE_RPM": rpm,
+        "PROMPT_TPM": "0",
+        "IMAGE_TPM": "0",
+    }
+
+    results = []
+    try:
+        for limit, concurrency in itertools.product(args.limits, args.concurrency):
+            for _ in range(max(1, args.repeat)):
+                results.append(
+                    run_case(
+                        server,
+                        args.csv,
+                        limit,
+                        concurrency,
+                        args.extra_args,
+                        env_overrides,
+                        args.keep,
+                        logger,
+                    )
+                )
+    finally:
+        server.stop()
+
+    logger.info("\n" + "=" * 60)
+    logger.info(f"{'limit':>6} {'conc':>5} {'wall s':>8} {'q/min':>8} {'RSS MiB':>8} {'errors':>7}")
+    for r in results:
+        logger.info(
+            f"{r['limit']:>6} {r['concurrency']:>5} {r['wall_seconds']:>8.1f} "
+            f"{r['questions_per_min']:>8.1f} {r['peak_rss_mib']:>8.0f} {r['errors']:>7}"
+        )
+    logger.info("=" * 60)
+
+    output = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "chat_latency": args.chat_latency,
+            "image_latency": args.image_latency,
+            "throttle_rate": args.throttle_rate,
+            "error_rate": args.error_rate,
+            "retry_after": args.retry_after,
+            "image_px": args.image_px,
+            "seed": args.seed,
+            "rpm": args.rpm,
+        },
+        "results": results,
+    }
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(json.load(f), results, logger)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        logger.info(f"Wrote results to {args.output}")
+
+    return 0 if all(r["exit_code"] in (0, 1) for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,22 +7,55 @@ Reads questions from CSV and creates visual representations for each question.
 """
 
 import argparse
+import asyncio
 import base64
+import cProfile
 import csv
 import hashlib
+import io
 import json
 import logging
 import os
+import pstats
+import random
 import re
 import shutil
+import signal
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
 import time
+import tracemalloc
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncOpenAI,
+    RateLimitError,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -120,12 +153,66 @@ def get_config() -> dict:
         - llm_api_key: API key for LLM
         - prompt_model: Model to use for prompt generation
         - image_model: Model to use for image generation
+        - prompt_rpm / prompt_tpm: Request and token limits per minute for prompt_model
+        - image_rpm / image_tpm: Request and token limits per minute for image_model
+          (0 disables a limit)
+        - prompt_cache_max_entries / prompt_cache_max_age_days: Prompt cache
+          eviction limits (0 disables a limit)
+        - image_response_format: 'b64_json' (default) or 'url'
+        - image_size / image_quality: Size and quality of final (HD tier) images
+        - draft_image_size / draft_image_quality: Size and quality of the
+          cheap drafts rendered first by --progressive
+        - api_max_retries: Retries per call after transient errors (5xx,
+          connection errors, timeouts)
+        - api_backoff_base / api_backoff_max: Full-jitter backoff bounds in seconds
+        - prompt_timeout / image_timeout: Per-call timeouts in seconds (0 disables)
+        - breaker_threshold: Consecutive transient failures that open the
+          circuit breaker (0 disables it)
+        - breaker_cooldown: Seconds an endpoint is ejected before probing again
+        - llm_endpoints: Optional JSON list from LLM_ENDPOINTS, one object per
+          backend with base_url, api_key and optional name, weight and
+          prompt_rpm/prompt_tpm/image_rpm/image_tpm overrides; when unset the
+          single LLM_BASE_URL/LLM_API_KEY endpoint is used
+        - http_max_connections: Connections in the HTTP pool shared by all endpoints
+        - db_connection / db_host / db_port / db_database / db_username /
+          db_password: The Laravel database holding the jobs table read by
+          --worker ('sqlite' or 'mysql'; db_database is a file path for SQLite)
+        - queue_table: Laravel's database queue table (DB_QUEUE_TABLE)
     """
     return {
         "llm_base_url": os.getenv("LLM_BASE_URL", "http://127.0.0.1:8045/v1"),
         "llm_api_key": os.getenv("LLM_API_KEY", "sk-e42b639c53274e9f90ce9693ad1c3f81"),
         "prompt_model": os.getenv("PROMPT_MODEL", "claude-opus-4-5-thinking"),
         "image_model": os.getenv("IMAGE_MODEL", "gemini-3-pro-image"),
+        "prompt_rpm": int(os.getenv("PROMPT_RPM", "60")),
+        "prompt_tpm": int(os.getenv("PROMPT_TPM", "100000")),
+        "image_rpm": int(os.getenv("IMAGE_RPM", "20")),
+        "image_tpm": int(os.getenv("IMAGE_TPM", "0")),
+        "prompt_cache_max_entries": int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "5000")),
+        "prompt_cache_max_age_days": float(os.getenv("PROMPT_CACHE_MAX_AGE_DAYS", "90")),
+        "image_response_format": os.getenv("IMAGE_RESPONSE_FORMAT", "b64_json"),
+        "image_size": os.getenv("IMAGE_SIZE", "1024x1024"),
+        "image_quality": os.getenv("IMAGE_QUALITY", "hd"),
+        "draft_image_size": os.getenv(
+            "IMAGE_DRAFT_SIZE", os.getenv("IMAGE_SIZE", "1024x1024")
+        ),
+        "draft_image_quality": os.getenv("IMAGE_DRAFT_QUALITY", "standard"),
+        "api_max_retries": int(os.getenv("API_MAX_RETRIES", "4")),
+        "api_backoff_base": float(os.getenv("API_BACKOFF_BASE", "1")),
+        "api_backoff_max": float(os.getenv("API_BACKOFF_MAX", "60")),
+        "prompt_timeout": float(os.getenv("PROMPT_TIMEOUT", "120")),
+        "image_timeout": float(os.getenv("IMAGE_TIMEOUT", "300")),
+        "breaker_threshold": int(os.getenv("BREAKER_THRESHOLD", "5")),
+        "breaker_cooldown": float(os.getenv("BREAKER_COOLDOWN", "30")),
+        "llm_endpoints": os.getenv("LLM_ENDPOINTS", ""),
+        "http_max_connections": int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        "db_connection": os.getenv("DB_CONNECTION", "sqlite"),
+        "db_host": os.getenv("DB_HOST", "127.0.0.1"),
+        "db_port": int(os.getenv("DB_PORT", "3306")),
+        "db_database": os.getenv("DB_DATABASE", os.path.join("database", "database.sqlite")),
+        "db_username": os.getenv("DB_USERNAME", "root"),
+        "db_password": os.getenv("DB_PASSWORD", ""),
+        "queue_table": os.getenv("DB_QUEUE_TABLE", "jobs"),
     }
 
 
@@ -137,6 +224,16 @@ DOMAIN_MAP = {
     "Personal-Sosial": "Personal-social skills",
 }
 
+# asq3_domains.code for each CSV domain, written to manifest.json so
+# asq3:sync-images can match questions without parsing filenames.
+DOMAIN_CODES = {
+    "Komunikasi": "communication",
+    "Motorik Kasar": "gross_motor",
+    "Motorik Halus": "fine_motor",
+    "Pemecahan Masalah": "problem_solving",
+    "Personal-Sosial": "personal_social",
+}
+
 AGE_RANGES = {
     "baby": [(2, 6)],
     "infant": [(8, 12)],
@@ -176,583 +273,5755 @@ def _get_child_term(age_months: int) -> str:
     return "child"
 
 
-def get_client(config: dict) -> OpenAI:
-    """
-    Initialize OpenAI-compatible client.
+# Maximum number of times a single call is retried after a 429 response.
+THROTTLE_RETRIES = 6
 
-    Args:
-        config: Configuration dictionary with llm_base_url and llm_api_key
+# Status codes worth retrying besides 429 and 5xx.
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 425})
 
-    Returns:
-        OpenAI client instance
-    """
-    return OpenAI(
-        base_url=config["llm_base_url"],
-        api_key=config["llm_api_key"],
-    )
+# asyncio.wait_for raises asyncio.TimeoutError, which is only an alias of the
+# builtin TimeoutError from Python 3.11 on.
+TIMEOUT_ERRORS = (TimeoutError, asyncio.TimeoutError)
 
 
-def get_filename(age: str, domain: str, number: str) -> str:
+def classify_api_error(error: BaseException) -> str:
     """
-    Generate sanitized filename for an ASQ-3 question image.
+    Classify an API call failure for the retry policy.
 
     Args:
-        age: Age range string (e.g. '2 Bulan')
-        domain: Domain name (e.g. 'Motorik Kasar')
-        number: Item number
+        error: Exception raised by the call
 
     Returns:
-        Sanitized filename like '2-bulan_motorik-kasar_1.png'
+        'throttle' for 429 responses, 'transient' for errors worth retrying
+        (connection errors, timeouts, 5xx and RETRYABLE_STATUS_CODES) and
+        'fatal' for everything else
     """
-    age_sanitized = re.sub(r"\s+", "-", age.strip().lower())
-    domain_sanitized = re.sub(r"\s+", "-", domain.strip().lower())
-    return f"{age_sanitized}_{domain_sanitized}_{number}.png"
+    if isinstance(error, RateLimitError):
+        return "throttle"
+    if isinstance(error, (APIConnectionError, *TIMEOUT_ERRORS, httpx.TransportError)):
+        return "transient"
+    if isinstance(error, APIStatusError):
+        status = error.status_code
+    elif isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    else:
+        return "fatal"
+    if status == 429:
+        return "throttle"
+    return "transient" if status >= 500 or status in RETRYABLE_STATUS_CODES else "fatal"
 
 
-def generate_prompt(
-    client: OpenAI,
-    question_text: str,
-    age_interval: str,
-    domain: str,
-    config: dict,
-) -> str:
+def _parse_duration(value: str) -> Optional[float]:
     """
-    Use Claude to create an optimized image generation prompt.
+    Parse a rate-limit duration header into seconds.
+
+    Accepts plain seconds ('1.5'), Go-style durations ('1m30s', '500ms')
+    and HTTP dates as sent in Retry-After.
 
     Args:
-        client: OpenAI-compatible client
-        question_text: The ASQ-3 question text
-        age_interval: Age range string (e.g. '2 Bulan')
-        domain: Domain name in Indonesian
-        config: Configuration dictionary
+        value: Raw header value
 
     Returns:
-        Optimized prompt string for image generation
+        Duration in seconds, or None if the value cannot be parsed
     """
-    age_months = _parse_age_months(age_interval)
-    child_term = _get_child_term(age_months)
-    domain_en = DOMAIN_MAP.get(domain, domain)
-
-    system_prompt = (
-        "You are an expert at creating image generation prompts for child development illustrations. "
-        "Create a child-friendly, colorful cartoon illustration prompt based on the given ASQ-3 screening question. "
-        f"The child in the image should be depicted as a {child_term} (around {age_months} months old). "
-        f"The activity relates to {domain_en}. "
-        "Important guidelines:\n"
-        "- No text in the image\n"
-        "- Warm, friendly, educational style\n"
-        "- Bright, appealing colors suitable for a parenting app\n"
-        "- Show the child performing or attempting the described activity\n"
-        "- Safe, nurturing environment\n"
-        "- Simple, clear composition\n"
-        "Return ONLY the image prompt, nothing else."
-    )
-
-    response = client.chat.completions.create(
-        model=config["prompt_model"],
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": f"Create an image prompt for this ASQ-3 question ({age_interval}, {domain}): {question_text}",
-            },
-        ],
-        max_tokens=300,
-        temperature=0.7,
-    )
+    value = value.strip()
+    if not value:
+        return None
 
-    content = response.choices[0].message.content
-    return content.strip() if content else ""
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+        return sum(float(n) * scale[u] for n, u in parts)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
 
-def generate_image(client: OpenAI, prompt: str, config: dict) -> str:
+class TokenBucket:
     """
-    Generate an image using the image generation API.
+    Continuously refilling token bucket measured in units per minute.
 
-    Args:
-        client: OpenAI-compatible client
-        prompt: Image generation prompt
-        config: Configuration dictionary
+    Reservations may drive the balance negative; the caller is told how long
+    to wait until its reservation is covered. A rate of 0 disables the bucket.
+    """
 
-    Returns:
-        Base64-encoded image data
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = float(per_minute)
+        self.tokens = self.per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(self.per_minute, self.tokens + elapsed * self.per_minute / 60)
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Reserve capacity and return the seconds to wait before using it.
+
+        Args:
+            amount: Units to reserve (clamped to the bucket capacity)
+            now: Current monotonic time
+
+        Returns:
+            Seconds until the reservation is covered (0 if available now)
+        """
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        self.tokens -= min(amount, self.per_minute)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens * 60 / self.per_minute
+
+    def refund(self, amount: float) -> None:
+        """Return (or, if negative, charge) capacity after reconciling usage."""
+        if self.per_minute > 0:
+            self.tokens = min(self.per_minute, self.tokens + amount)
+
+    def set_rate(self, per_minute: float, now: float) -> None:
+        """Change the refill rate, keeping the current balance within capacity."""
+        self._refill(now)
+        self.per_minute = float(per_minute)
+        self.tokens = min(self.tokens, self.per_minute)
+
+
+class CircuitBreaker:
     """
-    response = client.images.generate(
-        model=config["image_model"],
-        prompt=prompt,
-        size="1024x1024",
-        quality="hd",
-        n=1,
-        response_format="b64_json",
-    )
+    Eject an endpoint from routing while it keeps failing.
 
-    data = response.data
-    if not data:
-        raise RuntimeError("Image API returned no data")
-    b64 = data[0].b64_json
-    if b64 is None:
-        raise RuntimeError("Image API returned no b64_json data")
-    return b64
+    After `threshold` consecutive transient failures the circuit opens and
+    the endpoint stops being admitted. Once the cooldown has passed a single
+    probe request is let through: any response closes the circuit and
+    re-admits the endpoint, another transient failure reopens it with a
+    doubled cooldown (capped at max_cooldown). 429 responses and client
+    errors mean the endpoint is up, so they count as successes here.
+
+    State is guarded by a threading lock, like ModelRateLimiter.
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        cooldown: float,
+        max_cooldown: float = 300.0,
+        name: str = "endpoint",
+    ) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = max(0.1, cooldown)
+        self.cooldown = self.base_cooldown
+        self.max_cooldown = max(self.base_cooldown, max_cooldown)
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+        self.trips = 0
+
+    def admits(self, now: float) -> bool:
+        """Return True if a call could be admitted right now."""
+        with self.lock:
+            return (
+                self.threshold <= 0
+                or self.state == "closed"
+                or (now >= self.open_until and not self.probe_in_flight)
+            )
+
+    def admit(self) -> Optional[bool]:
+        """
+        Admit one call if the circuit allows it.
+
+        Returns:
+            None if the endpoint is ejected, otherwise True if this call is the
+            probe that decides whether to close the circuit
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.threshold <= 0 or self.state == "closed":
+                return False
+            if now >= self.open_until and not self.probe_in_flight:
+                self.state = "half-open"
+                self.probe_in_flight = True
+                return True
+            return None
+
+    def ejected_for(self, now: float) -> float:
+        """Seconds until the endpoint may be probed again (0 if admitting)."""
+        with self.lock:
+            if self.threshold <= 0 or self.state == "closed":
+                return 0.0
+            return max(self.open_until - now, 0.0)
+
+    def record_success(self, probe: bool) -> None:
+        """Register a response from the endpoint, closing an open circuit."""
+        with self.lock:
+            self.failures = 0
+            if probe:
+                self.probe_in_flight = False
+            if self.state != "closed":
+                self.state = "closed"
+                self.cooldown = self.base_cooldown
+                self.logger.info(f"Endpoint {self.name} healthy again, re-admitted")
+
+    def record_failure(self, probe: bool) -> bool:
+        """
+        Register a transient failure.
+
+        Returns:
+            True if the circuit is open, so the call should be re-routed
+            instead of spending one of its own retries
+        """
+        with self.lock:
+            if self.threshold <= 0:
+                return False
+            now = time.monotonic()
+            self.failures += 1
+            if probe:
+                self.probe_in_flight = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open(now)
+            elif self.state == "closed" and self.failures >= self.threshold:
+                self._open(now)
+            return self.state != "closed"
+
+    def release_probe(self, probe: bool) -> None:
+        """Let another caller probe if this probe was abandoned (e.g. cancelled)."""
+        if probe:
+            with self.lock:
+                self.probe_in_flight = False
+
+    def _open(self, now: float) -> None:
+        """Open the circuit for the current cooldown. Caller must hold the lock."""
+        self.state = "open"
+        self.open_until = now + self.cooldown
+        self.trips += 1
+        self.logger.warning(
+            f"Endpoint {self.name} ejected after {self.failures} consecutive failures "
+            f"for {self.cooldown:.0f}s"
+        )
 
 
-def save_image(image_data: str, output_dir: str, filename: str) -> bool:
+class RetryPolicy:
     """
-    Decode base64 image data and save as PNG file.
+    Retry settings shared by every API call.
 
-    Args:
-        image_data: Base64-encoded image data
-        output_dir: Directory to save the image
-        filename: Target filename
+    Transient failures are retried up to max_retries times with full-jitter
+    exponential backoff (a random delay between 0 and
+    min(max_delay, base_delay * 2**attempt)). A failure that ejects its
+    endpoint is re-routed without using up a retry.
+    """
 
-    Returns:
-        True if saved successfully, False otherwise
+    def __init__(
+        self, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 60.0
+    ) -> None:
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.retries = 0
+        self.timeouts = 0
+        self.paused_seconds = 0.0
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter delay in seconds before retry number `attempt` (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def summary(self) -> str:
+        """One-line description of retries, timeouts and pauses."""
+        return (
+            f"{self.retries} transient retries, {self.timeouts} timeouts, "
+            f"paused {self.paused_seconds:.1f}s with every endpoint ejected"
+        )
+
+
+class ModelRateLimiter:
     """
-    try:
-        raw = base64.b64decode(image_data)
+    Adaptive requests/minute and tokens/minute limiter for one model.
 
-        if raw[:8] != b"\x89PNG\r\n\x1a\n":
-            logging.getLogger(__name__).warning(
-                f"Image data for {filename} does not have PNG header, saving anyway"
-            )
+    Each call reserves one request and an estimated token count before it is
+    sent. A 429 response pauses the model for Retry-After seconds and halves
+    the effective request rate; successful calls restore it gradually up to
+    the configured limit. Rate-limit response headers pause the model until
+    the advertised reset when the remaining quota reaches zero.
 
-        filepath = os.path.join(output_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(raw)
+    Reservation is guarded by a threading lock and never blocks, so callers
+    only ever wait in asyncio.sleep() outside the lock.
+    """
 
-        return True
-    except Exception as e:
-        logging.getLogger(__name__).error(f"Failed to save image {filename}: {e}")
-        return False
+    def __init__(self, model: str, rpm: int, tpm: int) -> None:
+        self.model = model
+        self.configured_rpm = rpm
+        self.configured_tpm = tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        self.throttled = 0
+        self.header_pauses = 0
+        self.wait_seconds = 0.0
+        self.min_rpm_seen = float(rpm)
+
+    def reserve(self, estimated_tokens: int) -> float:
+        """
+        Reserve one request plus estimated tokens.
+
+        Args:
+            estimated_tokens: Expected prompt + completion tokens
+
+        Returns:
+            Seconds the caller must wait before sending the request
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = max(
+                self.paused_until - now,
+                self.requests.reserve(1, now),
+                self.tokens.reserve(estimated_tokens, now),
+                0.0,
+            )
+            self.wait_seconds += delay
+            return delay
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        """Wait asynchronously until the request may be sent."""
+        delay = self.reserve(estimated_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_success(
+        self, headers, estimated_tokens: int, used_tokens: Optional[int]
+    ) -> None:
+        """
+        Reconcile token usage and adapt to rate-limit headers after a success.
+
+        Args:
+            headers: Response headers (mapping with case-insensitive get)
+            estimated_tokens: Tokens reserved before the call
+            used_tokens: Actual total tokens reported by the API, if any
+        """
+        with self.lock:
+            now = time.monotonic()
+            if used_tokens is not None:
+                self.tokens.refund(estimated_tokens - used_tokens)
+
+            if self.configured_rpm > 0 and self.requests.per_minute < self.configured_rpm:
+                recovered = min(
+                    self.configured_rpm,
+                    self.requests.per_minute + max(1.0, self.configured_rpm * 0.05),
+                )
+                self.requests.set_rate(recovered, now)
+
+            self._apply_headers(headers, now)
+
+    def record_throttle(self, headers) -> float:
+        """
+        Register a 429 response and back off.
+
+        Args:
+            headers: Response headers of the 429 response
+
+        Returns:
+            Seconds the model is paused for
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+
+            retry_after = None
+            if headers is not None:
+                retry_after_ms = headers.get("retry-after-ms")
+                if retry_after_ms:
+                    parsed = _parse_duration(retry_after_ms)
+                    retry_after = parsed / 1000 if parsed is not None else None
+                if retry_after is None and headers.get("retry-after"):
+                    retry_after = _parse_duration(headers.get("retry-after"))
+            if retry_after is None:
+                retry_after = 2.0 ** min(self.throttled, 6)
+
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+            if self.requests.per_minute > 1:
+                self.requests.set_rate(max(1.0, self.requests.per_minute / 2), now)
+                self.min_rpm_seen = min(self.min_rpm_seen, self.requests.per_minute)
+
+            self._apply_headers(headers, now)
+            return self.paused_until - now
+
+    def _apply_headers(self, headers, now: float) -> None:
+        """Honour x-ratelimit-* headers. Caller must hold the lock."""
+        if headers is None:
+            return
+
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        if limit_requests and limit_requests.isdigit():
+            advertised = int(limit_requests)
+            if 0 < advertised < self.requests.per_minute:
+                self.requests.set_rate(advertised, now)
+                self.min_rpm_seen = min(self.min_rpm_seen, advertised)
+
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            if remaining is None or reset is None or remaining.strip() != "0":
+                continue
+            reset_seconds = _parse_duration(reset)
+            if reset_seconds:
+                self.paused_until = max(self.paused_until, now + reset_seconds)
+                self.header_pauses += 1
+
+    def summary(self) -> str:
+        """One-line description of configured limits and observed throttling."""
+        rpm = self.configured_rpm or "unlimited"
+        tpm = self.configured_tpm or "unlimited"
+        lowest = f"lowest rpm {self.min_rpm_seen:.0f}, " if self.configured_rpm else ""
+        return (
+            f"{self.model}: {rpm} rpm / {tpm} tpm configured, "
+            f"{self.throttled} throttled (429), {self.header_pauses} header pauses, "
+            f"{lowest}waited {self.wait_seconds:.1f}s"
+        )
 
 
-def load_checkpoint(checkpoint_path: str) -> dict:
+def build_rate_limiters(config: dict) -> dict[str, ModelRateLimiter]:
     """
-    Load checkpoint data from JSON file.
+    Create one rate limiter per configured model.
+
+    If prompt_model and image_model are the same model they share a single
+    limiter using the prompt limits.
 
     Args:
-        checkpoint_path: Path to checkpoint JSON file
+        config: Configuration dictionary from get_config(), or an endpoint's
+            copy of it with per-endpoint limits
 
     Returns:
-        Checkpoint dictionary with 'completed' list and 'duplicates' dict
+        Dictionary mapping model name to its ModelRateLimiter
     """
-    if os.path.exists(checkpoint_path):
-        with open(checkpoint_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"completed": [], "duplicates": {}, "hashes": {}}
+    limiters: dict[str, ModelRateLimiter] = {}
+    limiters[config["prompt_model"]] = ModelRateLimiter(
+        config["prompt_model"], config["prompt_rpm"], config["prompt_tpm"]
+    )
+    limiters.setdefault(
+        config["image_model"],
+        ModelRateLimiter(config["image_model"], config["image_rpm"], config["image_tpm"]),
+    )
+    return limiters
+
+
+def _estimate_tokens(text: str, max_tokens: int = 0) -> int:
+    """Rough token estimate (4 characters per token) plus the completion budget."""
+    return len(text) // 4 + max_tokens
+
+
+def _usage_tokens(parsed) -> Optional[int]:
+    """Extract total token usage from a parsed API response, if reported."""
+    usage = getattr(parsed, "usage", None)
+    total = getattr(usage, "total_tokens", None) if usage is not None else None
+    return total if isinstance(total, int) else None
+
+
+# Usage fields reported by chat (prompt/completion) and image (input/output) responses.
+USAGE_TOKEN_FIELDS = {
+    "prompt_tokens": "prompt",
+    "completion_tokens": "completion",
+    "input_tokens": "prompt",
+    "output_tokens": "completion",
+    "total_tokens": "total",
+}
 
+REPORT_QUANTILES = (0.5, 0.95, 0.99)
 
-def save_checkpoint(checkpoint_path: str, checkpoint_data: dict) -> None:
+RUN_REPORT_FILENAME = "run-report.json"
+PROFILE_FILENAME = "profile.pstats"
+# Functions and allocation sites logged by --profile.
+PROFILE_TOP_ENTRIES = 25
+
+
+def _percentile(ordered: list[float], quantile: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * quantile))]
+
+
+class RunMetrics:
     """
-    Save checkpoint data to JSON file.
+    Latency samples, counters and phase timings for one run.
 
-    Args:
-        checkpoint_path: Path to checkpoint JSON file
-        checkpoint_data: Checkpoint dictionary to save
+    Samples and counters are keyed by a metric name plus labels (for example
+    api_call_seconds with kind="image"). Everything is recorded from the
+    event loop or the main thread, so no locking is needed. report() turns
+    the data into the JSON run report, and write_prometheus() into a
+    node_exporter textfile.
     """
-    with open(checkpoint_path, "w", encoding="utf-8") as f:
-        json.dump(checkpoint_data, f, indent=2, ensure_ascii=False)
 
+    PROMETHEUS_PREFIX = "asq3_images"
+
+    def __init__(self) -> None:
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.samples: dict[tuple, list[float]] = {}
+        self.counters: dict[tuple, float] = {}
+        self.phases: dict[str, float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Record one latency (or other) sample."""
+        self.samples.setdefault(self._key(name, labels), []).append(value)
+
+    def add(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increase a counter."""
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_usage(self, parsed, kind: str) -> None:
+        """Count the token usage reported in a parsed API response, if any."""
+        usage = getattr(parsed, "usage", None)
+        if usage is None:
+            return
+        for field, token_type in USAGE_TOKEN_FIELDS.items():
+            value = getattr(usage, field, None)
+            if isinstance(value, int):
+                self.add("api_tokens_total", value, kind=kind, type=token_type)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a top-level phase of the run (clustering, generation, ...)."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - started
+
+    def histograms(self) -> dict[str, list[dict]]:
+        """Summaries of every sampled metric, grouped by metric name."""
+        result: dict[str, list[dict]] = {}
+        for (name, labels), values in sorted(self.samples.items()):
+            ordered = sorted(values)
+            entry = {
+                "labels": dict(labels),
+                "count": len(ordered),
+                "sum": round(sum(ordered), 6),
+                "max": round(ordered[-1], 6),
+            }
+            for quantile in REPORT_QUANTILES:
+                entry[f"p{quantile * 100:g}"] = round(_percentile(ordered, quantile), 6)
+            result.setdefault(name, []).append(entry)
+        return result
+
+    def report(self, **sections) -> dict:
+        """
+        Build the run report.
+
+        Args:
+            **sections: Extra top-level sections (outcome counts, endpoints, ...)
+
+        Returns:
+            JSON-serialisable dictionary
+        """
+        counters: dict[str, list[dict]] = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "duration_seconds": round(time.monotonic() - self.started, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "latency": self.histograms(),
+            "counters": counters,
+            **sections,
+        }
+
+    def write_json(self, path: str, report: dict) -> None:
+        """Atomically write a report from report() as JSON."""
+        _write_text_atomic(path, json.dumps(report, indent=2, ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path: str, report: dict) -> None:
+        """
+        Atomically write a report as a Prometheus textfile.
+
+        Latency metrics become summaries with 0.5/0.95/0.99 quantiles,
+        counters become counters and phases a duration gauge. Numeric values
+        of the "questions" section are exported as a labelled gauge.
+        """
+        prefix = self.PROMETHEUS_PREFIX
+
+        def labels_text(labels: dict, **extra: str) -> str:
+            merged = {**labels, **extra}
+            if not merged:
+                return ""
+            pairs = []
+            for key, value in merged.items():
+                escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+                pairs.append(f'{key}="{escaped}"')
+            return "{" + ",".join(pairs) + "}"
+
+        lines = [
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration_seconds']}",
+            f"# HELP {prefix}_phase_duration_seconds Wall time per phase of the last run",
+            f"# TYPE {prefix}_phase_duration_seconds gauge",
+        ]
+        lines.extend(
+            f"{prefix}_phase_duration_seconds{labels_text({'phase': name})} {seconds}"
+            for name, seconds in report["phases"].items()
+        )
 
-def load_errors(errors_path: str) -> dict:
+        for name, entries in report["latency"].items():
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for entry in entries:
+                for quantile in REPORT_QUANTILES:
+                    value = entry[f"p{quantile * 100:g}"]
+                    lines.append(
+                        f"{metric}{labels_text(entry['labels'], quantile=f'{quantile:g}')} {value}"
+                    )
+                lines.append(f"{metric}_sum{labels_text(entry['labels'])} {entry['sum']}")
+                lines.append(f"{metric}_count{labels_text(entry['labels'])} {entry['count']}")
+
+        for name, entries in report["counters"].items():
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(
+                f"{metric}{labels_text(entry['labels'])} {entry['value']:g}" for entry in entries
+            )
+
+        questions = report.get("questions", {})
+        if questions:
+            lines.append(f"# TYPE {prefix}_questions gauge")
+            lines.extend(
+                f"{prefix}_questions{labels_text({'outcome': outcome})} {count}"
+                for outcome, count in questions.items()
+                if isinstance(count, (int, float))
+            )
+
+        _write_text_atomic(path, "\n".join(lines) + "\n")
+
+
+def _discard_temp(tmp_path: str) -> None:
+    """Remove a temporary file if it still exists."""
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def _atomic_file(path: str, mode: str = "w", fsync: bool = False) -> Iterator:
     """
-    Load error log from JSON file.
+    Open a temporary file next to path and rename it into place on success.
+
+    Readers see either the previous file or the complete new one; if the
+    block raises, the temporary file is removed and path is untouched.
 
     Args:
-        errors_path: Path to errors JSON file
+        path: Final file path; its directory must exist
+        mode: 'w' for UTF-8 text or 'wb' for bytes
+        fsync: Flush the data to disk before the rename
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, mode, encoding=None if "b" in mode else "utf-8") as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _discard_temp(tmp_path)
+        raise
+
+
+def _write_text_atomic(path: str, text: str, fsync: bool = False) -> None:
+    """Write a text file through a temporary file and rename it into place."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _atomic_file(path, fsync=fsync) as f:
+        f.write(text)
+
+
+class Endpoint:
+    """
+    One OpenAI-compatible backend in an EndpointPool.
 
-    Returns:
-        Dictionary with 'errors' list
+    Has its own rate limiters and circuit breaker, and counts requests,
+    failures and latencies for the run summary.
     """
-    if os.path.exists(errors_path):
-        with open(errors_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"errors": []}
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: str,
+        weight: float,
+        limiters: dict[str, ModelRateLimiter],
+        breaker: CircuitBreaker,
+    ) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = max(weight, 0.001)
+        self.limiters = limiters
+        self.breaker = breaker
+        self.client: Optional[AsyncOpenAI] = None
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.latencies: deque[float] = deque(maxlen=2000)
+
+    def summary(self) -> str:
+        """One-line description of traffic, failures and latency."""
+        latency = ""
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            p50 = _percentile(ordered, 0.5)
+            p95 = _percentile(ordered, 0.95)
+            latency = f", latency p50 {p50:.2f}s / p95 {p95:.2f}s"
+        return (
+            f"{self.name} (weight {self.weight:g}): {self.requests} requests, "
+            f"{self.failures} transient failures, {self.breaker.trips} ejections{latency}"
+        )
 
 
-def save_error(errors_path: str, question_id: str, error_message: str) -> None:
+class EndpointPool:
     """
-    Append an error entry to the errors JSON file.
+    Route API calls across one or more endpoints.
 
-    Args:
-        errors_path: Path to errors JSON file
-        question_id: Identifier for the question that failed
-        error_message: Description of the error
+    Each call goes to the admitted endpoint with the fewest outstanding
+    requests relative to its weight; requests waiting in an endpoint's rate
+    limiter count as outstanding, so a throttled endpoint naturally gets
+    less traffic. Endpoints whose circuit breaker opens are ejected until a
+    probe succeeds. When every endpoint is ejected, callers wait, which
+    pauses the whole pipeline until one is re-admitted.
+
+    All endpoint clients share one httpx connection pool. It belongs to the
+    running event loop and is created on first use; close() releases it.
+
+    Latency, rate-limit waits, token usage and retries of every call are
+    recorded in `metrics` under the call's kind.
     """
-    errors = load_errors(errors_path)
-    errors["errors"].append(
-        {
-            "question_id": question_id,
-            "error": error_message,
-            "timestamp": datetime.now().isoformat(),
-        }
-    )
-    with open(errors_path, "w", encoding="utf-8") as f:
-        json.dump(errors, f, indent=2, ensure_ascii=False)
 
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        retry_policy: RetryPolicy,
+        max_connections: int,
+        metrics: Optional[RunMetrics] = None,
+    ) -> None:
+        self.endpoints = endpoints
+        self.retry_policy = retry_policy
+        self.max_connections = max(1, max_connections)
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.http_client: Optional[httpx.AsyncClient] = None
+
+    def _ensure_clients(self) -> None:
+        """Create the shared HTTP pool and per-endpoint clients on first use."""
+        if self.http_client is not None:
+            return
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+        )
+        for endpoint in self.endpoints:
+            endpoint.client = AsyncOpenAI(
+                base_url=endpoint.base_url,
+                api_key=endpoint.api_key,
+                max_retries=0,
+                http_client=self.http_client,
+            )
 
-def get_question_hash(question_text: str) -> str:
+    async def close(self) -> None:
+        """Close the shared HTTP pool; clients are recreated on next use."""
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+            for endpoint in self.endpoints:
+                endpoint.client = None
+
+    async def _pick(self) -> tuple[Endpoint, bool]:
+        """Wait for an admitted endpoint and return it with its probe flag."""
+        waited_since = None
+        while True:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e.breaker.admits(now)]
+            candidates.sort(key=lambda e: (e.outstanding + 1) / e.weight)
+            for endpoint in candidates:
+                probe = endpoint.breaker.admit()
+                if probe is not None:
+                    if waited_since is not None:
+                        self.retry_policy.paused_seconds += time.monotonic() - waited_since
+                    return endpoint, probe
+
+            if waited_since is None:
+                waited_since = now
+            delay = min(e.breaker.ejected_for(now) for e in self.endpoints)
+            await asyncio.sleep(min(max(delay, 0.5), 5.0))
+
+    async def call(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request,
+        timeout: Optional[float] = None,
+        kind: str = "api",
+    ):
+        """
+        Send an API request to the best endpoint, with rate limiting and retries.
+
+        429 responses are retried after waiting as long as the endpoint's
+        limiter requires. Transient failures (see classify_api_error) are
+        retried with full-jitter backoff, possibly on another endpoint;
+        fatal errors are raised at once.
+
+        Args:
+            model: Model name, selecting the endpoint's rate limiter
+            estimated_tokens: Expected tokens for the TPM bucket
+            request: Function taking an AsyncOpenAI client and returning a
+                coroutine for a raw API response (from .with_raw_response)
+            timeout: Seconds before a single attempt is abandoned (None or 0 for no limit)
+            kind: Metrics label for the call (cluster, prompt, prompt_batch, image)
+
+        Returns:
+            The parsed API response
+        """
+        self._ensure_clients()
+        policy = self.retry_policy
+        metrics = self.metrics
+        transient_attempts = 0
+        throttle_attempts = 0
+        while True:
+            endpoint, probe = await self._pick()
+            limiter = endpoint.limiters[model]
+            breaker = endpoint.breaker
+            endpoint.outstanding += 1
+            try:
+                waiting = time.monotonic()
+                await limiter.acquire(estimated_tokens)
+                endpoint.requests += 1
+                started = time.monotonic()
+                metrics.observe("rate_limit_wait_seconds", started - waiting, kind=kind)
+                if timeout:
+                    raw = await asyncio.wait_for(request(endpoint.client), timeout)
+                else:
+                    raw = await request(endpoint.client)
+            except Exception as e:
+                error_kind = classify_api_error(e)
+                if error_kind == "transient":
+                    endpoint.failures += 1
+                    if isinstance(e, TIMEOUT_ERRORS):
+                        policy.timeouts += 1
+                        metrics.add("api_timeouts_total", kind=kind)
+                    if breaker.record_failure(probe):
+                        continue
+                    if transient_attempts >= policy.max_retries:
+                        raise
+                    transient_attempts += 1
+                    policy.retries += 1
+                    metrics.add("api_retries_total", kind=kind)
+                    await asyncio.sleep(policy.backoff(transient_attempts))
+                    continue
+
+                breaker.record_success(probe)
+                if error_kind == "throttle" and throttle_attempts < THROTTLE_RETRIES:
+                    throttle_attempts += 1
+                    metrics.add("api_throttles_total", kind=kind)
+                    limiter.record_throttle(e.response.headers)
+                    continue
+                raise
+            except BaseException:
+                breaker.release_probe(probe)
+                raise
+            finally:
+                endpoint.outstanding -= 1
+
+            breaker.record_success(probe)
+            elapsed = time.monotonic() - started
+            endpoint.latencies.append(elapsed)
+            metrics.observe("api_call_seconds", elapsed, kind=kind)
+            parsed = raw.parse()
+            metrics.record_usage(parsed, kind)
+            limiter.record_success(raw.headers, estimated_tokens, _usage_tokens(parsed))
+            return parsed
+
+    def limiter_summaries(self) -> list[str]:
+        """Rate limiter summaries, prefixed with the endpoint name if there are several."""
+        lines = []
+        for endpoint in self.endpoints:
+            prefix = f"{endpoint.name} " if len(self.endpoints) > 1 else ""
+            lines.extend(f"{prefix}{limiter.summary()}" for limiter in endpoint.limiters.values())
+        return lines
+
+
+def build_endpoint_pool(config: dict) -> EndpointPool:
     """
-    Compute MD5 hash of question text for deduplication.
+    Create the endpoint pool from LLM_ENDPOINTS or the single LLM_BASE_URL.
 
     Args:
-        question_text: The question text to hash
+        config: Configuration dictionary from get_config()
 
     Returns:
-        Hex digest of the MD5 hash
+        EndpointPool with per-endpoint limiters and circuit breakers
+
+    Raises:
+        ValueError: If LLM_ENDPOINTS is not a JSON list of endpoint objects
     """
-    return hashlib.md5(question_text.encode("utf-8")).hexdigest()
+    if config["llm_endpoints"]:
+        try:
+            specs = json.loads(config["llm_endpoints"])
+        except json.JSONDecodeError as e:
+            raise ValueError(f"LLM_ENDPOINTS is not valid JSON: {e}")
+        if not isinstance(specs, list) or not specs:
+            raise ValueError("LLM_ENDPOINTS must be a non-empty JSON list")
+    else:
+        specs = [{"base_url": config["llm_base_url"], "api_key": config["llm_api_key"]}]
+
+    endpoints = []
+    for i, spec in enumerate(specs, 1):
+        if not isinstance(spec, dict) or not spec.get("base_url"):
+            raise ValueError(f"LLM_ENDPOINTS entry {i} needs a base_url")
+        name = str(spec.get("name") or spec["base_url"])
+        endpoint_config = dict(config)
+        for key in ("prompt_rpm", "prompt_tpm", "image_rpm", "image_tpm"):
+            if key in spec:
+                endpoint_config[key] = int(spec[key])
+        endpoints.append(
+            Endpoint(
+                name,
+                spec["base_url"],
+                spec.get("api_key", config["llm_api_key"]),
+                float(spec.get("weight", 1)),
+                build_rate_limiters(endpoint_config),
+                CircuitBreaker(
+                    config["breaker_threshold"], config["breaker_cooldown"], name=name
+                ),
+            )
+        )
 
+    return EndpointPool(
+        endpoints,
+        RetryPolicy(
+            config["api_max_retries"], config["api_backoff_base"], config["api_backoff_max"]
+        ),
+        config["http_max_connections"],
+    )
 
-def get_csv_hash(csv_path: str) -> str:
+
+def get_filename(age: str, domain: str, number: str) -> str:
     """
-    Compute MD5 hash of CSV file for staleness detection.
+    Generate sanitized filename for an ASQ-3 question image.
 
     Args:
-        csv_path: Path to the CSV file
+        age: Age range string (e.g. '2 Bulan')
+        domain: Domain name (e.g. 'Motorik Kasar')
+        number: Item number
 
     Returns:
-        Hex digest of the MD5 hash of the file contents
+        Sanitized filename like '2-bulan_motorik-kasar_1.png'
     """
-    with open(csv_path, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+    age_sanitized = re.sub(r"\s+", "-", age.strip().lower())
+    domain_sanitized = re.sub(r"\s+", "-", domain.strip().lower())
+    return f"{age_sanitized}_{domain_sanitized}_{number}.png"
 
 
-def load_clusters(clusters_path: str) -> Optional[dict]:
+# Bump PROMPT_TEMPLATE_VERSION whenever PROMPT_SYSTEM_TEMPLATE, the batch
+# template or the user messages in generate_prompt()/generate_prompts_batch()
+# change; cached prompts from other versions are then ignored and can be
+# purged with --invalidate-prompt-cache stale.
+PROMPT_TEMPLATE_VERSION = 1
+
+PROMPT_GUIDELINES = (
+    "Important guidelines:\n"
+    "- No text in the image\n"
+    "- Warm, friendly, educational style\n"
+    "- Bright, appealing colors suitable for a parenting app\n"
+    "- Show the child performing or attempting the described activity\n"
+    "- Safe, nurturing environment\n"
+    "- Simple, clear composition\n"
+)
+
+PROMPT_SYSTEM_TEMPLATE = (
+    "You are an expert at creating image generation prompts for child development illustrations. "
+    "Create a child-friendly, colorful cartoon illustration prompt based on the given ASQ-3 screening question. "
+    "The child in the image should be depicted as a {child_term} (around {age_months} months old). "
+    "The activity relates to {domain_en}. "
+    + PROMPT_GUIDELINES
+    + "Return ONLY the image prompt, nothing else."
+)
+
+PROMPT_BATCH_SYSTEM_TEMPLATE = (
+    "You are an expert at creating image generation prompts for child development illustrations. "
+    "Create one child-friendly, colorful cartoon illustration prompt for each given ASQ-3 screening question. "
+    "Depict the child at the age stated for that question, performing an activity from its developmental area. "
+    "Each prompt must stand on its own. "
+    + PROMPT_GUIDELINES
+    + "Return ONLY valid JSON, no markdown fences, no explanation."
+)
+
+
+def get_prompt_cache_key(
+    question_text: str, age_interval: str, domain: str, config: dict
+) -> str:
     """
-    Load clusters from JSON file if it exists.
+    Compute the content-addressed cache key for a generate_prompt() result.
+
+    The key covers every input that shapes the prompt: question text, age
+    interval, child term, English domain description, the system-prompt
+    template (text and version) and the prompt model.
 
     Args:
-        clusters_path: Path to clusters JSON file
+        question_text: The ASQ-3 question text
+        age_interval: Age range string (e.g. '2 Bulan')
+        domain: Domain name in Indonesian
+        config: Configuration dictionary
 
     Returns:
-        Clusters dictionary or None if file does not exist
+        Hex digest of the SHA-256 cache key
     """
-    if os.path.exists(clusters_path):
-        with open(clusters_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return None
-
-
-def save_clusters(clusters_path: str, clusters_data: dict) -> None:
+    key_parts = [
+        question_text,
+        age_interval,
+        _get_child_term(_parse_age_months(age_interval)),
+        DOMAIN_MAP.get(domain, domain),
+        PROMPT_TEMPLATE_VERSION,
+        PROMPT_SYSTEM_TEMPLATE,
+        config["prompt_model"],
+    ]
+    encoded = json.dumps(key_parts, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def get_input_fingerprint(q: dict, config: dict) -> str:
     """
-    Save clusters to JSON file.
+    Describe the inputs an image was generated from.
+
+    Stored with every completed record so edited questions, a new prompt
+    template or a model change can be detected without calling any API.
 
     Args:
-        clusters_path: Path to clusters JSON file
-        clusters_data: Clusters dictionary to save
+        q: Question dictionary from load_questions()
+        config: Configuration dictionary
+
+    Returns:
+        JSON object string with sorted keys
     """
-    with open(clusters_path, "w", encoding="utf-8") as f:
-        json.dump(clusters_data, f, indent=2, ensure_ascii=False)
+    return json.dumps(
+        {
+            "text": get_question_hash(q["question_text"]),
+            "age": q["age"],
+            "domain": q["domain"],
+            "template": PROMPT_TEMPLATE_VERSION,
+            "prompt_model": config["prompt_model"],
+            "image_model": config["image_model"],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
 
 
-def cluster_questions(
+def find_stale_questions(
     questions: list[dict],
-    client: OpenAI,
+    store: "StateStore",
     config: dict,
-    output_dir: str,
-    logger: logging.Logger,
-) -> dict:
+    canonical_map: dict[str, str],
+) -> dict[str, str]:
     """
-    Cluster questions by semantic similarity using Claude Opus.
+    Find completed questions whose stored fingerprint no longer matches.
 
-    Groups questions by (domain, age_category) first, then uses Claude to
-    identify which questions within each group describe the same visual concept
-    and can share one illustration.
+    A question is stale when any fingerprinted input changed. Cluster copies
+    and duplicates are also stale when the image they alias is stale, or
+    when a cluster copy now belongs to a different canonical.
 
     Args:
         questions: List of question dictionaries from load_questions()
-        client: OpenAI-compatible client
+        store: State store with the completed records
         config: Configuration dictionary
-        output_dir: Directory for output files (clusters.json saved here)
-        logger: Logger instance
+        canonical_map: Question ID -> canonical ID from build_cluster_lookup()
 
     Returns:
-        Clusters data dictionary with structure suitable for save_clusters()
+        Dictionary mapping stale question IDs to a short reason, in CSV order
     """
-    from collections import defaultdict
+    records = store.completed_fingerprints()
+    stale: dict[str, str] = {}
 
-    csv_path = "asq3.csv"
+    for q in questions:
+        question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        record = records.get(question_id)
+        if record is None or record["fingerprint"] is None:
+            continue
+        current = json.loads(get_input_fingerprint(q, config))
+        stored = json.loads(record["fingerprint"])
+        changed = sorted(k for k in current if stored.get(k) != current[k])
+        if changed:
+            stale[question_id] = f"changed {', '.join(changed)}"
 
-    groups: dict[tuple[str, str], list[dict]] = defaultdict(list)
     for q in questions:
-        age_months = _parse_age_months(q["age"])
-        age_category = _get_child_term(age_months)
-        key = (q["domain"], age_category)
-        groups[key].append(q)
+        question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        record = records.get(question_id)
+        if question_id in stale or record is None or not record["source"]:
+            continue
+        source_id = record["source"].replace(".png", "")
+        if source_id in stale:
+            stale[question_id] = f"source {source_id} is stale"
+        elif record["kind"] == "cluster_copy" and canonical_map.get(
+            question_id, source_id
+        ) != source_id:
+            stale[question_id] = f"canonical is now {canonical_map[question_id]}"
 
-    logger.info(
-        f"Grouped {len(questions)} questions into {len(groups)} domain/age groups"
-    )
+    return stale
 
-    age_category_descriptions = {
-        "baby": "0-6 months",
-        "infant": "8-12 months",
-        "toddler": "14-24 months",
-        "preschooler": "27-60 months",
-        "child": "unspecified age",
-    }
 
-    all_clusters: list[dict] = []
-    cluster_counter = 0
+async def request_json_completion(
+    pool: EndpointPool,
+    config: dict,
+    system_text: str,
+    prompt_text: str,
+    max_tokens: int,
+    temperature: float,
+    label: str,
+    logger: logging.Logger,
+    attempts: int = 3,
+    kind: str = "prompt",
+) -> Optional[dict]:
+    """
+    Ask the prompt model for a JSON object, retrying unparseable replies.
 
-    for (domain, age_category), group_questions in sorted(groups.items()):
-        age_desc = age_category_descriptions.get(age_category, age_category)
-        logger.info(
-            f"  Clustering {len(group_questions)} questions for "
-            f"{domain} / {age_category} ({age_desc})"
-        )
-
-        question_lines = []
-        question_id_map: dict[str, dict] = {}
-        for i, q in enumerate(group_questions, 1):
-            qid = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
-            question_lines.append(f"{i}. [{qid}] {q['question_text']}")
-            question_id_map[qid] = q
-
-        questions_text = "\n".join(question_lines)
-
-        prompt_text = (
-            "You are clustering ASQ-3 developmental screening questions for image generation.\n"
-            "Questions that describe the same visual scene/activity should share one image.\n\n"
-            f"Domain: {domain}\n"
-            f"Age Category: {age_category} ({age_desc})\n\n"
-            f"Questions:\n{questions_text}\n\n"
-            "Group these questions into clusters where each cluster will share one illustration.\n"
-            "Questions that are unique should be in their own single-question cluster.\n"
-            "Return ONLY valid JSON (no markdown, no explanation):\n"
-            '{"clusters": [{"canonical_id": "question_id_here", '
-            '"question_ids": ["id1", "id2"], '
-            '"reason": "Brief reason why these share an image"}]}'
-        )
-
-        parsed_response = None
-        for attempt in range(3):
-            try:
-                response = client.chat.completions.create(
+    Markdown code fences around the JSON are stripped before parsing. API
+    errors are not retried here: pool.call() has already retried transient
+    failures under the pool's retry policy when it raises.
+
+    Args:
+        pool: Endpoint pool the request is routed through
+        config: Configuration dictionary
+        system_text: System message
+        prompt_text: User message
+        max_tokens: Completion token limit
+        temperature: Sampling temperature
+        label: Short description used in log messages
+        logger: Logger instance
+        attempts: Number of requests before giving up on unparseable replies
+        kind: Metrics label for the call
+
+    Returns:
+        Parsed JSON object, or None if the call failed or no reply could be parsed
+    """
+    for attempt in range(attempts):
+        try:
+            response = await pool.call(
+                config["prompt_model"],
+                _estimate_tokens(system_text + prompt_text, max_tokens),
+                lambda client: client.chat.completions.with_raw_response.create(
                     model=config["prompt_model"],
                     messages=[
-                        {
-                            "role": "system",
-                            "content": (
-                                "You are an expert at analyzing child development screening questions. "
-                                "Return ONLY valid JSON, no markdown fences, no explanation."
-                            ),
-                        },
+                        {"role": "system", "content": system_text},
                         {"role": "user", "content": prompt_text},
                     ],
-                    max_tokens=4096,
-                    temperature=0.3,
-                )
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                ),
+                config.get("prompt_timeout"),
+                kind,
+            )
+        except Exception as e:
+            logger.warning(f"    [{label}] API error: {e}")
+            return None
 
-                content = response.choices[0].message.content
-                if content is None:
-                    raise ValueError("Empty response from API")
+        try:
+            content = response.choices[0].message.content
+            if content is None:
+                raise ValueError("Empty response from API")
+
+            content = content.strip()
+            if content.startswith("```"):
+                content = re.sub(r"^```(?:json)?\s*", "", content)
+                content = re.sub(r"\s*```$", "", content)
+
+            parsed = json.loads(content)
+            if not isinstance(parsed, dict):
+                raise ValueError("Response is not a JSON object")
+            return parsed
+        except (json.JSONDecodeError, ValueError, KeyError) as e:
+            logger.warning(
+                f"    [{label}] Attempt {attempt + 1}/{attempts} failed to parse response: {e}"
+            )
 
-                content = content.strip()
-                if content.startswith("```"):
-                    content = re.sub(r"^```(?:json)?\s*", "", content)
-                    content = re.sub(r"\s*```$", "", content)
+    return None
 
-                parsed_response = json.loads(content)
-                break
 
-            except (json.JSONDecodeError, ValueError, KeyError) as e:
-                delay = 2 ** (attempt + 1)
-                logger.warning(
-                    f"    Attempt {attempt + 1}/3 failed to parse clustering response: {e}. "
-                    f"Retrying in {delay}s..."
-                )
-                time.sleep(delay)
-            except Exception as e:
-                delay = 2 ** (attempt + 1)
-                logger.warning(
-                    f"    Attempt {attempt + 1}/3 API error: {e}. "
-                    f"Retrying in {delay}s..."
-                )
-                time.sleep(delay)
+async def generate_prompt(
+    pool: EndpointPool,
+    question_text: str,
+    age_interval: str,
+    domain: str,
+    config: dict,
+) -> str:
+    """
+    Use Claude to create an optimized image generation prompt.
 
-        if parsed_response is None or "clusters" not in parsed_response:
-            logger.warning(
-                f"    Failed to cluster {domain}/{age_category} after 3 attempts. "
-                f"Falling back to single-question clusters."
-            )
-            for q in group_questions:
-                qid = get_filename(q["age"], q["domain"], q["number"]).replace(
-                    ".png", ""
-                )
-                cluster_counter += 1
-                all_clusters.append(
-                    {
-                        "cluster_id": f"{domain.lower().replace(' ', '_')}_{age_category}_{cluster_counter}",
-                        "domain": domain,
-                        "age_category": age_category,
-                        "canonical_id": qid,
-                        "question_ids": [qid],
-                        "reason": "Fallback: single-question cluster",
-                    }
+    Args:
+        pool: Endpoint pool the request is routed through
+        question_text: The ASQ-3 question text
+        age_interval: Age range string (e.g. '2 Bulan')
+        domain: Domain name in Indonesian
+        config: Configuration dictionary
+
+    Returns:
+        Optimized prompt string for image generation
+    """
+    age_months = _parse_age_months(age_interval)
+    system_prompt = PROMPT_SYSTEM_TEMPLATE.format(
+        child_term=_get_child_term(age_months),
+        age_months=age_months,
+        domain_en=DOMAIN_MAP.get(domain, domain),
+    )
+
+    user_prompt = f"Create an image prompt for this ASQ-3 question ({age_interval}, {domain}): {question_text}"
+
+    response = await pool.call(
+        config["prompt_model"],
+        _estimate_tokens(system_prompt + user_prompt, 300),
+        lambda client: client.chat.completions.with_raw_response.create(
+            model=config["prompt_model"],
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            max_tokens=300,
+            temperature=0.7,
+        ),
+        config.get("prompt_timeout"),
+        "prompt",
+    )
+
+    content = response.choices[0].message.content
+    return content.strip() if content else ""
+
+
+async def generate_prompts_batch(
+    pool: EndpointPool,
+    questions: list[dict],
+    config: dict,
+    logger: logging.Logger,
+) -> dict[str, str]:
+    """
+    Create image prompts for several questions in one chat completion.
+
+    The shared system prompt is sent once per batch instead of once per
+    question. Entries that are missing or not a non-empty string are left
+    out, so callers can fall back to generate_prompt() for just those.
+
+    Args:
+        pool: Endpoint pool the request is routed through
+        questions: Questions to prompt for, typically one domain/age group
+        config: Configuration dictionary
+        logger: Logger instance
+
+    Returns:
+        Dictionary mapping question_id to image prompt
+    """
+    question_ids = []
+    question_lines = []
+    for i, q in enumerate(questions, 1):
+        qid = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        question_ids.append(qid)
+        age_months = _parse_age_months(q["age"])
+        question_lines.append(
+            f"{i}. [{qid}] ({q['age']}, {q['domain']}; a {_get_child_term(age_months)} "
+            f"around {age_months} months old; {DOMAIN_MAP.get(q['domain'], q['domain'])}) "
+            f"{q['question_text']}"
+        )
+
+    prompt_text = (
+        "Create an image prompt for each of these ASQ-3 questions:\n"
+        + "\n".join(question_lines)
+        + "\n\nReturn ONLY valid JSON mapping every question_id to its image prompt:\n"
+        '{"prompts": {"question_id": "image prompt"}}'
+    )
+
+    parsed = await request_json_completion(
+        pool,
+        config,
+        PROMPT_BATCH_SYSTEM_TEMPLATE,
+        prompt_text,
+        min(300 * len(questions) + 200, 16000),
+        0.7,
+        f"prompt batch {question_ids[0]} +{len(question_ids) - 1}",
+        logger,
+        kind="prompt_batch",
+    )
+    prompts = (parsed or {}).get("prompts")
+    if not isinstance(prompts, dict):
+        return {}
+
+    return {
+        qid: prompts[qid].strip()
+        for qid in question_ids
+        if isinstance(prompts.get(qid), str) and prompts[qid].strip()
+    }
+
+
+async def generate_image(
+    pool: EndpointPool,
+    prompt: str,
+    config: dict,
+    tier: str = "hd",
+) -> str:
+    """
+    Generate an image using the image generation API.
+
+    Args:
+        pool: Endpoint pool the request is routed through
+        prompt: Image generation prompt
+        config: Configuration dictionary (image_response_format selects
+            'b64_json' or 'url')
+        tier: 'hd' for final images, 'draft' for the cheaper draft
+            size and quality
+
+    Returns:
+        Base64-encoded image data, or the image URL when
+        image_response_format is 'url'
+    """
+    response_format = config.get("image_response_format", "b64_json")
+    if tier == "draft":
+        size, quality = config["draft_image_size"], config["draft_image_quality"]
+    else:
+        size, quality = config["image_size"], config["image_quality"]
+    response = await pool.call(
+        config["image_model"],
+        _estimate_tokens(prompt),
+        lambda client: client.images.with_raw_response.generate(
+            model=config["image_model"],
+            prompt=prompt,
+            size=size,
+            quality=quality,
+            n=1,
+            response_format=response_format,
+        ),
+        config.get("image_timeout"),
+        "image",
+    )
+
+    data = response.data
+    if not data:
+        raise RuntimeError("Image API returned no data")
+    if response_format == "url":
+        url = data[0].url
+        if url is None:
+            raise RuntimeError("Image API returned no url data")
+        return url
+    b64 = data[0].b64_json
+    if b64 is None:
+        raise RuntimeError("Image API returned no b64_json data")
+    return b64
+
+
+# Latencies observed before hedging starts, so the percentile is meaningful.
+HEDGE_MIN_SAMPLES = 20
+
+
+class ImageHedger:
+    """
+    Hedge slow generate_image() calls with a duplicate request.
+
+    Once a request has been running longer than the given percentile of
+    recently observed latencies, a second identical request is sent. The
+    first one to return a valid image wins and the other is cancelled.
+    At most max_rate of all requests are hedged, because a cancelled
+    request may still be billed.
+
+    Each request contributes the primary's elapsed time, including when the
+    hedge wins. Sampling only winners would drop the slow tail and pull the
+    threshold down with every hedge.
+    """
+
+    def __init__(self, percentile: float, max_rate: float, window: int = 500) -> None:
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.latencies: deque[float] = deque(maxlen=window)
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.capped = 0
+
+    def threshold(self) -> Optional[float]:
+        """Current hedging delay in seconds, or None until enough samples exist."""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    async def generate(
+        self, pool: EndpointPool, prompt: str, config: dict, tier: str = "hd"
+    ) -> str:
+        """
+        Generate an image, hedging the request if it runs long.
+
+        The hedge is routed like any call, so it may go to another endpoint.
+
+        Args:
+            pool: Endpoint pool the requests are routed through
+            prompt: Image generation prompt
+            config: Configuration dictionary
+            tier: Image tier passed to generate_image()
+
+        Returns:
+            Image data as returned by generate_image()
+        """
+        self.requests += 1
+        delay = self.threshold()
+
+        def launch() -> asyncio.Task:
+            return asyncio.ensure_future(generate_image(pool, prompt, config, tier))
+
+        started = time.monotonic()
+        primary = launch()
+        pending = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    if self.hedged < self.max_rate * self.requests:
+                        self.hedged += 1
+                        pending.add(launch())
+                    else:
+                        self.capped += 1
+
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
                 )
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    # A cancelled primary took at least this long
+                    self.latencies.append(time.monotonic() - started)
+                    if task is not primary:
+                        self.hedge_wins += 1
+                    return task.result()
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def summary(self) -> str:
+        """One-line description of hedging activity."""
+        threshold = self.threshold()
+        current = f"{threshold:.1f}s" if threshold is not None else "not reached"
+        return (
+            f"p{self.percentile:g} threshold {current}, {self.hedged} of "
+            f"{self.requests} requests hedged (cap {self.max_rate:.0%}), "
+            f"{self.hedge_wins} won by the hedge, {self.capped} not hedged due to cap"
+        )
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Base64 characters decoded per step (a multiple of 4, ~768 KiB decoded).
+B64_CHUNK_CHARS = 1024 * 1024
+
+
+def _iter_b64_chunks(image_data: str) -> Iterator[bytes]:
+    """
+    Decode base64 data in bounded chunks instead of all at once.
+
+    Whitespace is skipped and chunk boundaries are kept on 4-character
+    quantums, so the output is identical to base64.b64decode(image_data).
+
+    Args:
+        image_data: Base64-encoded image data
+
+    Yields:
+        Decoded byte chunks
+    """
+    pending = ""
+    for start in range(0, len(image_data), B64_CHUNK_CHARS):
+        chunk = pending + "".join(image_data[start : start + B64_CHUNK_CHARS].split())
+        usable = len(chunk) - len(chunk) % 4
+        pending = chunk[usable:]
+        if usable:
+            yield base64.b64decode(chunk[:usable], validate=True)
+    if pending:
+        raise ValueError("Truncated base64 image data")
+
+
+class PngStreamValidator:
+    """
+    Incremental PNG header check for streamed image data.
+
+    Verifies the signature and the IHDR chunk (length, type, non-zero
+    dimensions and CRC) from the first 33 bytes as they arrive. Data without
+    a PNG signature is accepted with a warning, as before; data that claims
+    to be PNG but has a corrupt IHDR is rejected.
+    """
+
+    HEADER_SIZE = 33
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.head = b""
+        self.checked = False
+        self.is_png = False
+
+    def feed(self, chunk: bytes) -> None:
+        """Inspect the next chunk; raises ValueError on a corrupt PNG header."""
+        if self.checked:
+            return
+        self.head += chunk[: self.HEADER_SIZE - len(self.head)]
+        if len(self.head) >= len(PNG_SIGNATURE) and not self.head.startswith(PNG_SIGNATURE):
+            logging.getLogger(__name__).warning(
+                f"Image data for {self.filename} does not have PNG header, saving anyway"
+            )
+            self.checked = True
+            return
+        if len(self.head) < self.HEADER_SIZE:
+            return
+
+        length, chunk_type = struct.unpack(">I4s", self.head[8:16])
+        width, height = struct.unpack(">II", self.head[16:24])
+        (crc,) = struct.unpack(">I", self.head[29:33])
+        if length != 13 or chunk_type != b"IHDR":
+            raise ValueError("PNG data is missing the IHDR chunk")
+        if width == 0 or height == 0:
+            raise ValueError(f"PNG has invalid dimensions {width}x{height}")
+        if zlib.crc32(self.head[12:29]) & 0xFFFFFFFF != crc:
+            raise ValueError("PNG IHDR chunk failed CRC check")
+
+        self.checked = True
+        self.is_png = True
+
+    def finish(self) -> None:
+        """Raise if the stream ended before the header could be checked."""
+        if not self.checked:
+            raise ValueError(f"Image data too short ({len(self.head)} bytes)")
+
+
+def _fsync_dir(directory: str) -> None:
+    """Flush a directory entry so a completed rename survives a crash."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Generated images are stored once under OBJECTS_DIRNAME, named by the
+# SHA-256 of their bytes. Question IDs resolve to objects through the state
+# store and manifest.json; <question_id>.png files are optional aliases.
+OBJECTS_DIRNAME = "objects"
+
+MANIFEST_FILENAME = "manifest.json"
+
+# Version 2 entries carry age_months, domain_code and question_number.
+MANIFEST_VERSION = 2
+
+# Minimum seconds between manifest rewrites while the engine is running.
+MANIFEST_REFRESH_SECONDS = 30.0
+
+LINK_MODES = ("hardlink", "symlink", "copy", "none")
+
+
+class ImageObjectWriter:
+    """
+    Atomically store image bytes, written chunk by chunk, as a content-addressed object.
+
+    Bytes go to a temporary file in the objects directory while the PNG
+    header is validated and the SHA-256 is computed. commit() renames the
+    fsynced file to objects/<sha256>.png; if that object already exists the
+    temporary file is discarded. Readers never see a truncated image.
+
+    Every method blocks on disk I/O; async callers run them in a thread.
+    """
+
+    def __init__(self, output_dir: str, label: str) -> None:
+        self.objects_dir = os.path.join(output_dir, OBJECTS_DIRNAME)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.validator = PngStreamValidator(label)
+        self.digest = hashlib.sha256()
+        fd, self.tmp_path = tempfile.mkstemp(
+            prefix=f".{label}.", suffix=".tmp", dir=self.objects_dir
+        )
+        self.file = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        """Validate, hash and write the next chunk; raises ValueError on a corrupt header."""
+        self.validator.feed(chunk)
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> tuple[str, int]:
+        """
+        Publish the object.
+
+        Returns:
+            Tuple of (object path relative to output_dir, number of bytes)
+
+        Raises:
+            ValueError: If the image data is corrupt or empty
+        """
+        self.validator.finish()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        object_name = f"{self.digest.hexdigest()}.png"
+        object_path = os.path.join(self.objects_dir, object_name)
+        if os.path.exists(object_path):
+            os.unlink(self.tmp_path)
         else:
-            for raw_cluster in parsed_response["clusters"]:
-                cluster_counter += 1
-                canonical_id = raw_cluster.get("canonical_id", "")
-                question_ids = raw_cluster.get("question_ids", [canonical_id])
-                reason = raw_cluster.get("reason", "")
-
-                valid_ids = [qid for qid in question_ids if qid in question_id_map]
-                if not valid_ids:
-                    logger.warning(
-                        f"    Skipping cluster with no valid question IDs: {question_ids}"
-                    )
-                    continue
+            os.chmod(self.tmp_path, 0o644)
+            os.replace(self.tmp_path, object_path)
+            _fsync_dir(self.objects_dir)
+        return f"{OBJECTS_DIRNAME}/{object_name}", self.size
 
-                if canonical_id not in question_id_map:
-                    canonical_id = valid_ids[0]
+    def abort(self) -> None:
+        """Discard the temporary file."""
+        self.file.close()
+        _discard_temp(self.tmp_path)
 
-                all_clusters.append(
-                    {
-                        "cluster_id": f"{domain.lower().replace(' ', '_')}_{age_category}_{cluster_counter}",
-                        "domain": domain,
-                        "age_category": age_category,
-                        "canonical_id": canonical_id,
-                        "question_ids": valid_ids,
-                        "reason": reason,
-                    }
+
+def write_image_object(chunks: Iterable[bytes], output_dir: str, label: str) -> tuple[str, int]:
+    """
+    Atomically store streamed image bytes as a content-addressed object.
+
+    Args:
+        chunks: Iterable of decoded image byte chunks
+        output_dir: Image output directory
+        label: Name used in log and error messages (usually the question filename)
+
+    Returns:
+        Tuple of (object path relative to output_dir, number of bytes)
+
+    Raises:
+        ValueError: If the image data is corrupt or empty
+    """
+    writer = ImageObjectWriter(output_dir, label)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def save_image(image_data: str, output_dir: str, filename: str) -> Optional[str]:
+    """
+    Decode base64 image data and store it as a content-addressed PNG object.
+
+    Decoding is streamed in chunks to an atomically renamed temporary file,
+    so the decoded image is never held in memory in full.
+
+    Args:
+        image_data: Base64-encoded image data (a data: URL is also accepted)
+        output_dir: Image output directory
+        filename: Question filename the image belongs to
+
+    Returns:
+        Object path relative to output_dir, or None if saving failed
+    """
+    try:
+        if image_data.startswith("data:"):
+            image_data = image_data.partition(",")[2]
+        object_path, _ = write_image_object(
+            _iter_b64_chunks(image_data), output_dir, filename
+        )
+        return object_path
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Failed to save image {filename}: {e}")
+        return None
+
+
+async def download_image(
+    url: str,
+    output_dir: str,
+    filename: str,
+    pool: EndpointPool,
+    io_pool: Optional[ThreadPoolExecutor] = None,
+) -> Optional[str]:
+    """
+    Stream an image URL (response_format="url") directly into the object store.
+
+    The download reuses the endpoint pool's HTTP connections, and transient
+    failures are retried under the pool's retry policy and counted in its
+    retries. Disk writes run in io_pool so the event loop never blocks.
+
+    Args:
+        url: Image URL returned by the image API (data: URLs are decoded)
+        output_dir: Image output directory
+        filename: Question filename the image belongs to
+        pool: Endpoint pool the image was generated through
+        io_pool: Executor for disk writes (None for the loop's default)
+
+    Returns:
+        Object path relative to output_dir, or None if saving failed
+    """
+    loop = asyncio.get_running_loop()
+    if url.startswith("data:"):
+        return await loop.run_in_executor(io_pool, save_image, url, output_dir, filename)
+
+    pool._ensure_clients()
+    policy = pool.retry_policy
+    for attempt in range(policy.max_retries + 1):
+        writer = None
+        try:
+            async with pool.http_client.stream(
+                "GET", url, timeout=120, follow_redirects=True
+            ) as response:
+                response.raise_for_status()
+                writer = await loop.run_in_executor(
+                    io_pool, ImageObjectWriter, output_dir, filename
                 )
+                async for chunk in response.aiter_bytes(65536):
+                    await loop.run_in_executor(io_pool, writer.write, chunk)
+                object_path, _ = await loop.run_in_executor(io_pool, writer.commit)
+            return object_path
+        except Exception as e:
+            if writer is not None:
+                await loop.run_in_executor(io_pool, writer.abort)
+            if classify_api_error(e) != "fatal" and attempt < policy.max_retries:
+                policy.retries += 1
+                await asyncio.sleep(policy.backoff(attempt + 1))
+                continue
+            logging.getLogger(__name__).error(f"Failed to download image {filename}: {e}")
+            return None
+    return None
 
-            logger.info(f"    Created {len(parsed_response['clusters'])} clusters")
 
-        time.sleep(1.5)
+def link_legacy_file(output_dir: str, object_path: str, filename: str, link_mode: str) -> None:
+    """
+    Expose an object under its legacy <question_id>.png name.
 
-    total_clustered_questions = sum(len(c["question_ids"]) for c in all_clusters)
+    The alias is created under a temporary name and renamed into place, so
+    an existing alias is replaced atomically. With link_mode 'none' any
+    existing alias is removed so it cannot go stale.
 
-    clusters_data = {
-        "version": 1,
-        "csv_hash": get_csv_hash(csv_path),
-        "created_at": datetime.now().isoformat(),
-        "total_questions": total_clustered_questions,
-        "total_clusters": len(all_clusters),
-        "clusters": all_clusters,
+    Args:
+        output_dir: Image output directory
+        object_path: Object path relative to output_dir
+        filename: Legacy filename (e.g. '2-bulan_komunikasi_1.png')
+        link_mode: One of LINK_MODES
+    """
+    target = os.path.join(output_dir, filename)
+    if link_mode == "none":
+        if os.path.lexists(target):
+            os.unlink(target)
+        return
+
+    source = os.path.join(output_dir, object_path)
+    tmp_path = os.path.join(
+        output_dir, f".{filename}.{os.getpid()}.{threading.get_ident()}.link"
+    )
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+
+    if link_mode == "symlink":
+        os.symlink(object_path, tmp_path)
+    elif link_mode == "hardlink":
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copy2(source, tmp_path)
+    else:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def _hash_file(path: str) -> str:
+    """Compute the SHA-256 of a file without loading it into memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy_atomic(source: str, target: str) -> None:
+    """Hard-link (or copy) source to target through a temporary name."""
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def adopt_legacy_images(
+    store: "StateStore", output_dir: str, link_mode: str, logger: logging.Logger
+) -> None:
+    """
+    Move images completed before the object store into objects/.
+
+    Each completed question without an object has its <question_id>.png
+    hashed and stored once under objects/, and the legacy file is replaced
+    by an alias according to link_mode. Identical legacy copies collapse to
+    a single object.
+
+    Args:
+        store: State store
+        output_dir: Image output directory
+        link_mode: One of LINK_MODES
+        logger: Logger instance
+    """
+    pending = store.completed_without_object()
+    if not pending:
+        return
+
+    objects_dir = os.path.join(output_dir, OBJECTS_DIRNAME)
+    os.makedirs(objects_dir, exist_ok=True)
+
+    adopted = 0
+    for question_id, filename in pending:
+        legacy_path = os.path.join(output_dir, filename)
+        if not os.path.isfile(legacy_path):
+            continue
+
+        object_name = f"{_hash_file(legacy_path)}.png"
+        object_path = os.path.join(objects_dir, object_name)
+        if not os.path.exists(object_path):
+            _link_or_copy_atomic(legacy_path, object_path)
+
+        relative = f"{OBJECTS_DIRNAME}/{object_name}"
+        link_legacy_file(output_dir, relative, filename, link_mode)
+        store.set_object(question_id, relative)
+        adopted += 1
+
+    logger.info(f"Moved {adopted} existing images into the content-addressed store")
+
+
+VARIANTS_DIRNAME = "variants"
+
+DEFAULT_VARIANT_SIZES = (256, 512, 1024)
+
+
+def parse_variant_sizes(value: str) -> list[int]:
+    """
+    Parse a comma-separated list of variant widths (e.g. '256,512,1024').
+
+    Raises:
+        argparse.ArgumentTypeError: If a width is not a positive integer
+    """
+    try:
+        sizes = sorted({int(part) for part in value.split(",") if part.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid variant sizes: {value}")
+    if not sizes or sizes[0] <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid variant sizes: {value}")
+    return sizes
+
+
+def variant_keys(sizes: list[int], formats: list[str]) -> list[str]:
+    """Return the variant keys ('webp-256', ..., 'png-master') for a variant spec."""
+    return [f"{fmt}-{size}" for fmt in formats for size in sizes] + ["png-master"]
+
+
+def _save_atomic(image, path: str, **save_kwargs) -> int:
+    """Save a Pillow image to a temp file and rename it into place."""
+    with _atomic_file(path, "wb") as f:
+        image.save(f, **save_kwargs)
+    return os.path.getsize(path)
+
+
+def render_variants(
+    output_dir: str, object_path: str, sizes: list[int], formats: list[str], keys: list[str]
+) -> list[dict]:
+    """
+    Render responsive variants of one image object (process pool worker).
+
+    Writes variants/<sha256>/<width>.<format> for each requested width (a
+    width above the source is rendered at the source width rather than
+    upscaled), plus a losslessly optimised master PNG that is only kept when
+    it is smaller than the original object.
+
+    Args:
+        output_dir: Image output directory
+        object_path: Source object path relative to output_dir
+        sizes: Target widths in pixels
+        formats: Target formats ('webp', 'avif')
+        keys: Variant keys still missing for this object
+
+    Returns:
+        List of variant records with key, path, width, format and bytes
+    """
+    from PIL import Image
+
+    source_hash = os.path.basename(object_path).split(".")[0]
+    target_dir = os.path.join(output_dir, VARIANTS_DIRNAME, source_hash)
+    os.makedirs(target_dir, exist_ok=True)
+    source_path = os.path.join(output_dir, object_path)
+
+    records = []
+    with Image.open(source_path) as source:
+        source.load()
+        has_alpha = source.mode in ("RGBA", "LA") or "transparency" in source.info
+        base = source.convert("RGBA" if has_alpha else "RGB")
+
+        for fmt in formats:
+            for size in sizes:
+                key = f"{fmt}-{size}"
+                if key not in keys:
+                    continue
+                width = min(size, base.width)
+                height = max(1, round(base.height * width / base.width))
+                resized = base if width == base.width else base.resize(
+                    (width, height), Image.Resampling.LANCZOS
+                )
+                relative = f"{VARIANTS_DIRNAME}/{source_hash}/{size}.{fmt}"
+                save_kwargs = (
+                    {"format": "WEBP", "quality": 82, "method": 6}
+                    if fmt == "webp"
+                    else {"format": "AVIF", "quality": 60}
+                )
+                size_bytes = _save_atomic(
+                    resized, os.path.join(output_dir, relative), **save_kwargs
+                )
+                records.append(
+                    {"key": key, "path": relative, "width": width, "format": fmt, "bytes": size_bytes}
+                )
+
+        if "png-master" in keys:
+            relative = f"{VARIANTS_DIRNAME}/{source_hash}/master.png"
+            master_path = os.path.join(output_dir, relative)
+            size_bytes = _save_atomic(source, master_path, format="PNG", optimize=True)
+            if size_bytes >= os.path.getsize(source_path):
+                os.unlink(master_path)
+                relative, size_bytes = object_path, os.path.getsize(source_path)
+            records.append(
+                {
+                    "key": "png-master",
+                    "path": relative,
+                    "width": base.width,
+                    "format": "png",
+                    "bytes": size_bytes,
+                }
+            )
+
+    return records
+
+
+def build_variants(
+    store: "StateStore",
+    output_dir: str,
+    sizes: list[int],
+    formats: list[str],
+    workers: Optional[int],
+    logger: logging.Logger,
+) -> dict[str, int]:
+    """
+    Render missing responsive variants for every stored image object.
+
+    Objects whose variants for the current spec are already recorded (and
+    still on disk) are skipped, so reruns only process new or changed
+    images. Rendering runs in a process pool to use all cores.
+
+    Args:
+        store: State store
+        output_dir: Image output directory
+        sizes: Target widths in pixels
+        formats: Target formats ('webp', optionally 'avif')
+        workers: Process pool size (None = CPU count)
+        logger: Logger instance
+
+    Returns:
+        Dictionary with rendered, skipped and failed object counts
+    """
+    keys = variant_keys(sizes, formats)
+    existing = store.variants_by_source()
+
+    todo: list[tuple[str, list[str]]] = []
+    skipped = 0
+    for object_path in store.distinct_objects():
+        source_hash = os.path.basename(object_path).split(".")[0]
+        recorded = existing.get(source_hash, {})
+        missing = [
+            key
+            for key in keys
+            if key not in recorded
+            or not os.path.exists(os.path.join(output_dir, recorded[key]["path"]))
+        ]
+        if missing:
+            todo.append((object_path, missing))
+        else:
+            skipped += 1
+
+    counts = {"rendered": 0, "skipped": skipped, "failed": 0}
+    if not todo:
+        logger.info(f"Variants up to date for {skipped} images")
+        return counts
+
+    logger.info(
+        f"Rendering variants ({', '.join(formats)} at {', '.join(map(str, sizes))}px) "
+        f"for {len(todo)} images, {skipped} up to date"
+    )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(render_variants, output_dir, object_path, sizes, formats, missing): object_path
+            for object_path, missing in todo
+        }
+        for future in as_completed(futures):
+            object_path = futures[future]
+            source_hash = os.path.basename(object_path).split(".")[0]
+            try:
+                records = future.result()
+            except Exception as e:
+                logger.error(f"  Failed to render variants for {object_path}: {e}")
+                counts["failed"] += 1
+                continue
+            store.record_variants(source_hash, records)
+            counts["rendered"] += 1
+
+    logger.info(
+        f"Variants: {counts['rendered']} rendered, {counts['skipped']} up to date, "
+        f"{counts['failed']} failed"
+    )
+    return counts
+
+
+def resolve_question_id(question_id: str) -> Optional[dict]:
+    """
+    Resolve a question ID to the columns that identify it in asq3_questions.
+
+    Args:
+        question_id: Filename stem from get_filename() (e.g. '2-bulan_motorik-kasar_1')
+
+    Returns:
+        Dictionary with age_months, domain_code and question_number, or None
+        if the ID does not follow the get_filename() pattern
+    """
+    parts = question_id.split("_")
+    if len(parts) != 3 or not parts[2].isdigit():
+        return None
+    age_slug, domain_slug, number = parts
+    domain_codes = {
+        get_filename("0", domain, "0").split("_")[1]: code
+        for domain, code in DOMAIN_CODES.items()
+    }
+    age_months = _parse_age_months(age_slug)
+    if domain_slug not in domain_codes or not age_months:
+        return None
+    return {
+        "age_months": age_months,
+        "domain_code": domain_codes[domain_slug],
+        "question_number": int(number),
     }
 
-    clusters_path = os.path.join(output_dir, "clusters.json")
-    save_clusters(clusters_path, clusters_data)
-    logger.info(
-        f"Clustering complete: {total_clustered_questions} questions -> "
-        f"{len(all_clusters)} clusters (saved to {clusters_path})"
+
+def write_manifest(store: "StateStore", output_dir: str) -> str:
+    """
+    Write manifest.json mapping every completed question to its image object.
+
+    Entries include the image tier ('draft' until --progressive upgrades it
+    to 'hd'), the responsive variant paths when variants have been
+    rendered, and the resolved age_months, domain_code and question_number
+    so asq3:sync-images can update the database with set-based queries.
+    The engine also rewrites it periodically during a run. The manifest is
+    what asq3:sync-images consumes; it is written to a temporary file and
+    renamed into place.
+
+    Args:
+        store: State store
+        output_dir: Image output directory
+
+    Returns:
+        Path of the written manifest
+    """
+    variants = store.variants_by_source()
+
+    entries = {}
+    for row in store.manifest_rows():
+        source_hash = os.path.basename(row["object"]).split(".")[0]
+        entry = {
+            "object": row["object"],
+            "sha256": source_hash,
+            "kind": row["kind"],
+            "source": row["source"],
+            "tier": row["tier"],
+        }
+        entry.update(resolve_question_id(row["question_id"]) or {})
+        if source_hash in variants:
+            entry["variants"] = {
+                key: record["path"] for key, record in sorted(variants[source_hash].items())
+            }
+        entries[row["question_id"]] = entry
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "generated_at": datetime.now().isoformat(),
+        "objects_dir": OBJECTS_DIRNAME,
+        "total_entries": len(entries),
+        "total_objects": len({e["object"] for e in entries.values()}),
+        "entries": entries,
+    }
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    _write_text_atomic(
+        manifest_path, json.dumps(manifest, indent=2, ensure_ascii=False), fsync=True
+    )
+    return manifest_path
+
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """
+    Load legacy checkpoint data from JSON file (imported by StateStore).
+
+    Args:
+        checkpoint_path: Path to checkpoint JSON file
+
+    Returns:
+        Checkpoint dictionary with 'completed' list and 'duplicates' dict
+    """
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"completed": [], "duplicates": {}, "hashes": {}}
+
+
+def load_errors(errors_path: str) -> dict:
+    """
+    Load legacy error log from JSON file (imported by StateStore).
+
+    Args:
+        errors_path: Path to errors JSON file
+
+    Returns:
+        Dictionary with 'errors' list
+    """
+    if os.path.exists(errors_path):
+        with open(errors_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"errors": []}
+
+
+def get_question_hash(question_text: str) -> str:
+    """
+    Compute MD5 hash of question text for deduplication.
+
+    Args:
+        question_text: The question text to hash
+
+    Returns:
+        Hex digest of the MD5 hash
+    """
+    return hashlib.md5(question_text.encode("utf-8")).hexdigest()
+
+
+def get_csv_hash(csv_path: str) -> str:
+    """
+    Compute MD5 hash of CSV file for staleness detection.
+
+    Args:
+        csv_path: Path to the CSV file
+
+    Returns:
+        Hex digest of the MD5 hash of the file contents
+    """
+    with open(csv_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def load_clusters(clusters_path: str) -> Optional[dict]:
+    """
+    Load clusters from JSON file if it exists.
+
+    Args:
+        clusters_path: Path to clusters JSON file
+
+    Returns:
+        Clusters dictionary or None if file does not exist
+    """
+    if os.path.exists(clusters_path):
+        with open(clusters_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+
+def save_clusters(clusters_path: str, clusters_data: dict) -> None:
+    """
+    Save a read-only snapshot of the clusters to a JSON file.
+
+    The state store is authoritative; the snapshot is for inspection only.
+    It is written to a temporary file and renamed into place, so a crash
+    never leaves a truncated clusters.json.
+
+    Args:
+        clusters_path: Path to clusters JSON file
+        clusters_data: Clusters dictionary to save
+    """
+    with _atomic_file(clusters_path) as f:
+        json.dump(clusters_data, f, indent=2, ensure_ascii=False)
+
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completed (
+    question_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    question_hash TEXT,
+    completed_at TEXT NOT NULL,
+    object TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_completed_source ON completed (source);
+CREATE TABLE IF NOT EXISTS hashes (
+    question_hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    object TEXT
+);
+CREATE TABLE IF NOT EXISTS errors (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    question_id TEXT NOT NULL,
+    error TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    resolved INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_errors_question ON errors (question_id, resolved);
+CREATE TABLE IF NOT EXISTS clusters (
+    cluster_id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    domain TEXT NOT NULL,
+    age_category TEXT NOT NULL,
+    canonical_id TEXT NOT NULL,
+    reason TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS cluster_members (
+    question_id TEXT PRIMARY KEY,
+    cluster_id TEXT NOT NULL REFERENCES clusters (cluster_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cluster_members_cluster ON cluster_members (cluster_id);
+CREATE TABLE IF NOT EXISTS cluster_groups (
+    group_key TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prompt_cache (
+    cache_key TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    template_version INTEGER NOT NULL,
+    prompt_model TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_prompt_cache_last_used ON prompt_cache (last_used_at);
+CREATE TABLE IF NOT EXISTS variants (
+    source_hash TEXT NOT NULL,
+    variant_key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    PRIMARY KEY (source_hash, variant_key)
+);
+"""
+
+
+class StateStore:
+    """
+    Transactional SQLite (WAL) store for generation state.
+
+    Holds completed questions, question-hash -> file mappings, duplicate and
+    cluster-copy links, the error log and the clusters as indexed tables.
+    Every completion is a single transaction, so a crash can never leave a
+    half-written state file behind. A process-wide lock serialises access to
+    the shared connection, and WAL plus a busy timeout lets several
+    processes write to the same database.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(STATE_SCHEMA)
+        self._ensure_column("completed", "object", "TEXT")
+        self._ensure_column("hashes", "object", "TEXT")
+        self._ensure_column("completed", "fingerprint", "TEXT")
+        self._ensure_column("completed", "tier", "TEXT NOT NULL DEFAULT 'hd'")
+
+    def _ensure_column(self, table: str, column: str, declaration: str) -> None:
+        """Add a column to a table created by an older version of the script."""
+        columns = {
+            row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")
+        }
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+    def close(self) -> None:
+        """Close the underlying connection."""
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block in one IMMEDIATE transaction, rolling back on error.
+
+        Usage:
+            with store.transaction() as conn:
+                conn.execute(...)
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """Read a metadata value."""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        """Write a metadata value."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def is_completed(self, question_id: str) -> bool:
+        """Return True if the question has a completed image."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM completed WHERE question_id = ?", (question_id,)
+            ).fetchone()
+        return row is not None
+
+    def hash_source(self, question_hash: str) -> Optional[tuple[str, str]]:
+        """
+        Return the image generated for a question-text hash, if any.
+
+        Returns:
+            Tuple of (source filename, object path) or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename, object FROM hashes "
+                "WHERE question_hash = ? AND object IS NOT NULL",
+                (question_hash,),
+            ).fetchone()
+        return (row["filename"], row["object"]) if row else None
+
+    def get_object(self, question_id: str) -> Optional[str]:
+        """Return the object path a completed question resolves to, if any."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT object FROM completed WHERE question_id = ?", (question_id,)
+            ).fetchone()
+        return row["object"] if row else None
+
+    def set_object(self, question_id: str, object_path: str) -> None:
+        """Point a completed question (and hashes generated by it) at an object."""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE completed SET object = ? WHERE question_id = ?",
+                (object_path, question_id),
+            )
+            conn.execute(
+                "UPDATE hashes SET object = ? "
+                "WHERE filename = (SELECT filename FROM completed WHERE question_id = ?)",
+                (object_path, question_id),
+            )
+
+    def completed_without_object(self) -> list[tuple[str, str]]:
+        """Return (question_id, filename) of completions predating the object store."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT question_id, filename FROM completed WHERE object IS NULL "
+                "ORDER BY kind != 'generated', question_id"
+            ).fetchall()
+        return [(row["question_id"], row["filename"]) for row in rows]
+
+    def completed_fingerprints(self) -> dict[str, sqlite3.Row]:
+        """Return {question_id: row} with kind, source and fingerprint of completions."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT question_id, kind, source, fingerprint FROM completed"
+            ).fetchall()
+        return {row["question_id"]: row for row in rows}
+
+    def backfill_fingerprints(self, fingerprints: dict[str, tuple[str, str]]) -> int:
+        """
+        Adopt current fingerprints for records completed before fingerprints existed.
+
+        A record is adopted only if its stored question hash matches the
+        current text (or was never recorded); edited questions stay unknown.
+
+        Args:
+            fingerprints: {question_id: (question_hash, fingerprint)}
+
+        Returns:
+            Number of records updated
+        """
+        with self.transaction() as conn:
+            return sum(
+                conn.execute(
+                    "UPDATE completed SET fingerprint = ? "
+                    "WHERE question_id = ? AND fingerprint IS NULL "
+                    "AND (question_hash IS NULL OR question_hash = ?)",
+                    (fingerprint, question_id, question_hash),
+                ).rowcount
+                for question_id, (question_hash, fingerprint) in fingerprints.items()
+            )
+
+    def manifest_rows(self) -> list[sqlite3.Row]:
+        """Return completed questions that resolve to an object, ordered by ID."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT question_id, object, kind, source, tier FROM completed "
+                "WHERE object IS NOT NULL ORDER BY question_id"
+            ).fetchall()
+
+    def distinct_objects(self) -> list[str]:
+        """Return every object path referenced by a completed question."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT object FROM completed WHERE object IS NOT NULL ORDER BY object"
+            ).fetchall()
+        return [row["object"] for row in rows]
+
+    def variants_by_source(self) -> dict[str, dict[str, dict]]:
+        """Return recorded variants as {source_hash: {variant_key: record}}."""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM variants").fetchall()
+        variants: dict[str, dict[str, dict]] = {}
+        for row in rows:
+            variants.setdefault(row["source_hash"], {})[row["variant_key"]] = dict(row)
+        return variants
+
+    def record_variants(self, source_hash: str, records: list[dict]) -> None:
+        """Record rendered variants of one source object in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO variants "
+                "(source_hash, variant_key, path, width, format, bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (source_hash, r["key"], r["path"], r["width"], r["format"], r["bytes"])
+                    for r in records
+                ],
+            )
+
+    def mark_generated(
+        self,
+        question_id: str,
+        filename: str,
+        question_hash: str,
+        object_path: str,
+        fingerprint: Optional[str] = None,
+        tier: str = "hd",
+    ) -> None:
+        """
+        Record a freshly generated image in one transaction.
+
+        Args:
+            question_id: Question identifier (filename stem)
+            filename: Legacy image filename
+            question_hash: Hash of the question text
+            object_path: Content-addressed object path relative to the output dir
+            fingerprint: Input fingerprint from get_input_fingerprint()
+            tier: 'hd' or 'draft'
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completed "
+                "(question_id, filename, kind, source, question_hash, completed_at, "
+                "object, fingerprint, tier) "
+                "VALUES (?, ?, 'generated', NULL, ?, ?, ?, ?, ?)",
+                (question_id, filename, question_hash, now, object_path, fingerprint, tier),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO hashes (question_hash, filename, object) "
+                "VALUES (?, ?, ?)",
+                (question_hash, filename, object_path),
+            )
+            conn.execute(
+                "UPDATE errors SET resolved = 1 WHERE question_id = ? AND resolved = 0",
+                (question_id,),
+            )
+
+    def mark_copy(
+        self,
+        question_id: str,
+        filename: str,
+        kind: str,
+        source: str,
+        question_hash: str,
+        object_path: str,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        """
+        Record a question fulfilled by aliasing another question's image.
+
+        Args:
+            question_id: Question identifier (filename stem)
+            filename: Legacy image filename
+            kind: 'cluster_copy' (source is a canonical question ID) or
+                'duplicate' (source is the existing filename)
+            source: Where the image was aliased from
+            question_hash: Hash of the question text
+            object_path: Shared object path relative to the output dir
+            fingerprint: Input fingerprint from get_input_fingerprint()
+
+        The copy inherits the tier of the image it aliases.
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completed "
+                "(question_id, filename, kind, source, question_hash, completed_at, "
+                "object, fingerprint, tier) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE("
+                "(SELECT tier FROM completed WHERE object = ? AND kind = 'generated' "
+                "LIMIT 1), 'hd'))",
+                (
+                    question_id,
+                    filename,
+                    kind,
+                    source,
+                    question_hash,
+                    now,
+                    object_path,
+                    fingerprint,
+                    object_path,
+                ),
+            )
+            conn.execute(
+                "UPDATE errors SET resolved = 1 WHERE question_id = ? AND resolved = 0",
+                (question_id,),
+            )
+
+    def draft_ids(self) -> set[str]:
+        """Return IDs of generated questions whose image is still a draft."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT question_id FROM completed WHERE kind = 'generated' AND tier = 'draft'"
+            ).fetchall()
+        return {row["question_id"] for row in rows}
+
+    def upgrade_object(
+        self, question_id: str, old_object: Optional[str], new_object: str
+    ) -> list[str]:
+        """
+        Replace a draft with its HD image in one transaction.
+
+        The upgraded question and every copy or duplicate that aliased the
+        draft object are re-pointed at the new object and marked 'hd'.
+
+        Args:
+            question_id: Question whose draft was re-rendered
+            old_object: Draft object path (None if unknown)
+            new_object: HD object path
+
+        Returns:
+            Legacy filenames whose aliases must be relinked
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE completed SET object = ?, tier = 'hd', completed_at = ? "
+                "WHERE question_id = ? OR (object = ? AND object IS NOT NULL)",
+                (new_object, now, question_id, old_object),
+            )
+            conn.execute(
+                "UPDATE hashes SET object = ? WHERE object = ?", (new_object, old_object)
+            )
+            conn.execute(
+                "UPDATE errors SET resolved = 1 WHERE question_id = ? AND resolved = 0",
+                (question_id,),
+            )
+            rows = conn.execute(
+                "SELECT filename FROM completed WHERE object = ?", (new_object,)
+            ).fetchall()
+        return [row["filename"] for row in rows]
+
+    def record_error(self, question_id: str, error_message: str) -> None:
+        """Append an error entry for a question."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO errors (question_id, error, timestamp) VALUES (?, ?, ?)",
+                (question_id, error_message, datetime.now().isoformat()),
+            )
+
+    def failed_ids(self) -> set[str]:
+        """Return IDs with unresolved errors that are still not completed."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT e.question_id FROM errors e "
+                "LEFT JOIN completed c ON c.question_id = e.question_id "
+                "WHERE e.resolved = 0 AND c.question_id IS NULL"
+            ).fetchall()
+        return {row["question_id"] for row in rows}
+
+    def get_cached_prompt(self, cache_key: str, max_age_days: float) -> Optional[str]:
+        """
+        Look up a cached prompt and refresh its last-used time.
+
+        Args:
+            cache_key: Key from get_prompt_cache_key()
+            max_age_days: Entries older than this are treated as missing (0 = no limit)
+
+        Returns:
+            Cached prompt, or None on a miss
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT prompt, created_at FROM prompt_cache WHERE cache_key = ?",
+                (cache_key,),
+            ).fetchone()
+            if row is None:
+                return None
+            if max_age_days and row["created_at"] < now - max_age_days * 86400:
+                return None
+            conn.execute(
+                "UPDATE prompt_cache SET last_used_at = ? WHERE cache_key = ?",
+                (now, cache_key),
+            )
+        return row["prompt"]
+
+    def put_cached_prompt(self, cache_key: str, prompt: str, prompt_model: str) -> None:
+        """Store a generated prompt under its cache key."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO prompt_cache "
+                "(cache_key, prompt, template_version, prompt_model, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, prompt, PROMPT_TEMPLATE_VERSION, prompt_model, now, now),
+            )
+
+    def evict_prompt_cache(self, max_entries: int, max_age_days: float) -> int:
+        """
+        Drop expired prompt cache entries and trim to the least recently used limit.
+
+        Args:
+            max_entries: Maximum entries to keep (0 = no limit)
+            max_age_days: Maximum entry age in days (0 = no limit)
+
+        Returns:
+            Number of entries removed
+        """
+        removed = 0
+        with self.transaction() as conn:
+            if max_age_days:
+                cutoff = time.time() - max_age_days * 86400
+                removed += conn.execute(
+                    "DELETE FROM prompt_cache WHERE created_at < ?", (cutoff,)
+                ).rowcount
+            if max_entries:
+                removed += conn.execute(
+                    "DELETE FROM prompt_cache WHERE cache_key NOT IN ("
+                    "SELECT cache_key FROM prompt_cache ORDER BY last_used_at DESC LIMIT ?)",
+                    (max_entries,),
+                ).rowcount
+        return removed
+
+    def invalidate_prompt_cache(self, stale_only: bool) -> int:
+        """
+        Remove cached prompts.
+
+        Args:
+            stale_only: Only remove entries from other template versions
+
+        Returns:
+            Number of entries removed
+        """
+        with self.transaction() as conn:
+            if stale_only:
+                return conn.execute(
+                    "DELETE FROM prompt_cache WHERE template_version != ?",
+                    (PROMPT_TEMPLATE_VERSION,),
+                ).rowcount
+            return conn.execute("DELETE FROM prompt_cache").rowcount
+
+    def has_clusters(self) -> bool:
+        """Return True if clusters have been stored."""
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM clusters LIMIT 1").fetchone()
+        return row is not None
+
+    def save_clusters(self, clusters_data: dict) -> None:
+        """
+        Replace the stored clusters in one transaction.
+
+        Args:
+            clusters_data: Clusters dictionary as produced by cluster_questions()
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM cluster_members")
+            conn.execute("DELETE FROM clusters")
+            conn.execute("DELETE FROM cluster_groups")
+            conn.executemany(
+                "INSERT INTO cluster_groups (group_key, content_hash) VALUES (?, ?)",
+                sorted(clusters_data.get("group_hashes", {}).items()),
+            )
+            for position, cluster in enumerate(clusters_data.get("clusters", [])):
+                conn.execute(
+                    "INSERT INTO clusters "
+                    "(cluster_id, position, domain, age_category, canonical_id, reason) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        cluster["cluster_id"],
+                        position,
+                        cluster["domain"],
+                        cluster["age_category"],
+                        cluster["canonical_id"],
+                        cluster.get("reason", ""),
+                    ),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cluster_members "
+                    "(question_id, cluster_id, position) VALUES (?, ?, ?)",
+                    [
+                        (qid, cluster["cluster_id"], i)
+                        for i, qid in enumerate(cluster["question_ids"])
+                    ],
+                )
+            for key in ("version", "csv_hash", "created_at"):
+                if key in clusters_data:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        (f"clusters_{key}", str(clusters_data[key])),
+                    )
+
+    def load_clusters(self) -> Optional[dict]:
+        """
+        Load the stored clusters in the clusters.json structure.
+
+        Returns:
+            Clusters dictionary or None if no clusters are stored
+        """
+        with self.lock:
+            clusters = self.conn.execute(
+                "SELECT * FROM clusters ORDER BY position"
+            ).fetchall()
+            members = self.conn.execute(
+                "SELECT question_id, cluster_id FROM cluster_members "
+                "ORDER BY cluster_id, position"
+            ).fetchall()
+            group_hashes = dict(
+                self.conn.execute(
+                    "SELECT group_key, content_hash FROM cluster_groups"
+                ).fetchall()
+            )
+        if not clusters:
+            return None
+
+        member_ids: dict[str, list[str]] = {}
+        for row in members:
+            member_ids.setdefault(row["cluster_id"], []).append(row["question_id"])
+
+        all_clusters = [
+            {
+                "cluster_id": row["cluster_id"],
+                "domain": row["domain"],
+                "age_category": row["age_category"],
+                "canonical_id": row["canonical_id"],
+                "question_ids": member_ids.get(row["cluster_id"], []),
+                "reason": row["reason"],
+            }
+            for row in clusters
+        ]
+        version = self.get_meta("clusters_version")
+        return {
+            "version": int(version) if version else 1,
+            "csv_hash": self.get_meta("clusters_csv_hash") or "",
+            "created_at": self.get_meta("clusters_created_at") or "",
+            "total_questions": sum(len(c["question_ids"]) for c in all_clusters),
+            "total_clusters": len(all_clusters),
+            "group_hashes": group_hashes,
+            "clusters": all_clusters,
+        }
+
+    def merge_from(self, db_path: str) -> dict[str, int]:
+        """
+        Merge another state database (a shard) into this one.
+
+        Completions are upserted, keeping whichever record is newer; hash
+        mappings, variants and cached prompts are added; errors are appended
+        unless already present. Clusters are taken from the shard only if
+        this store has none. Merging the same shard twice is harmless.
+
+        Args:
+            db_path: Path to the shard's state.db
+
+        Returns:
+            Dictionary with the number of completed and error rows merged
+        """
+        # Opening the shard applies schema migrations before it is attached
+        shard = StateStore(db_path)
+        shard_clusters = shard.load_clusters()
+        shard.close()
+
+        with self.lock:
+            self.conn.execute("ATTACH DATABASE ? AS shard", (db_path,))
+            try:
+                with self.transaction() as conn:
+                    completed = conn.execute(
+                        "INSERT INTO completed (question_id, filename, kind, source, "
+                        "question_hash, completed_at, object, fingerprint, tier) "
+                        "SELECT question_id, filename, kind, source, question_hash, "
+                        "completed_at, object, fingerprint, tier FROM shard.completed "
+                        "WHERE true ON CONFLICT (question_id) DO UPDATE SET "
+                        "filename = excluded.filename, kind = excluded.kind, "
+                        "source = excluded.source, question_hash = excluded.question_hash, "
+                        "completed_at = excluded.completed_at, object = excluded.object, "
+                        "fingerprint = excluded.fingerprint, tier = excluded.tier "
+                        "WHERE excluded.completed_at > completed.completed_at"
+                    ).rowcount
+                    conn.execute(
+                        "INSERT OR REPLACE INTO hashes (question_hash, filename, object) "
+                        "SELECT question_hash, filename, object FROM shard.hashes"
+                    )
+                    errors = conn.execute(
+                        "INSERT INTO errors (question_id, error, timestamp, resolved) "
+                        "SELECT question_id, error, timestamp, resolved FROM shard.errors s "
+                        "WHERE NOT EXISTS (SELECT 1 FROM errors e WHERE "
+                        "e.question_id = s.question_id AND e.timestamp = s.timestamp "
+                        "AND e.error = s.error)"
+                    ).rowcount
+                    conn.execute(
+                        "INSERT OR IGNORE INTO variants "
+                        "(source_hash, variant_key, path, width, format, bytes) "
+                        "SELECT source_hash, variant_key, path, width, format, bytes "
+                        "FROM shard.variants"
+                    )
+                    conn.execute(
+                        "INSERT OR IGNORE INTO prompt_cache (cache_key, prompt, "
+                        "template_version, prompt_model, created_at, last_used_at) "
+                        "SELECT cache_key, prompt, template_version, prompt_model, "
+                        "created_at, last_used_at FROM shard.prompt_cache"
+                    )
+                    # Errors resolved by a completion in another shard
+                    conn.execute(
+                        "UPDATE errors SET resolved = 1 WHERE resolved = 0 AND "
+                        "question_id IN (SELECT question_id FROM completed)"
+                    )
+            finally:
+                self.conn.execute("DETACH DATABASE shard")
+
+        if shard_clusters and not self.has_clusters():
+            self.save_clusters(shard_clusters)
+
+        return {"completed": completed, "errors": errors}
+
+    def import_legacy_json(self, output_dir: str, logger: logging.Logger) -> None:
+        """
+        One-time import of checkpoint.json, errors.json and clusters.json.
+
+        The JSON files are left in place; a meta flag prevents re-importing.
+
+        Args:
+            output_dir: Directory containing the legacy JSON files
+            logger: Logger instance
+        """
+        if self.get_meta("legacy_json_imported"):
+            return
+
+        checkpoint_path = os.path.join(output_dir, "checkpoint.json")
+        errors_path = os.path.join(output_dir, "errors.json")
+        clusters_path = os.path.join(output_dir, "clusters.json")
+
+        checkpoint = load_checkpoint(checkpoint_path)
+        errors = load_errors(errors_path)
+        clusters_data = load_clusters(clusters_path)
+
+        hashes = checkpoint.get("hashes", {})
+        generated = {filename: qhash for qhash, filename in hashes.items()}
+        cluster_copies = checkpoint.get("cluster_copies", {})
+        duplicates = checkpoint.get("duplicates", {})
+        now = datetime.now().isoformat()
+
+        with self.transaction() as conn:
+            for question_id in dict.fromkeys(checkpoint.get("completed", [])):
+                filename = f"{question_id}.png"
+                if question_id in cluster_copies:
+                    kind, source = "cluster_copy", cluster_copies[question_id]
+                elif question_id in duplicates:
+                    kind, source = "duplicate", duplicates[question_id]
+                else:
+                    kind, source = "generated", None
+                conn.execute(
+                    "INSERT OR IGNORE INTO completed "
+                    "(question_id, filename, kind, source, question_hash, completed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (question_id, filename, kind, source, generated.get(filename), now),
+                )
+            conn.executemany(
+                "INSERT OR IGNORE INTO hashes (question_hash, filename) VALUES (?, ?)",
+                list(hashes.items()),
+            )
+            conn.executemany(
+                "INSERT INTO errors (question_id, error, timestamp) VALUES (?, ?, ?)",
+                [
+                    (e["question_id"], e.get("error", ""), e.get("timestamp", now))
+                    for e in errors.get("errors", [])
+                ],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', ?)",
+                (now,),
+            )
+
+        if clusters_data and not self.has_clusters():
+            self.save_clusters(clusters_data)
+
+        if checkpoint.get("completed") or errors.get("errors") or clusters_data:
+            logger.info(
+                f"Imported legacy state: {len(checkpoint.get('completed', []))} completed, "
+                f"{len(errors.get('errors', []))} errors, "
+                f"{clusters_data['total_clusters'] if clusters_data else 0} clusters"
+            )
+
+
+# Indonesian function words and ASQ-3 boilerplate ("Apakah bayi/anak Anda ...",
+# "Saat Anda ...") that carry no information about the depicted activity.
+CLUSTER_STOP_WORDS = frozenset(
+    """
+    apakah bayi anak anda ia dia nya saat ketika jika bila sebelum setelah sesudah
+    yang dan atau dengan di ke dari pada untuk dalam itu ini tersebut seperti
+    sekitar setidaknya paling sedikit sambil tanpa bukan tidak belum sudah akan
+    bisa dapat mampu mencoba boleh juga lagi masih hanya sendiri sendirinya
+    kepada oleh agar supaya karena sehingga misalnya contoh mis dll lain
+    """.split()
+)
+
+DEFAULT_MERGE_THRESHOLD = 0.8
+DEFAULT_AMBIGUOUS_THRESHOLD = 0.35
+
+
+def normalize_question_tokens(question_text: str) -> list[str]:
+    """
+    Normalise Indonesian question text into content tokens for similarity.
+
+    Lowercases, strips punctuation and digits, drops stop words, and reduces
+    the '-nya' possessive suffix so 'tangannya' and 'tangan' match.
+
+    Args:
+        question_text: Raw question text
+
+    Returns:
+        List of content tokens
+    """
+    tokens = []
+    for word in re.findall(r"[a-z]+", question_text.lower()):
+        if word.endswith("nya") and len(word) > 5:
+            word = word[:-3]
+        if word not in CLUSTER_STOP_WORDS and len(word) > 1:
+            tokens.append(word)
+    return tokens
+
+
+def tfidf_similarity(texts: list[str]) -> "np.ndarray":
+    """
+    Pairwise cosine similarity of TF-IDF vectors (unigrams + bigrams).
+
+    Args:
+        texts: Question texts
+
+    Returns:
+        (n, n) similarity matrix with ones on the diagonal
+    """
+    docs = []
+    for text in texts:
+        tokens = normalize_question_tokens(text)
+        docs.append(tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])])
+
+    vocabulary = {term: i for i, term in enumerate(sorted({t for d in docs for t in d}))}
+    n = len(docs)
+    if not vocabulary:
+        return np.eye(n)
+
+    counts = np.zeros((n, len(vocabulary)), dtype=np.float64)
+    for row, doc in enumerate(docs):
+        for term in doc:
+            counts[row, vocabulary[term]] += 1
+
+    tf = np.log1p(counts)
+    df = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + n) / (1 + df)) + 1
+    vectors = tf * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    similarity = vectors @ vectors.T
+    np.fill_diagonal(similarity, 1.0)
+    return similarity
+
+
+def precluster_group(
+    question_ids: list[str],
+    texts: list[str],
+    merge_threshold: float,
+    ambiguous_threshold: float,
+) -> tuple[list[dict], list[list[str]]]:
+    """
+    Decide clear merges and clear singletons locally, leaving the rest to the LLM.
+
+    Questions whose TF-IDF similarity is at least merge_threshold are merged
+    (transitively). A resulting component is settled when its similarity to
+    every other component is below ambiguous_threshold; otherwise it is
+    ambiguous and needs the model to decide.
+
+    Args:
+        question_ids: Question IDs in CSV order
+        texts: Question texts, aligned with question_ids
+        merge_threshold: Similarity at or above which questions are merged
+        ambiguous_threshold: Similarity below which questions are clearly distinct
+
+    Returns:
+        Tuple of:
+        - settled: raw clusters (canonical_id, question_ids, reason) decided locally
+        - ambiguous: components (lists of question IDs) that need the model
+    """
+    n = len(question_ids)
+    similarity = tfidf_similarity(texts)
+
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(*np.nonzero(np.triu(similarity >= merge_threshold, k=1))):
+        root_i, root_j = find(int(i)), find(int(j))
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    components: dict[int, list[int]] = {}
+    for i in range(n):
+        components.setdefault(find(i), []).append(i)
+
+    labels = np.array([find(i) for i in range(n)])
+    settled: list[dict] = []
+    ambiguous: list[list[str]] = []
+    for root in sorted(components):
+        members = components[root]
+        outside = labels != root
+        max_outside = float(similarity[members][:, outside].max()) if outside.any() else 0.0
+        ids = [question_ids[i] for i in members]
+
+        if max_outside >= ambiguous_threshold:
+            ambiguous.append(ids)
+        elif len(ids) > 1:
+            settled.append(
+                {
+                    "canonical_id": ids[0],
+                    "question_ids": ids,
+                    "reason": f"Local: lexical similarity >= {merge_threshold:.2f}",
+                }
+            )
+        else:
+            settled.append(
+                {
+                    "canonical_id": ids[0],
+                    "question_ids": ids,
+                    "reason": f"Local: unique (max similarity {max_outside:.2f})",
+                }
+            )
+
+    return settled, ambiguous
+
+
+def group_questions_for_clustering(
+    questions: list[dict],
+) -> dict[tuple[str, str], list[dict]]:
+    """
+    Group questions by (domain, age_category), keeping CSV order within a group.
+
+    Args:
+        questions: List of question dictionaries from load_questions()
+
+    Returns:
+        Dictionary mapping (domain, age_category) to its questions
+    """
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for q in questions:
+        age_category = _get_child_term(_parse_age_months(q["age"]))
+        groups.setdefault((q["domain"], age_category), []).append(q)
+    return groups
+
+
+def get_group_key(domain: str, age_category: str) -> str:
+    """Return the key a (domain, age_category) group hash is stored under."""
+    return f"{domain}/{age_category}"
+
+
+def get_group_hash(group_questions: list[dict]) -> str:
+    """
+    Compute a content hash of one clustering group.
+
+    Covers question IDs and texts in CSV order, so adding, removing, editing
+    or reordering a question in the group changes the hash.
+
+    Args:
+        group_questions: Questions in the group
+
+    Returns:
+        Hex digest of the SHA-256 hash
+    """
+    payload = [
+        [get_filename(q["age"], q["domain"], q["number"]), q["question_text"]]
+        for q in group_questions
+    ]
+    return hashlib.sha256(
+        json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def diff_cluster_groups(
+    questions: list[dict], clusters_data: dict
+) -> tuple[dict[str, str], list[str]]:
+    """
+    Compare the current questions with the group hashes stored with the clusters.
+
+    Clusters saved before group hashes existed have none; if the CSV hash
+    still matches they are taken as up to date, otherwise every group is
+    reported as changed.
+
+    Args:
+        questions: List of question dictionaries from load_questions()
+        clusters_data: Stored clusters dictionary
+
+    Returns:
+        Tuple of (current group hashes, sorted keys of added, edited or removed groups)
+    """
+    current = {
+        get_group_key(domain, age_category): get_group_hash(group_questions)
+        for (domain, age_category), group_questions in group_questions_for_clustering(
+            questions
+        ).items()
+    }
+    stored = clusters_data.get("group_hashes") or {}
+    if not stored:
+        if clusters_data.get("csv_hash") == get_csv_hash("asq3.csv"):
+            return current, []
+        return current, sorted(current)
+
+    changed = {key for key in current if stored.get(key) != current[key]}
+    changed.update(key for key in stored if key not in current)
+    return current, sorted(changed)
+
+
+AGE_CATEGORY_DESCRIPTIONS = {
+    "baby": "0-6 months",
+    "infant": "8-12 months",
+    "toddler": "14-24 months",
+    "preschooler": "27-60 months",
+    "child": "unspecified age",
+}
+
+
+async def _cluster_group(
+    domain: str,
+    age_category: str,
+    group_questions: list[dict],
+    pool: EndpointPool,
+    config: dict,
+    logger: logging.Logger,
+) -> Optional[dict]:
+    """
+    Ask the prompt model to cluster one (domain, age_category) group.
+
+    Args:
+        domain: Domain name in Indonesian
+        age_category: Child term from _get_child_term()
+        group_questions: Questions in the group
+        pool: Endpoint pool the request is routed through
+        config: Configuration dictionary
+        logger: Logger instance
+
+    Returns:
+        Parsed JSON response, or None if all attempts failed
+    """
+    age_desc = AGE_CATEGORY_DESCRIPTIONS.get(age_category, age_category)
+    label = f"{domain}/{age_category}"
+
+    question_lines = []
+    for i, q in enumerate(group_questions, 1):
+        qid = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        question_lines.append(f"{i}. [{qid}] {q['question_text']}")
+
+    questions_text = "\n".join(question_lines)
+
+    prompt_text = (
+        "You are clustering ASQ-3 developmental screening questions for image generation.\n"
+        "Questions that describe the same visual scene/activity should share one image.\n\n"
+        f"Domain: {domain}\n"
+        f"Age Category: {age_category} ({age_desc})\n\n"
+        f"Questions:\n{questions_text}\n\n"
+        "Group these questions into clusters where each cluster will share one illustration.\n"
+        "Questions that are unique should be in their own single-question cluster.\n"
+        "Return ONLY valid JSON (no markdown, no explanation):\n"
+        '{"clusters": [{"canonical_id": "question_id_here", '
+        '"question_ids": ["id1", "id2"], '
+        '"reason": "Brief reason why these share an image"}]}'
+    )
+
+    system_text = (
+        "You are an expert at analyzing child development screening questions. "
+        "Return ONLY valid JSON, no markdown fences, no explanation."
+    )
+
+    return await request_json_completion(
+        pool, config, system_text, prompt_text, 4096, 0.3, label, logger, kind="cluster"
+    )
+
+
+async def cluster_questions(
+    questions: list[dict],
+    pool: EndpointPool,
+    config: dict,
+    output_dir: str,
+    logger: logging.Logger,
+    store: StateStore,
+    workers: int = 4,
+    mode: str = "llm",
+    merge_threshold: float = DEFAULT_MERGE_THRESHOLD,
+    ambiguous_threshold: float = DEFAULT_AMBIGUOUS_THRESHOLD,
+    previous: Optional[dict] = None,
+) -> dict:
+    """
+    Cluster questions by semantic similarity using Claude Opus.
+
+    Groups questions by (domain, age_category) first, then uses Claude to
+    identify which questions within each group describe the same visual concept
+    and can share one illustration. Up to `workers` groups are clustered
+    concurrently; results are merged in sorted group order, so cluster_id
+    numbering does not depend on which request finishes first.
+
+    In 'hybrid' mode a local TF-IDF pass (precluster_group) first settles
+    clear merges and clear singletons, and only one representative per
+    ambiguous component is sent to the model. 'local' mode never calls the
+    API and keeps ambiguous components as separate clusters.
+
+    With `previous` clusters, only groups whose content hash changed are
+    re-clustered. Untouched groups keep their clusters and cluster_ids; new
+    clusters are numbered after the highest existing cluster number.
+
+    Args:
+        questions: List of question dictionaries from load_questions()
+        pool: Endpoint pool requests are routed through
+        config: Configuration dictionary
+        output_dir: Directory for output files (clusters.json snapshot saved here)
+        logger: Logger instance
+        store: State store the clusters are saved to
+        workers: Maximum number of groups clustered at once
+        mode: 'llm', 'hybrid' or 'local'
+        merge_threshold: Local similarity at or above which questions merge
+        ambiguous_threshold: Local similarity below which questions are distinct
+        previous: Stored clusters to update incrementally, or None to start over
+
+    Returns:
+        Clusters data dictionary with structure suitable for save_clusters()
+    """
+    csv_path = "asq3.csv"
+
+    groups = group_questions_for_clustering(questions)
+    group_hashes = {
+        get_group_key(domain, age_category): get_group_hash(group_questions)
+        for (domain, age_category), group_questions in groups.items()
+    }
+
+    kept: dict[tuple[str, str], list[dict]] = {}
+    cluster_counter = 0
+    if previous is not None:
+        stored_hashes = previous.get("group_hashes") or {}
+        for cluster in previous.get("clusters", []):
+            match = re.search(r"_(\d+)$", cluster["cluster_id"])
+            if match:
+                cluster_counter = max(cluster_counter, int(match.group(1)))
+            group = (cluster["domain"], cluster["age_category"])
+            key = get_group_key(*group)
+            if key in group_hashes and stored_hashes.get(key) == group_hashes[key]:
+                kept.setdefault(group, []).append(cluster)
+
+    changed_groups = {key: qs for key, qs in groups.items() if key not in kept}
+    logger.info(
+        f"Grouped {len(questions)} questions into {len(groups)} domain/age groups, "
+        f"re-clustering {len(changed_groups)} in {mode} mode, "
+        f"up to {max(1, workers)} groups at once"
+    )
+
+    semaphore = asyncio.Semaphore(max(1, workers))
+    started_at = time.monotonic()
+    llm_calls = 0
+
+    async def run_group(
+        domain: str, age_category: str, group_questions: list[dict]
+    ) -> list[dict]:
+        nonlocal llm_calls
+        question_id_map = {
+            get_filename(q["age"], q["domain"], q["number"]).replace(".png", ""): q
+            for q in group_questions
+        }
+
+        if mode == "llm":
+            settled: list[dict] = []
+            components = [[qid] for qid in question_id_map]
+        else:
+            settled, components = precluster_group(
+                list(question_id_map),
+                [q["question_text"] for q in question_id_map.values()],
+                merge_threshold,
+                ambiguous_threshold,
+            )
+
+        if mode == "local" or len(components) < 2:
+            return settled + [
+                {
+                    "canonical_id": ids[0],
+                    "question_ids": ids,
+                    "reason": "Local: lexical similarity" if len(ids) > 1 else "Local: unique",
+                }
+                for ids in components
+            ]
+
+        # One representative per component goes to the model; its answer
+        # is expanded back to the full components.
+        members = {ids[0]: ids for ids in components}
+        async with semaphore:
+            age_desc = AGE_CATEGORY_DESCRIPTIONS.get(age_category, age_category)
+            logger.info(
+                f"  Clustering {len(members)} of {len(question_id_map)} questions for "
+                f"{domain} / {age_category} ({age_desc})"
+            )
+            group_start = time.monotonic()
+            llm_calls += 1
+            parsed_response = await _cluster_group(
+                domain,
+                age_category,
+                [question_id_map[qid] for qid in members],
+                pool,
+                config,
+                logger,
+            )
+            elapsed = time.monotonic() - group_start
+
+        if parsed_response is None or "clusters" not in parsed_response:
+            logger.warning(
+                f"    Failed to cluster {domain}/{age_category} after 3 attempts. "
+                f"Falling back to single-question clusters."
+            )
+            return settled + [
+                {
+                    "canonical_id": ids[0],
+                    "question_ids": ids,
+                    "reason": "Fallback: single-question cluster",
+                }
+                for ids in components
+            ]
+
+        logger.info(
+            f"    {domain} / {age_category}: {len(parsed_response['clusters'])} clusters "
+            f"in {elapsed:.1f}s"
+        )
+
+        resolved: list[dict] = []
+        assigned: set[str] = set()
+        for raw_cluster in parsed_response["clusters"]:
+            canonical_id = raw_cluster.get("canonical_id", "")
+            question_ids = raw_cluster.get("question_ids", [canonical_id])
+            reason = raw_cluster.get("reason", "")
+
+            valid_ids = [
+                qid
+                for rep_id in question_ids
+                if rep_id in members and rep_id not in assigned
+                for qid in members[rep_id]
+            ]
+            if not valid_ids:
+                logger.warning(
+                    f"    Skipping cluster with no valid question IDs: {question_ids}"
+                )
+                continue
+            assigned.update(rep_id for rep_id in question_ids if rep_id in members)
+
+            # A canonical the model already placed in an earlier cluster
+            # would leave this one pointing outside itself
+            if canonical_id not in valid_ids:
+                canonical_id = valid_ids[0]
+
+            resolved.append(
+                {"canonical_id": canonical_id, "question_ids": valid_ids, "reason": reason}
+            )
+
+        # Components the model left out keep their own cluster
+        for rep_id, ids in members.items():
+            if rep_id not in assigned:
+                resolved.append(
+                    {
+                        "canonical_id": ids[0],
+                        "question_ids": ids,
+                        "reason": "Not clustered by model: own cluster",
+                    }
+                )
+
+        return settled + resolved
+
+    sorted_groups = sorted(changed_groups.items())
+    results = await asyncio.gather(
+        *(run_group(domain, age_category, qs) for (domain, age_category), qs in sorted_groups)
+    )
+    new_clusters = {
+        group: group_clusters
+        for (group, _), group_clusters in zip(sorted_groups, results)
+    }
+
+    all_clusters: list[dict] = []
+
+    for domain, age_category in sorted(groups):
+        if (domain, age_category) in kept:
+            all_clusters.extend(kept[(domain, age_category)])
+            continue
+        for raw_cluster in new_clusters[(domain, age_category)]:
+            cluster_counter += 1
+            all_clusters.append(
+                {
+                    "cluster_id": f"{domain.lower().replace(' ', '_')}_{age_category}_{cluster_counter}",
+                    "domain": domain,
+                    "age_category": age_category,
+                    **raw_cluster,
+                }
+            )
+
+    total_clustered_questions = sum(len(c["question_ids"]) for c in all_clusters)
+
+    clusters_data = {
+        "version": 1,
+        "csv_hash": get_csv_hash(csv_path),
+        "created_at": datetime.now().isoformat(),
+        "total_questions": total_clustered_questions,
+        "total_clusters": len(all_clusters),
+        "group_hashes": group_hashes,
+        "clusters": all_clusters,
+    }
+
+    store.save_clusters(clusters_data)
+    clusters_path = os.path.join(output_dir, "clusters.json")
+    save_clusters(clusters_path, clusters_data)
+    logger.info(
+        f"Clustering complete: {total_clustered_questions} questions -> "
+        f"{len(all_clusters)} clusters with {llm_calls} model calls in "
+        f"{time.monotonic() - started_at:.1f}s "
+        f"(saved to {store.db_path}, snapshot {clusters_path})"
+    )
+
+    return clusters_data
+
+
+def build_cluster_lookup(
+    clusters_data: Optional[dict],
+) -> tuple[dict[str, str], set[str]]:
+    """
+    Build lookup structures from clusters data.
+
+    Returns:
+        tuple of:
+        - canonical_map: {question_id: canonical_id} for all questions
+        - canonical_set: set of canonical question IDs
+    """
+    if clusters_data is None:
+        return {}, set()
+
+    canonical_map: dict[str, str] = {}
+    canonical_set: set[str] = set()
+
+    for cluster in clusters_data.get("clusters", []):
+        canonical_id = cluster["canonical_id"]
+        canonical_set.add(canonical_id)
+        for qid in cluster["question_ids"]:
+            canonical_map[qid] = canonical_id
+
+    return canonical_map, canonical_set
+
+
+def load_priority_weights(source: str, config: dict) -> dict[int, float]:
+    """
+    Load how much each age interval is screened.
+
+    Args:
+        source: 'db' to count non-cancelled asq3_screenings per age interval
+            in the Laravel database, or the path of a JSON object or a
+            two-column CSV mapping an age (months or an 'N Bulan' label)
+            to a weight
+        config: Configuration dictionary from get_config()
+
+    Returns:
+        Dictionary mapping age in months to a non-negative weight
+
+    Raises:
+        ValueError: If the weights file is malformed
+        RuntimeError: If the database cannot be opened
+    """
+    if source == "db":
+        conn, _ = connect_laravel_database(config)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT ai.age_months, COUNT(*) FROM asq3_screenings s "
+                "JOIN asq3_age_intervals ai ON ai.id = s.age_interval_id "
+                "WHERE s.status <> 'cancelled' GROUP BY ai.age_months"
+            )
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+    elif source.endswith(".json"):
+        with open(source, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"{source} must hold a JSON object of age -> weight")
+        rows = list(data.items())
+    else:
+        with open(source, "r", encoding="utf-8", newline="") as f:
+            rows = [row[:2] for row in csv.reader(f) if len(row) >= 2]
+        if rows and not re.search(r"\d", rows[0][0]):
+            rows = rows[1:]  # header
+
+    weights: dict[int, float] = {}
+    for age, weight in rows:
+        age_months = _parse_age_months(str(age))
+        try:
+            weights[age_months] = weights.get(age_months, 0.0) + max(0.0, float(weight))
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid weight for age {age}: {weight!r}") from None
+    return weights
+
+
+def prioritize_questions(
+    questions: list[dict],
+    weights: dict[int, float],
+    canonical_map: dict[str, str],
+    canonical_set: set[str],
+) -> list[dict]:
+    """
+    Order questions so the most-screened age intervals get images first.
+
+    A question's priority is the weight of its age interval. A cluster
+    canonical's priority is the total weight of every question in its
+    cluster, since its image is copied to all of them; ties put canonicals
+    ahead of the copies that wait for them, then keep CSV order.
+
+    Args:
+        questions: Questions to order
+        weights: Age in months -> weight from load_priority_weights()
+        canonical_map / canonical_set: Cluster lookups from build_cluster_lookup()
+
+    Returns:
+        The questions in priority order
+    """
+
+    def age_weight(question_id: str) -> float:
+        resolved = resolve_question_id(question_id)
+        return weights.get(resolved["age_months"], 0.0) if resolved else 0.0
+
+    unlocked: dict[str, float] = {}
+    for question_id, canonical_id in canonical_map.items():
+        unlocked[canonical_id] = unlocked.get(canonical_id, 0.0) + age_weight(question_id)
+
+    def sort_key(indexed: tuple[int, dict]) -> tuple[float, int, int]:
+        idx, q = indexed
+        question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        if question_id in canonical_set:
+            return (-unlocked.get(question_id, age_weight(question_id)), 0, idx)
+        return (-age_weight(question_id), 1, idx)
+
+    return [q for _, q in sorted(enumerate(questions), key=sort_key)]
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parse a --shard value like '2/4' (1-based index, shard count).
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is malformed or out of range
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 1/4")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard index must be between 1 and N")
+    return index, count
+
+
+def get_shard_keys(questions: list[dict], clusters_data: Optional[dict]) -> dict[str, str]:
+    """
+    Map every question to the key that decides which shard processes it.
+
+    Questions in the same cluster or with identical text are joined into
+    one component keyed by its smallest question ID, so a canonical image,
+    its cluster copies and its exact-text duplicates always share a shard.
+
+    Args:
+        questions: List of question dictionaries from load_questions()
+        clusters_data: Clusters dictionary, or None
+
+    Returns:
+        Dictionary mapping question_id to its shard key
+    """
+    parent: dict[str, str] = {}
+
+    def find(qid: str) -> str:
+        parent.setdefault(qid, qid)
+        while parent[qid] != qid:
+            parent[qid] = parent[parent[qid]]
+            qid = parent[qid]
+        return qid
+
+    def union(a: str, b: str) -> None:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    by_text: dict[str, str] = {}
+    for q in questions:
+        question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        find(question_id)
+        question_hash = get_question_hash(q["question_text"])
+        if question_hash in by_text:
+            union(by_text[question_hash], question_id)
+        else:
+            by_text[question_hash] = question_id
+
+    for cluster in (clusters_data or {}).get("clusters", []):
+        for qid in cluster["question_ids"]:
+            union(cluster["canonical_id"], qid)
+
+    return {qid: find(qid) for qid in list(parent)}
+
+
+def stable_shard(key: str, count: int) -> int:
+    """Return the 1-based shard for a key; independent of process and Python hash seed."""
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:16], 16) % count + 1
+
+
+def _copy_tree_missing(source_dir: str, target_dir: str) -> int:
+    """Hard-link (or copy) files from source_dir that target_dir lacks; return the count."""
+    copied = 0
+    for root, _, files in os.walk(source_dir):
+        relative = os.path.relpath(root, source_dir)
+        destination = os.path.normpath(os.path.join(target_dir, relative))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            target = os.path.join(destination, name)
+            if os.path.exists(target):
+                continue
+            _link_or_copy_atomic(os.path.join(root, name), target)
+            copied += 1
+    return copied
+
+
+def merge_shards(
+    shard_dirs: list[str],
+    output_dir: str,
+    store: "StateStore",
+    link_mode: str,
+    logger: logging.Logger,
+) -> None:
+    """
+    Combine the output directories of --shard runs into one output directory.
+
+    Objects and variants are content-addressed, so copying missing files is
+    enough; state is merged with StateStore.merge_from(). Legacy aliases and
+    manifest.json are then rebuilt from the merged state.
+
+    Args:
+        shard_dirs: Output directories of the shard runs
+        output_dir: Target output directory (asq3:sync-images reads this one)
+        store: State store of the target directory
+        link_mode: One of LINK_MODES for the rebuilt aliases
+        logger: Logger instance
+    """
+    for shard_dir in shard_dirs:
+        db_path = os.path.join(shard_dir, "state.db")
+        if not os.path.isfile(db_path):
+            logger.warning(f"Skipping {shard_dir}: no state.db")
+            continue
+        files = sum(
+            _copy_tree_missing(os.path.join(shard_dir, dirname), os.path.join(output_dir, dirname))
+            for dirname in (OBJECTS_DIRNAME, VARIANTS_DIRNAME)
+            if os.path.isdir(os.path.join(shard_dir, dirname))
+        )
+        merged = store.merge_from(db_path)
+        logger.info(
+            f"Merged {shard_dir}: {merged['completed']} completions, "
+            f"{merged['errors']} errors, {files} new files"
+        )
+
+    rows = store.manifest_rows()
+    for row in rows:
+        if os.path.exists(os.path.join(output_dir, row["object"])):
+            link_legacy_file(output_dir, row["object"], f"{row['question_id']}.png", link_mode)
+    clusters_data = store.load_clusters()
+    if clusters_data:
+        save_clusters(os.path.join(output_dir, "clusters.json"), clusters_data)
+    manifest_path = write_manifest(store, output_dir)
+    logger.info(f"Wrote merged manifest for {len(rows)} questions to {manifest_path}")
+
+
+class GenerationEngine:
+    """
+    Async pipelined engine that generates images for many questions at once.
+
+    Work flows through four stages connected by bounded queues:
+
+        resolve -> prompt (generate_prompt) -> image (generate_image) -> save (save_image)
+
+    Before dispatch the questions are ordered so every cluster canonical in
+    the run comes ahead of its members. Each cluster then has one root: its
+    canonical, or the first member when the canonical is not part of the
+    run and has no image yet. Members copy their cluster root's image; a
+    question with the same exact text as an earlier one copies it as a
+    duplicate. A question whose root is still in flight is parked off the
+    resolvers and re-enqueued when the root finishes, so waiting copies never
+    hold a resolver. If a root finishes without an image, the first member
+    to notice is promoted to root and renders the image the others then
+    copy, so each image is requested once even with many questions in
+    flight. Resolvers handle skips and copies; everything else moves on to
+    the prompt stage.
+
+    Each stage has its own worker count. The prompt->image queue lets the
+    text model run ahead of the image model by a bounded number of prompts,
+    and the image->save queue holds at most a few decoded responses, so a
+    slow image model backs pressure up the pipeline instead of growing memory.
+
+    Per-stage queue wait and handling time (which includes any time blocked
+    handing the item to the next stage) are recorded in the pool's metrics.
+
+    Images are rendered at the given tier. Questions in `upgrades` already
+    have a draft; they skip the resolve checks and their new HD image
+    replaces the draft for them and every copy of it.
+
+    Questions that fail are collected in `failed` with their error message.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        config: dict,
+        output_dir: str,
+        store: StateStore,
+        canonical_map: dict[str, str],
+        canonical_set: set[str],
+        logger: logging.Logger,
+        pool: EndpointPool,
+        stale: Optional[set[str]] = None,
+        tier: str = "hd",
+        upgrades: Optional[set[str]] = None,
+    ) -> None:
+        self.args = args
+        self.config = config
+        self.output_dir = output_dir
+        self.store = store
+        self.canonical_map = canonical_map
+        self.canonical_set = canonical_set
+        self.logger = logger
+        self.pool = pool
+        self.metrics = pool.metrics
+
+        self.concurrency = max(1, args.concurrency)
+        self.prompt_workers = max(1, args.prompt_workers or self.concurrency)
+        self.image_workers = max(1, args.image_workers or self.concurrency)
+        self.save_workers = max(1, args.save_workers)
+        self.prompt_lookahead = max(1, args.prompt_lookahead or 2 * self.image_workers)
+
+        self.io_pool: Optional[ThreadPoolExecutor] = None
+        self.stale = stale or set()
+        self.tier = tier
+        self.upgrades = upgrades or set()
+        self.prompt_batch_size = max(1, getattr(args, "prompt_batch_size", 1))
+        self.prompt_batches: dict[str, dict] = {}
+        hedge_percentile = getattr(args, "hedge_percentile", 0)
+        self.hedger = (
+            ImageHedger(hedge_percentile, args.hedge_max_rate)
+            if hedge_percentile > 0
+            else None
+        )
+        self.refreshed: set[str] = set()
+        self.failed: dict[str, str] = {}
+        self.manifest_written_at = time.monotonic()
+        self.roots: dict[str, tuple[str, asyncio.Future]] = {}
+        self.text_roots: dict[str, str] = {}
+        self.hash_tail: dict[str, asyncio.Future] = {}
+        self.resolve_queue: Optional[asyncio.Queue] = None
+        self.requeues: set[asyncio.Task] = set()
+        self.unresolved = 0
+        self.all_resolved = asyncio.Event()
+        self.counts = {
+            "success": 0,
+            "skip": 0,
+            "duplicate": 0,
+            "cluster_copy": 0,
+            "error": 0,
+            "prompt_cache_hit": 0,
+            "prompt_cache_miss": 0,
+            "prompt_batch_calls": 0,
+            "prompt_batch_hit": 0,
+            "prompt_batch_fallback": 0,
+            "promoted": 0,
+        }
+
+    async def run(self, questions: list[dict], close_pool: bool = True) -> dict[str, int]:
+        """
+        Process all questions and return the outcome counters.
+
+        Args:
+            questions: List of question dictionaries from load_questions()
+            close_pool: Close the endpoint pool's HTTP connections when done;
+                callers running several engines at once leave it open
+
+        Returns:
+            Dictionary with success, skip, duplicate, cluster_copy and error counts
+        """
+        questions = self._plan_dependencies(questions)
+        self.io_pool = ThreadPoolExecutor(
+            max_workers=self.save_workers + 2, thread_name_prefix="asq3-io"
+        )
+
+        resolve_queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        self.resolve_queue = resolve_queue
+        prompt_queue: asyncio.Queue = asyncio.Queue(maxsize=self.prompt_workers)
+        image_queue: asyncio.Queue = asyncio.Queue(maxsize=self.prompt_lookahead)
+        save_queue: asyncio.Queue = asyncio.Queue(maxsize=self.save_workers)
+
+        stages = [
+            (
+                "resolve",
+                resolve_queue,
+                self.concurrency,
+                lambda item: self._resolve_step(item, prompt_queue),
+            ),
+            (
+                "prompt",
+                prompt_queue,
+                self.prompt_workers,
+                lambda item: self._prompt(item, image_queue),
+            ),
+            ("image", image_queue, self.image_workers, lambda item: self._image(item, save_queue)),
+            ("save", save_queue, self.save_workers, self._save),
+        ]
+        stage_tasks = [
+            [
+                asyncio.create_task(self._stage_worker(stage, queue, handler))
+                for _ in range(workers)
+            ]
+            for stage, queue, workers, handler in stages
+        ]
+
+        self.logger.info(
+            f"Pipeline: {self.concurrency} resolvers, {self.prompt_workers} prompt workers, "
+            f"{self.image_workers} image workers, {self.save_workers} save workers, "
+            f"prompt lookahead {self.prompt_lookahead}"
+        )
+
+        try:
+            if not self.args.dry_run and self.prompt_batch_size > 1:
+                # Reads completion and prompt cache state for every question
+                await self._run_io(self._plan_prompt_batches, questions)
+
+            total = len(questions)
+            for idx, q in enumerate(questions, 1):
+                await self._enqueue(resolve_queue, await self._dispatch(idx, total, q))
+
+            # Parked questions re-enter the resolve stage when their root
+            # finishes, so it may only stop once every question has left it.
+            while self.unresolved:
+                self.all_resolved.clear()
+                await self.all_resolved.wait()
+
+            # Drain stage by stage: a stage only receives its stop sentinels
+            # once every upstream worker has exited.
+            for (_, queue, _, _), tasks in zip(stages, stage_tasks):
+                for _ in tasks:
+                    await queue.put(None)
+                await asyncio.gather(*tasks)
+        finally:
+            for task in [*self.requeues, *(t for tasks in stage_tasks for t in tasks)]:
+                task.cancel()
+            self.io_pool.shutdown(wait=True)
+            if close_pool:
+                await self.pool.close()
+
+        return self.counts
+
+    def _plan_dependencies(self, questions: list[dict]) -> list[dict]:
+        """
+        Order questions so each cluster canonical precedes its members.
+
+        A canonical is moved up to just before the first of its members;
+        everything else keeps its order (CSV or --priority-weights).
+        """
+        by_id = {
+            get_filename(q["age"], q["domain"], q["number"]).replace(".png", ""): q
+            for q in questions
+        }
+        ordered: list[dict] = []
+        placed: set[str] = set()
+        moved = 0
+        for question_id, q in by_id.items():
+            canonical_id = self.canonical_map.get(question_id)
+            if canonical_id in by_id and canonical_id not in placed:
+                placed.add(canonical_id)
+                ordered.append(by_id[canonical_id])
+                moved += canonical_id != question_id
+            if question_id not in placed:
+                placed.add(question_id)
+                ordered.append(q)
+        if moved:
+            self.logger.info(f"Moved {moved} cluster canonicals ahead of their members")
+        return ordered
+
+    def _plan_prompt_batches(self, questions: list[dict]) -> None:
+        """
+        Split the questions likely to need a new prompt into batches.
+
+        Candidates are questions that will not be skipped, are not expected
+        to copy from a cluster canonical and have no cached prompt. Batches
+        hold up to prompt_batch_size questions of one domain/age group in CSV
+        order; a batch is requested when its first member reaches the prompt
+        stage.
+        """
+        use_cache = not self.args.no_prompt_cache
+        groups: dict[tuple[str, str], list[dict]] = {}
+        for (domain, age_category), group_questions in group_questions_for_clustering(
+            questions
+        ).items():
+            for q in group_questions:
+                question_id = get_filename(q["age"], q["domain"], q["number"]).replace(
+                    ".png", ""
+                )
+                if (
+                    not self.args.force
+                    and question_id not in self.stale
+                    and self.store.is_completed(question_id)
+                ):
+                    continue
+                if question_id in self.canonical_map and question_id not in self.canonical_set:
+                    continue
+                if use_cache and self.store.get_cached_prompt(
+                    get_prompt_cache_key(q["question_text"], q["age"], q["domain"], self.config),
+                    self.config["prompt_cache_max_age_days"],
+                ):
+                    continue
+                groups.setdefault((domain, age_category), []).append(q)
+
+        batch_count = 0
+        for group_questions in groups.values():
+            for start in range(0, len(group_questions), self.prompt_batch_size):
+                members = group_questions[start : start + self.prompt_batch_size]
+                if len(members) < 2:
+                    continue
+                batch = {"questions": members, "task": None}
+                batch_count += 1
+                for q in members:
+                    question_id = get_filename(q["age"], q["domain"], q["number"]).replace(
+                        ".png", ""
+                    )
+                    self.prompt_batches[question_id] = batch
+
+        if batch_count:
+            self.logger.info(
+                f"Prompt batching: {len(self.prompt_batches)} questions in "
+                f"{batch_count} batches of up to {self.prompt_batch_size}"
+            )
+
+    async def _run_prompt_batch(self, batch: dict) -> dict[str, str]:
+        """Request one prompt batch and cache its results."""
+        self.counts["prompt_batch_calls"] += 1
+        try:
+            prompts = await generate_prompts_batch(
+                self.pool, batch["questions"], self.config, self.logger
+            )
+        except Exception as e:
+            self.logger.warning(f"  Prompt batch failed: {e}")
+            return {}
+
+        if not self.args.no_prompt_cache:
+            for q in batch["questions"]:
+                question_id = get_filename(q["age"], q["domain"], q["number"]).replace(
+                    ".png", ""
+                )
+                if question_id in prompts:
+                    await self._run_io(
+                        self.store.put_cached_prompt,
+                        get_prompt_cache_key(
+                            q["question_text"], q["age"], q["domain"], self.config
+                        ),
+                        prompts[question_id],
+                        self.config["prompt_model"],
+                    )
+        return prompts
+
+    async def _batched_prompt(self, question_id: str) -> Optional[str]:
+        """Return the prompt for a question from its batch, requesting it if needed."""
+        batch = self.prompt_batches.get(question_id)
+        if batch is None:
+            return None
+        if batch["task"] is None:
+            batch["task"] = asyncio.ensure_future(self._run_prompt_batch(batch))
+        prompts = await asyncio.shield(batch["task"])
+        return prompts.get(question_id)
+
+    async def _dispatch(self, idx: int, total: int, q: dict) -> dict:
+        """
+        Register a question's completion future and the roots it depends on.
+
+        Registration happens in dispatch order, so a question only ever waits
+        for questions dispatched before it (or for a member promoted while
+        both wait to resolve), so waiting can never deadlock the pipeline.
+        """
+        loop = asyncio.get_running_loop()
+        filename = get_filename(q["age"], q["domain"], q["number"])
+        question_id = filename.replace(".png", "")
+        question_hash = get_question_hash(q["question_text"])
+        done = loop.create_future()
+
+        cluster_id = None
+        canonical_id = self.canonical_map.get(question_id)
+        if canonical_id in self.roots:
+            cluster_id = canonical_id
+        elif canonical_id == question_id or (
+            canonical_id and not await self._run_io(self._image_object, canonical_id)
+        ):
+            # Only the dispatcher adds roots, so none appeared during the lookup
+            self.roots[canonical_id] = (question_id, done)
+
+        depends_on = []
+        if question_hash in self.hash_tail:
+            depends_on.append(self.hash_tail[question_hash])
+        self.hash_tail[question_hash] = done
+        text_root = self.text_roots.setdefault(question_hash, question_id)
+        self.unresolved += 1
+
+        return {
+            "idx": idx,
+            "total": total,
+            "question": q,
+            "filename": filename,
+            "question_id": question_id,
+            "question_hash": question_hash,
+            "fingerprint": get_input_fingerprint(q, self.config),
+            "depends_on": depends_on,
+            "cluster": cluster_id,
+            "text_root": text_root if text_root != question_id else None,
+            "done": done,
+            "parked": False,
+        }
+
+    async def _enqueue(self, queue: asyncio.Queue, item: dict) -> None:
+        """Put an item on a stage queue, stamping it for queue wait metrics."""
+        item["queued_at"] = time.monotonic()
+        await queue.put(item)
+
+    async def _stage_worker(self, stage: str, queue: asyncio.Queue, handler) -> None:
+        """Feed queue items to a stage handler until a None sentinel arrives."""
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            started = time.monotonic()
+            self.metrics.observe(
+                "queue_wait_seconds", started - item.pop("queued_at", started), stage=stage
+            )
+            try:
+                await handler(item)
+            except Exception as e:
+                await self._fail(item, e)
+            finally:
+                self.metrics.observe("stage_seconds", time.monotonic() - started, stage=stage)
+            await self._refresh_manifest()
+
+    async def _refresh_manifest(self) -> None:
+        """Rewrite manifest.json if MANIFEST_REFRESH_SECONDS have passed."""
+        now = time.monotonic()
+        if self.args.dry_run or now - self.manifest_written_at < MANIFEST_REFRESH_SECONDS:
+            return
+        self.manifest_written_at = now
+        try:
+            await self._run_io(write_manifest, self.store, self.output_dir)
+        except OSError as e:
+            self.logger.warning(f"Failed to refresh manifest: {e}")
+
+    def _finish(self, item: dict) -> None:
+        """Mark a question as finished so dependent questions can proceed."""
+        if not item["done"].done():
+            item["done"].set_result(True)
+
+    async def _fail(self, item: dict, error: Exception) -> None:
+        """Record a failed question and release its dependents."""
+        question_id = item["question_id"]
+        error_msg = str(error)
+        self.logger.error(f"  [{question_id}] Error: {error_msg}")
+        self.failed[question_id] = error_msg
+        self.counts["error"] += 1
+        try:
+            await self._run_io(self.store.record_error, question_id, error_msg)
+        finally:
+            self._finish(item)
+
+    def _is_outdated(self, question_id: str) -> bool:
+        """Return True if a question's image is stale and not yet regenerated."""
+        return question_id in self.stale and question_id not in self.refreshed
+
+    def _image_object(self, question_id: str) -> Optional[str]:
+        """Return a question's object path if its current image is on disk."""
+        if self._is_outdated(question_id):
+            return None
+        object_path = self.store.get_object(question_id)
+        if object_path and os.path.exists(os.path.join(self.output_dir, object_path)):
+            return object_path
+        return None
+
+    def _promote(self, item: dict, root_id: str) -> None:
+        """
+        Make a question the root of its cluster in place of a root without an image.
+
+        The question then renders the cluster image and the remaining members
+        wait for it instead.
+        """
+        cluster_id = item["cluster"]
+        self.roots[cluster_id] = (item["question_id"], item["done"])
+        self.counts["promoted"] += 1
+        self.logger.info(
+            f"  [{item['question_id']}] Cluster root {root_id} has no image, "
+            f"rendering it for cluster {cluster_id}"
+        )
+
+    def _park(self, item: dict, waiting_for: asyncio.Future) -> bool:
+        """
+        Take a question off the resolvers until the question it waits for finishes.
+
+        It is re-enqueued for resolving from the future's done callback.
+
+        Returns:
+            True, for _resolve() to return
+        """
+
+        def requeue(_: asyncio.Future) -> None:
+            task = asyncio.ensure_future(self._enqueue(self.resolve_queue, item))
+            self.requeues.add(task)
+            task.add_done_callback(self.requeues.discard)
+
+        item["parked"] = True
+        waiting_for.add_done_callback(requeue)
+        return True
+
+    async def _run_io(self, func, *func_args):
+        """Run a blocking disk operation in the I/O thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_pool, func, *func_args)
+
+    async def _resolve_step(self, item: dict, prompt_queue: asyncio.Queue) -> None:
+        """Resolve stage: run _resolve(), counting questions that leave the stage."""
+        parked = False
+        try:
+            parked = await self._resolve(item, prompt_queue)
+        finally:
+            if not parked:
+                self.unresolved -= 1
+                if not self.unresolved:
+                    self.all_resolved.set()
+
+    async def _resolve(self, item: dict, prompt_queue: asyncio.Queue) -> bool:
+        """
+        Skip or copy a question, or forward it to the prompt stage.
+
+        Args:
+            item: Dispatch record produced by _dispatch()
+            prompt_queue: Queue feeding the prompt stage
+
+        Returns:
+            True if the question was parked until a question it copies from
+            finishes, False once it has left the resolve stage
+        """
+        q = item["question"]
+        filename = item["filename"]
+        question_id = item["question_id"]
+        question_hash = item["question_hash"]
+        store = self.store
+        logger = self.logger
+
+        if not item["parked"]:
+            logger.info(f"\n[{item['idx']}/{item['total']}] {question_id}")
+
+        pending = next((f for f in item["depends_on"] if not f.done()), None)
+        if pending is not None:
+            return self._park(item, pending)
+
+        if question_id in self.upgrades:
+            if self.args.dry_run:
+                logger.info(f"  [{question_id}] [DRY-RUN] Would upgrade draft to HD")
+                self.counts["success"] += 1
+                self._finish(item)
+                return False
+            logger.info(f"  [{question_id}] Upgrading draft to HD")
+            await self._enqueue(prompt_queue, item)
+            return False
+
+        if (
+            not self.args.force
+            and question_id not in self.stale
+            and await self._run_io(store.is_completed, question_id)
+        ):
+            logger.info(f"  [{question_id}] Skipping (already completed)")
+            self.counts["skip"] += 1
+            self._finish(item)
+            return False
+
+        # Non-canonical questions copy from their cluster root
+        if question_id in self.canonical_map and question_id not in self.canonical_set:
+            canonical_id = self.canonical_map[question_id]
+            if item["cluster"]:
+                while True:
+                    root_id, root_done = self.roots[item["cluster"]]
+                    if not root_done.done():
+                        return self._park(item, root_done)
+                    source_id = root_id
+                    source_object = await self._run_io(self._image_object, root_id)
+                    if source_object or self.args.dry_run:
+                        break
+                    # The first member to find the root without an image renders
+                    # it; one promoted during the lookup is waited for instead
+                    if self.roots[item["cluster"]][0] == root_id:
+                        self._promote(item, root_id)
+                        source_id = None
+                        break
+            else:
+                source_id = canonical_id
+                source_object = await self._run_io(self._image_object, canonical_id)
+
+            if source_object:
+                await self._run_io(
+                    link_legacy_file,
+                    self.output_dir,
+                    source_object,
+                    filename,
+                    self.args.link_mode,
+                )
+                logger.info(f"  [{question_id}] Cluster copy from {source_id}")
+
+                await self._run_io(
+                    store.mark_copy,
+                    question_id,
+                    filename,
+                    "cluster_copy",
+                    source_id,
+                    question_hash,
+                    source_object,
+                    item["fingerprint"],
+                )
+
+                self.counts["cluster_copy"] += 1
+                self._finish(item)
+                return False
+            elif source_id and self.args.dry_run and item["cluster"]:
+                logger.info(f"  [{question_id}] [DRY-RUN] Would copy from {source_id}")
+                self.counts["cluster_copy"] += 1
+                self._finish(item)
+                return False
+            elif not item["cluster"]:
+                logger.info(
+                    f"  [{question_id}] Canonical image {canonical_id} is not in this run, "
+                    f"generating it for the cluster"
+                )
+
+        if self.args.dry_run and item["text_root"]:
+            logger.info(f"  [{question_id}] [DRY-RUN] Would copy duplicate of {item['text_root']}")
+            self.counts["duplicate"] += 1
+            self._finish(item)
+            return False
+
+        if self.args.dry_run:
+            logger.info(f"  [{question_id}] [DRY-RUN] Would generate: {filename}")
+            logger.info(f"  [{question_id}] Question: {q['question_text'][:80]}...")
+            self.counts["success"] += 1
+            self._finish(item)
+            return False
+
+        existing = await self._run_io(store.hash_source, question_hash)
+        if existing:
+            source_id = existing[0].replace(".png", "")
+            # --force regenerates the text root once; later duplicates copy
+            # the image it wrote in this run, never one from an earlier run
+            if self._is_outdated(source_id) or (
+                self.args.force and source_id not in self.refreshed
+            ):
+                existing = None
+        if existing:
+            existing_filename, existing_object = existing
+
+            if os.path.exists(os.path.join(self.output_dir, existing_object)):
+                await self._run_io(
+                    link_legacy_file,
+                    self.output_dir,
+                    existing_object,
+                    filename,
+                    self.args.link_mode,
+                )
+                logger.info(
+                    f"  [{question_id}] Duplicate detected, copied from {existing_filename}"
+                )
+
+                await self._run_io(
+                    store.mark_copy,
+                    question_id,
+                    filename,
+                    "duplicate",
+                    existing_filename,
+                    question_hash,
+                    existing_object,
+                    item["fingerprint"],
+                )
+
+                self.counts["duplicate"] += 1
+                self._finish(item)
+                return False
+
+        await self._enqueue(prompt_queue, item)
+        return False
+
+    async def _prompt(self, item: dict, image_queue: asyncio.Queue) -> None:
+        """Prompt stage: synthesise the image prompt for a question."""
+        q = item["question"]
+        question_id = item["question_id"]
+        use_cache = not self.args.no_prompt_cache
+        cache_key = get_prompt_cache_key(
+            q["question_text"], q["age"], q["domain"], self.config
+        )
+
+        prompt = None
+        if question_id in self.prompt_batches:
+            prompt = await self._batched_prompt(question_id)
+            if prompt:
+                self.counts["prompt_batch_hit"] += 1
+                self.logger.info(f"  [{question_id}] Prompt from batch")
+            else:
+                self.counts["prompt_batch_fallback"] += 1
+                self.logger.info(
+                    f"  [{question_id}] No usable prompt in batch, requesting it alone"
+                )
+        elif use_cache:
+            prompt = await self._run_io(
+                self.store.get_cached_prompt,
+                cache_key,
+                self.config["prompt_cache_max_age_days"],
+            )
+            if prompt:
+                self.counts["prompt_cache_hit"] += 1
+                self.logger.info(f"  [{question_id}] Prompt cache hit")
+
+        if not prompt:
+            self.counts["prompt_cache_miss"] += 1
+            self.logger.info(
+                f"  [{question_id}] Generating prompt via {self.config['prompt_model']}..."
+            )
+            prompt = await generate_prompt(
+                self.pool, q["question_text"], q["age"], q["domain"], self.config
+            )
+            if prompt and use_cache:
+                await self._run_io(
+                    self.store.put_cached_prompt,
+                    cache_key,
+                    prompt,
+                    self.config["prompt_model"],
+                )
+
+        item["prompt"] = prompt
+        self.logger.info(f"  [{question_id}] Prompt: {prompt[:100]}...")
+
+        await self._enqueue(image_queue, item)
+
+    async def _image(self, item: dict, save_queue: asyncio.Queue) -> None:
+        """Image stage: render the image for a synthesised prompt."""
+        question_id = item["question_id"]
+
+        self.logger.info(
+            f"  [{question_id}] Generating image via {self.config['image_model']}..."
+        )
+        generate = self.hedger.generate if self.hedger is not None else generate_image
+        item["image_data"] = await generate(
+            self.pool, item.pop("prompt"), self.config, self.tier
+        )
+
+        await self._enqueue(save_queue, item)
+
+    async def _save(self, item: dict) -> None:
+        """Save stage: persist the image and record the completion."""
+        filename = item["filename"]
+        question_id = item["question_id"]
+
+        self.logger.info(f"  [{question_id}] Saving {filename}...")
+        image_data = item.pop("image_data")
+        if self.config["image_response_format"] == "url":
+            object_path = await download_image(
+                image_data, self.output_dir, filename, self.pool, self.io_pool
+            )
+        else:
+            self.metrics.add("image_response_bytes_total", len(image_data))
+            object_path = await self._run_io(save_image, image_data, self.output_dir, filename)
+        del image_data
+        if not object_path:
+            raise RuntimeError("Failed to save image file")
+        self.metrics.add(
+            "image_bytes_written_total",
+            await self._run_io(os.path.getsize, os.path.join(self.output_dir, object_path)),
+        )
+
+        if question_id in self.upgrades:
+            await self._run_io(self._replace_draft, question_id, object_path)
+            self.refreshed.add(question_id)
+            self.counts["success"] += 1
+            self.logger.info(f"  [{question_id}] Upgraded to HD")
+            self._finish(item)
+            return
+
+        await self._run_io(
+            link_legacy_file, self.output_dir, object_path, filename, self.args.link_mode
+        )
+        await self._run_io(
+            self.store.mark_generated,
+            question_id,
+            filename,
+            item["question_hash"],
+            object_path,
+            item["fingerprint"],
+            self.tier,
+        )
+        self.refreshed.add(question_id)
+        self.counts["success"] += 1
+        self.logger.info(f"  [{question_id}] Done!")
+        self._finish(item)
+
+    def _replace_draft(self, question_id: str, object_path: str) -> None:
+        """Point a draft and its copies at the HD object, then relink their aliases."""
+        old_object = self.store.get_object(question_id)
+        filenames = self.store.upgrade_object(question_id, old_object, object_path)
+        for filename in filenames:
+            link_legacy_file(self.output_dir, object_path, filename, self.args.link_mode)
+
+
+# Laravel queue that asq3:queue-images pushes generation jobs to.
+DEFAULT_JOB_QUEUE = "asq3-images"
+
+JOB_DISPLAY_NAME = "asq3-images:generate"
+
+# A released job becomes available again after this many seconds per attempt.
+JOB_RELEASE_DELAY = 30
+
+FAILED_JOBS_TABLE = "failed_jobs"
+
+# Exceptions either Laravel database driver raises for query failures.
+DB_ERRORS = (sqlite3.Error,) if pymysql is None else (sqlite3.Error, pymysql.MySQLError)
+
+
+def connect_laravel_database(config: dict):
+    """
+    Open the Laravel application database (jobs table, screenings).
+
+    Args:
+        config: Configuration dictionary from get_config()
+
+    Returns:
+        Tuple of (DB-API connection, driver name)
+
+    Raises:
+        RuntimeError: If the driver is unsupported or PyMySQL is missing
+    """
+    driver = config["db_connection"]
+    if driver == "sqlite":
+        conn = sqlite3.connect(
+            config["db_database"], timeout=30, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn, driver
+    if driver in ("mysql", "mariadb"):
+        if pymysql is None:
+            raise RuntimeError(
+                "Reading a MySQL database requires PyMySQL: pip install -r scripts/requirements.txt"
+            )
+        conn = pymysql.connect(
+            host=config["db_host"],
+            port=config["db_port"],
+            user=config["db_username"],
+            password=config["db_password"],
+            database=config["db_database"],
+            charset="utf8mb4",
+            autocommit=False,
+        )
+        return conn, "mysql"
+    raise RuntimeError(f"Unsupported DB_CONNECTION={driver}")
+
+
+class JobQueue:
+    """
+    Claims generation jobs from Laravel's database queue tables.
+
+    Jobs are reserved the way Laravel's own database queue reserves them: a
+    job is available when it is unreserved and due, or when its reservation
+    is older than the visibility timeout (its worker died). Claiming sets
+    reserved_at and bumps attempts in the same transaction; MySQL locks the
+    rows with FOR UPDATE SKIP LOCKED so concurrent workers take different
+    jobs, and SQLite serializes claimers with BEGIN IMMEDIATE.
+
+    A claimed job is acknowledged by deleting it, released by clearing its
+    reservation with a delay, or moved to failed_jobs once it has used up
+    max_attempts.
+    """
+
+    def __init__(
+        self,
+        conn,
+        driver: str,
+        queue: str,
+        table: str = "jobs",
+        visibility_timeout: int = 600,
+        max_attempts: int = 3,
+    ) -> None:
+        self.conn = conn
+        self.driver = driver
+        self.queue = queue
+        self.table = table
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator:
+        """Yield a cursor inside a write transaction, committing on success."""
+        cursor = self.conn.cursor()
+        try:
+            if self.driver == "sqlite":
+                cursor.execute("BEGIN IMMEDIATE")
+            yield cursor
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            cursor.close()
+
+    def _execute(self, cursor, sql: str, params: tuple = ()) -> None:
+        """Run a statement written with ? placeholders on either driver."""
+        if self.driver == "mysql":
+            sql = sql.replace("?", "%s")
+        cursor.execute(sql, params)
+
+    def claim(self, limit: int) -> list[dict]:
+        """
+        Reserve up to `limit` available jobs, oldest first.
+
+        Returns:
+            List of job dictionaries with id, payload and attempts (including
+            this one)
+        """
+        now = int(time.time())
+        lock = " FOR UPDATE SKIP LOCKED" if self.driver == "mysql" else ""
+        with self._transaction() as cursor:
+            self._execute(
+                cursor,
+                f"SELECT id, payload, attempts FROM {self.table} WHERE queue = ? "
+                "AND ((reserved_at IS NULL AND available_at <= ?) OR reserved_at <= ?) "
+                f"ORDER BY id LIMIT ?{lock}",
+                (self.queue, now, now - self.visibility_timeout, limit),
+            )
+            rows = cursor.fetchall()
+            if rows:
+                placeholders = ", ".join("?" * len(rows))
+                self._execute(
+                    cursor,
+                    f"UPDATE {self.table} SET reserved_at = ?, attempts = attempts + 1 "
+                    f"WHERE id IN ({placeholders})",
+                    (now, *(row[0] for row in rows)),
+                )
+        return [
+            {"id": row[0], "payload": row[1], "attempts": row[2] + 1} for row in rows
+        ]
+
+    def heartbeat(self, job_ids: list[int]) -> None:
+        """Extend the reservation of jobs that are still being processed."""
+        if not job_ids:
+            return
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._transaction() as cursor:
+            self._execute(
+                cursor,
+                f"UPDATE {self.table} SET reserved_at = ? WHERE id IN ({placeholders})",
+                (int(time.time()), *job_ids),
+            )
+
+    def ack(self, job_ids: list[int]) -> None:
+        """Delete finished jobs."""
+        if not job_ids:
+            return
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._transaction() as cursor:
+            self._execute(
+                cursor, f"DELETE FROM {self.table} WHERE id IN ({placeholders})", tuple(job_ids)
+            )
+
+    def release(self, job: dict, error: str) -> bool:
+        """
+        Make a failed job available again, or fail it for good.
+
+        Args:
+            job: Job dictionary from claim()
+            error: Why this attempt failed
+
+        Returns:
+            True if the job was released for another attempt, False if it
+            was moved to failed_jobs
+        """
+        if job["attempts"] >= self.max_attempts:
+            self.fail(job, error)
+            return False
+        with self._transaction() as cursor:
+            self._execute(
+                cursor,
+                f"UPDATE {self.table} SET reserved_at = NULL, available_at = ? WHERE id = ?",
+                (int(time.time()) + JOB_RELEASE_DELAY * job["attempts"], job["id"]),
+            )
+        return True
+
+    def fail(self, job: dict, error: str) -> None:
+        """Move a job to failed_jobs so `php artisan queue:retry` can requeue it."""
+        try:
+            job_uuid = json.loads(job["payload"]).get("uuid")
+        except (ValueError, AttributeError):
+            job_uuid = None
+        with self._transaction() as cursor:
+            self._execute(
+                cursor,
+                f"INSERT INTO {FAILED_JOBS_TABLE} "
+                "(uuid, connection, queue, payload, exception, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job_uuid or str(uuid.uuid4()),
+                    "database",
+                    self.queue,
+                    job["payload"],
+                    error,
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+            self._execute(cursor, f"DELETE FROM {self.table} WHERE id = ?", (job["id"],))
+
+
+def index_questions_by_key(questions: list[dict]) -> dict[tuple, dict]:
+    """Map (age months, domain code, item number) to each CSV question."""
+    return {
+        (_parse_age_months(q["age"]), DOMAIN_CODES.get(q["domain"]), int(q["number"])): q
+        for q in questions
+        if q["number"].isdigit()
+    }
+
+
+def question_from_job(payload: str, questions_by_key: dict[tuple, dict]) -> tuple[dict, bool]:
+    """
+    Build the question a job asks to generate.
+
+    The payload's data names the question by age_months, domain_code and
+    question_number, the keys the manifest uses; an optional question_text
+    overrides the CSV text so edits made in the admin panel are rendered.
+
+    Args:
+        payload: Raw jobs.payload JSON
+        questions_by_key: (age months, domain code, item number) -> CSV question
+
+    Returns:
+        Tuple of (question dictionary in the load_questions() format, whether
+        the job asks to regenerate an up-to-date image)
+
+    Raises:
+        ValueError: If the payload is malformed or names an unknown question
+    """
+    try:
+        data = json.loads(payload)["data"]
+        key = (int(data["age_months"]), data["domain_code"], int(data["question_number"]))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Malformed job payload: {e}") from e
+
+    q = questions_by_key.get(key)
+    question_text = data.get("question_text")
+    if q is None:
+        domain = next(
+            (name for name, code in DOMAIN_CODES.items() if code == key[1]), None
+        )
+        if domain is None or not question_text:
+            raise ValueError(f"Unknown question {key[0]} months/{key[1]}/#{key[2]}")
+        q = {
+            "age": f"{key[0]} Bulan",
+            "domain": domain,
+            "number": str(key[2]),
+            "question_text": "",
+            "answer_choices": "",
+        }
+    if question_text:
+        q = {**q, "question_text": question_text}
+    return q, bool(data.get("force"))
+
+
+class QueueWorker:
+    """
+    Long-running worker that generates images for queued jobs.
+
+    Each batch claims up to --concurrency jobs and runs them through one
+    GenerationEngine, so prompt and image calls for different jobs overlap
+    while the endpoint pool's rate limits still apply. Reservations are
+    refreshed every third of the visibility timeout while a batch runs, so
+    only a dead worker's jobs are picked up by others. Jobs whose question
+    finished are deleted and the manifest is rewritten for asq3:sync-images;
+    failed ones are released with a growing delay until max attempts.
+
+    Jobs table queries and manifest writes run on a dedicated thread, so a
+    slow or locked database never stalls the event loop (and with it the
+    running batch's API calls). The single thread also serializes use of
+    the one database connection.
+
+    SIGINT and SIGTERM stop the worker after the current batch.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        jobs: JobQueue,
+        questions: list[dict],
+        engine_kwargs: dict,
+        logger: logging.Logger,
+    ) -> None:
+        self.args = args
+        self.jobs = jobs
+        self.engine_kwargs = engine_kwargs
+        self.logger = logger
+        self.questions_by_key = index_questions_by_key(questions)
+        self.stopping = False
+        self.db_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asq3-db")
+        self.counts = {"processed": 0, "failed": 0, "released": 0}
+
+    def stop(self) -> None:
+        """Finish the current batch, then exit."""
+        if not self.stopping:
+            self.logger.info("Stopping after the current batch...")
+        self.stopping = True
+
+    async def run(self) -> dict[str, int]:
+        """
+        Poll for jobs until stopped (or the queue is empty with --stop-when-empty).
+
+        Returns:
+            Dictionary with processed, released and failed job counts
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        batch_size = max(1, self.args.concurrency)
+        self.logger.info(
+            f"Worker polling queue '{self.jobs.queue}' "
+            f"(batch {batch_size}, visibility timeout {self.jobs.visibility_timeout}s)"
+        )
+        try:
+            while not self.stopping:
+                claimed = await self._run_db(self.jobs.claim, batch_size)
+                if not claimed:
+                    if self.args.stop_when_empty:
+                        break
+                    await asyncio.sleep(self.args.poll_interval)
+                    continue
+                await self._process(claimed)
+        finally:
+            self.db_pool.shutdown(wait=True)
+        return self.counts
+
+    async def _run_db(self, func, *func_args):
+        """Run a blocking database or manifest call on the worker's database thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_pool, func, *func_args)
+
+    async def _heartbeat(self, job_ids: list[int]) -> None:
+        """Keep the batch's reservations fresh until cancelled."""
+        interval = max(1.0, self.jobs.visibility_timeout / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._run_db(self.jobs.heartbeat, job_ids)
+            except Exception as e:
+                self.logger.warning(f"Failed to extend job reservations: {e}")
+
+    async def _process(self, claimed: list[dict]) -> None:
+        """Generate the questions of one claimed batch and settle its jobs."""
+        logger = self.logger
+        store = self.engine_kwargs["store"]
+        config = self.engine_kwargs["config"]
+
+        jobs_by_question: dict[str, list[dict]] = {}
+        batch_questions: dict[str, dict] = {}
+        forced: set[str] = set()
+        for job in claimed:
+            if job["attempts"] > self.jobs.max_attempts:
+                logger.warning(f"Job {job['id']} exceeded {self.jobs.max_attempts} attempts")
+                await self._run_db(self.jobs.fail, job, "Job has been attempted too many times.")
+                self.counts["failed"] += 1
+                continue
+            try:
+                q, force = question_from_job(job["payload"], self.questions_by_key)
+            except ValueError as e:
+                logger.error(f"Job {job['id']}: {e}")
+                await self._run_db(self.jobs.fail, job, str(e))
+                self.counts["failed"] += 1
+                continue
+            question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+            jobs_by_question.setdefault(question_id, []).append(job)
+            batch_questions.setdefault(question_id, q)
+            if force:
+                forced.add(question_id)
+        if not batch_questions:
+            return
+
+        questions = list(batch_questions.values())
+        stale = set(find_stale_questions(questions, store, config, {}))
+        stale |= forced
+        # An edited or forced question gets its own image instead of a cluster copy
+        canonical_map = {
+            qid: canonical
+            for qid, canonical in self.engine_kwargs["canonical_map"].items()
+            if qid not in stale
+        }
+        logger.info(
+            f"Claimed {len(claimed)} jobs for {len(questions)} questions "
+            f"({len(stale)} to regenerate)"
+        )
+
+        engine = GenerationEngine(
+            args=self.args,
+            stale=stale,
+            **{**self.engine_kwargs, "canonical_map": canonical_map},
+        )
+        job_ids = [job["id"] for jobs in jobs_by_question.values() for job in jobs]
+        heartbeat = asyncio.create_task(self._heartbeat(job_ids))
+        try:
+            with engine.metrics.phase("generation"):
+                await engine.run(questions)
+        except Exception as e:
+            logger.error(f"Batch failed: {e}")
+            engine.failed.update(dict.fromkeys(jobs_by_question, str(e)))
+        finally:
+            heartbeat.cancel()
+
+        finished = []
+        for question_id, jobs in jobs_by_question.items():
+            if question_id not in engine.failed:
+                finished.extend(job["id"] for job in jobs)
+                continue
+            for job in jobs:
+                if await self._run_db(self.jobs.release, job, engine.failed[question_id]):
+                    self.counts["released"] += 1
+                else:
+                    logger.warning(f"Job {job['id']} ({question_id}) moved to failed_jobs")
+                    self.counts["failed"] += 1
+        await self._run_db(self.jobs.ack, finished)
+        self.counts["processed"] += len(finished)
+
+        await self._run_db(write_manifest, store, self.engine_kwargs["output_dir"])
+
+
+# New generations the service accepts in flight before shedding requests.
+DEFAULT_SERVICE_BACKLOG = 64
+
+DEFAULT_SERVICE_PORT = 8046
+
+# URL prefix Laravel serves --output-dir under (see asq3:sync-images).
+PUBLIC_URL_PREFIX = "/storage/asq3-images/"
+
+SERVICE_MAX_BODY_BYTES = 64 * 1024
+SERVICE_READ_TIMEOUT = 10.0
+
+
+class GenerationFailed(Exception):
+    """An on-demand generation finished without an image."""
+
+
+class ImageService:
+    """
+    Local HTTP service that generates images on demand.
+
+    Laravel calls it for questions whose image_url is still null:
+
+        GET  /images/<question_id>
+        POST /images  {"age_months": 2, "domain_code": "communication",
+                       "question_number": 1}
+        GET  /health
+
+    Questions that already have an image are answered from the state store
+    and output directory without touching the API. Anything else becomes a
+    single-flight generation keyed by question ID, and every concurrent
+    request for it awaits the same future. Before generating, a cluster
+    member joins its canonical's flight and a question joins the flight
+    already rendering its exact text, so a burst of requests for one cluster
+    or one text produces one image plus cheap copies.
+
+    Up to --concurrency generations run at once through the shared endpoint
+    pool, so its rate limits and circuit breakers still apply. Requests that
+    would start a flight beyond --max-backlog are shed with 503 and a
+    Retry-After estimate instead of queueing without bound; requests that
+    join an existing flight or hit a completed image are always served. A
+    canonical flight started by a member takes over the member's backlog
+    slot while the member waits, so one admitted request never holds two.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        questions: list[dict],
+        engine_kwargs: dict,
+        logger: logging.Logger,
+    ) -> None:
+        self.args = args
+        self.engine_kwargs = engine_kwargs
+        self.store = engine_kwargs["store"]
+        self.output_dir = engine_kwargs["output_dir"]
+        self.canonical_map = engine_kwargs["canonical_map"]
+        self.logger = logger
+        self.questions = {
+            get_filename(q["age"], q["domain"], q["number"]).replace(".png", ""): q
+            for q in questions
+        }
+        self.questions_by_key = index_questions_by_key(questions)
+        # Each flight is one question, so its engine needs one worker per stage
+        self.engine_args = argparse.Namespace(
+            **{
+                **vars(args),
+                "concurrency": 1,
+                "prompt_workers": 1,
+                "image_workers": 1,
+                "save_workers": 1,
+                "prompt_lookahead": 1,
+                "prompt_batch_size": 1,
+            }
+        )
+        self.max_backlog = max(1, args.max_backlog)
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.flights: dict[str, asyncio.Future] = {}
+        self.text_flights: dict[str, asyncio.Future] = {}
+        # Member flights waiting on a canonical flight they started
+        self.riding = 0
+        self.generating = 0
+        self.generation_seconds = 0.0
+        self.manifest_written_at = time.monotonic()
+        self.manifest_dirty = False
+        # Manifest rewrites walk the whole store, so they run off the event loop
+        self.io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asq3-io")
+        self.counts = {"cached": 0, "generated": 0, "coalesced": 0, "shed": 0, "failed": 0}
+
+    async def run(self, host: str, port: int) -> dict[str, int]:
+        """
+        Serve requests until SIGINT or SIGTERM, then finish in-flight generations.
+
+        Returns:
+            Dictionary with cached, generated, coalesced, shed and failed
+            request counts
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        self.slots = asyncio.Semaphore(max(1, self.args.concurrency))
+        server = await asyncio.start_server(self._handle, host, port)
+        self.logger.info(
+            f"Serving on http://{host}:{port} "
+            f"({self.args.concurrency} concurrent generations, backlog {self.max_backlog})"
+        )
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            if self.flights:
+                self.logger.info(f"Finishing {len(self.flights)} in-flight generations...")
+                await asyncio.gather(*self.flights.values(), return_exceptions=True)
+            await server.wait_closed()
+            await self.engine_kwargs["pool"].close()
+            self.io_pool.shutdown(wait=True)
+        if self.manifest_dirty:
+            write_manifest(self.store, self.output_dir)
+        return self.counts
+
+    def _completed(self, question_id: str) -> Optional[dict]:
+        """Return the response for a question whose image is on disk, if any."""
+        object_path = self.store.get_object(question_id)
+        if not object_path or not os.path.exists(os.path.join(self.output_dir, object_path)):
+            return None
+        return {
+            "question_id": question_id,
+            **(resolve_question_id(question_id) or {}),
+            "object": object_path,
+            "url": PUBLIC_URL_PREFIX + object_path,
+        }
+
+    def _backlog(self) -> int:
+        """Number of flights counted against --max-backlog."""
+        return len(self.flights) - self.riding
+
+    def _retry_after(self) -> int:
+        """Estimate the seconds until the backlog has room again."""
+        per_slot = self._backlog() / max(1, self.args.concurrency)
+        return max(1, round(per_slot * (self.generation_seconds or 1.0)))
+
+    async def request(self, question_id: str) -> tuple[int, dict]:
+        """
+        Return the image for a question, generating it if needed.
+
+        Returns:
+            Tuple of (HTTP status, JSON body)
+        """
+        result = self._completed(question_id)
+        if result:
+            self.counts["cached"] += 1
+            return 200, {**result, "source": "cache"}
+        if question_id not in self.questions:
+            return 404, {"error": f"Unknown question {question_id}"}
+
+        coalesced = question_id in self.flights
+        if not coalesced and self._backlog() >= self.max_backlog:
+            self.counts["shed"] += 1
+            return 503, {"error": "Generation backlog is full", "retry_after": self._retry_after()}
+
+        try:
+            result = await self._ensure(question_id)
+        except GenerationFailed as e:
+            self.counts["failed"] += 1
+            return 502, {"question_id": question_id, "error": str(e)}
+        source = "coalesced" if coalesced else "generated"
+        self.counts[source] += 1
+        return 200, {**result, "source": source}
+
+    async def _ensure(self, question_id: str) -> dict:
+        """Join the question's in-flight generation, starting one if there is none."""
+        flight = self.flights.get(question_id)
+        if flight is None:
+            flight = asyncio.ensure_future(self._produce(question_id))
+            self.flights[question_id] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(question_id, None))
+        return await asyncio.shield(flight)
+
+    async def _produce(self, question_id: str) -> dict:
+        """Generate one question after the flights it can copy from."""
+        q = self.questions[question_id]
+        flight = self.flights[question_id]
+
+        canonical_id = self.canonical_map.get(question_id)
+        if (
+            canonical_id
+            and canonical_id != question_id
+            and canonical_id in self.questions
+            and not self._completed(canonical_id)
+        ):
+            riding = canonical_id not in self.flights
+            self.riding += riding
+            try:
+                await self._ensure(canonical_id)
+            except GenerationFailed:
+                pass  # the member renders its own image instead
+            finally:
+                self.riding -= riding
+
+        question_hash = get_question_hash(q["question_text"])
+        twin = self.text_flights.get(question_hash)
+        self.text_flights[question_hash] = flight
+        try:
+            if twin is not None:
+                await asyncio.gather(asyncio.shield(twin), return_exceptions=True)
+            async with self.slots:
+                return await self._generate(question_id, q)
+        finally:
+            if self.text_flights.get(question_hash) is flight:
+                del self.text_flights[question_hash]
+
+    async def _generate(self, question_id: str, q: dict) -> dict:
+        """Run one question through a GenerationEngine that shares the endpoint pool."""
+        engine = GenerationEngine(args=self.engine_args, **self.engine_kwargs)
+        started = time.monotonic()
+        self.generating += 1
+        try:
+            await engine.run([q], close_pool=False)
+        finally:
+            self.generating -= 1
+        elapsed = time.monotonic() - started
+        if self.generation_seconds:
+            elapsed = 0.8 * self.generation_seconds + 0.2 * elapsed
+        self.generation_seconds = elapsed
+
+        if question_id in engine.failed:
+            raise GenerationFailed(engine.failed[question_id])
+        result = self._completed(question_id)
+        if result is None:
+            raise GenerationFailed("No image was saved")
+        self.manifest_dirty = True
+        await self._refresh_manifest()
+        return result
+
+    async def _refresh_manifest(self) -> None:
+        """Rewrite manifest.json if MANIFEST_REFRESH_SECONDS have passed."""
+        now = time.monotonic()
+        if now - self.manifest_written_at < MANIFEST_REFRESH_SECONDS:
+            return
+        self.manifest_written_at = now
+        self.manifest_dirty = False
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.io_pool, write_manifest, self.store, self.output_dir)
+        except OSError as e:
+            self.logger.warning(f"Failed to refresh manifest: {e}")
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        """Dispatch one request to its handler."""
+        if path == "/health":
+            return 200, {
+                "status": "ok",
+                "in_flight": len(self.flights),
+                "backlog": self._backlog(),
+                "generating": self.generating,
+                "max_backlog": self.max_backlog,
+                **self.counts,
+            }
+        if path.startswith("/images/") and method == "GET":
+            return await self.request(path[len("/images/") :].removesuffix(".png"))
+        if path == "/images" and method == "POST":
+            try:
+                data = json.loads(body)
+                if "question_id" in data:
+                    question_id = str(data["question_id"])
+                else:
+                    key = (
+                        int(data["age_months"]),
+                        data["domain_code"],
+                        int(data["question_number"]),
+                    )
+                    q = self.questions_by_key.get(key)
+                    if q is None:
+                        return 404, {
+                            "error": f"Unknown question {key[0]} months/{key[1]}/#{key[2]}"
+                        }
+                    question_id = get_filename(q["age"], q["domain"], q["number"]).replace(
+                        ".png", ""
+                    )
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": f"Malformed request: {e}"}
+            return await self.request(question_id)
+        if path in ("/images", "/health") or path.startswith("/images/"):
+            return 405, {"error": f"{method} not allowed"}
+        return 404, {"error": f"No route for {path}"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve one HTTP/1.1 request per connection."""
+        status, body = 400, {"error": "Bad request"}
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), SERVICE_READ_TIMEOUT)
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), SERVICE_READ_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > SERVICE_MAX_BODY_BYTES:
+                status, body = 413, {"error": "Request body too large"}
+            else:
+                payload = (
+                    await asyncio.wait_for(reader.readexactly(length), SERVICE_READ_TIMEOUT)
+                    if length
+                    else b""
+                )
+                status, body = await self._route(method, target.split("?", 1)[0], payload)
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            self.logger.error(f"Service request failed: {e}")
+            status, body = 500, {"error": str(e)}
+
+        content = json.dumps(body).encode()
+        head = (
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            "Connection: close\r\n"
+        )
+        if status == 503:
+            head += f"Retry-After: {body['retry_after']}\r\n"
+        try:
+            writer.write(head.encode("latin-1") + b"\r\n" + content)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """
+    Build the command-line parser.
+
+    Returns:
+        argparse.ArgumentParser for all generator options
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate images for ASQ-3 screening questions",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Show help
+  python generate_asq3_images.py --help
+  
+  # Generate images for first 10 questions
+  python generate_asq3_images.py --limit 10
+  
+  # Regenerate all images (overwrite existing)
+  python generate_asq3_images.py --force
+  
+  # Preview what would be generated without calling API
+  python generate_asq3_images.py --dry-run --limit 5
+  
+  # Run clustering only (no image generation)
+  python generate_asq3_images.py --cluster-only
+  
+  # Use existing clusters without regenerating
+  python generate_asq3_images.py --skip-clustering
+  
+  # Force regenerate clusters
+  python generate_asq3_images.py --force-cluster
+
+  # Cluster offline without any API calls
+  python generate_asq3_images.py --cluster-only --force-cluster --cluster-mode local
+
+  # List images made stale by CSV edits, then regenerate just those
+  python generate_asq3_images.py --changed-only --dry-run
+  python generate_asq3_images.py --changed-only
+
+  # Retry only the questions that failed in earlier runs
+  python generate_asq3_images.py --retry-errors
+
+  # Regenerate images but call the prompt model again for every question
+  python generate_asq3_images.py --force --no-prompt-cache
+
+  # Render 256/512/1024px WebP and AVIF variants after generation
+  python generate_asq3_images.py --variants --avif
+
+  # Create image prompts 20 questions per chat call
+  python generate_asq3_images.py --prompt-batch-size 20
+
+  # Split generation across 4 machines, then merge their output
+  python generate_asq3_images.py --cluster-only
+  python generate_asq3_images.py --shard 1/4 --output-dir shard-1 \\
+      --clusters-from storage/app/public/asq3-images/clusters.json
+  python generate_asq3_images.py --merge-shards shard-1 shard-2 shard-3 shard-4
+
+  # Hedge image requests slower than the 95th latency percentile
+  python generate_asq3_images.py --hedge-percentile 95 --hedge-max-rate 0.1
+
+  # Generate up to 8 questions concurrently
+  python generate_asq3_images.py --concurrency 8
+
+  # Cover every question with a quick draft, then upgrade the drafts to HD
+  python generate_asq3_images.py --progressive
+  python generate_asq3_images.py --upgrade-drafts --upgrade-workers 2
+
+  # Export run metrics for the node_exporter textfile collector
+  python generate_asq3_images.py --prometheus-file /var/lib/node_exporter/asq3_images.prom
+
+  # Profile CPU and memory hot paths on a small sample
+  python generate_asq3_images.py --limit 20 --profile
+
+  # Cover the most-screened age intervals first within a 50-question budget
+  python generate_asq3_images.py --priority-weights db --limit 50
+
+  # Generate images for jobs pushed by `php artisan asq3:queue-images`
+  python generate_asq3_images.py --worker --concurrency 4
+
+  # Serve on-demand generation to Laravel on http://127.0.0.1:8046
+  python generate_asq3_images.py --serve --concurrency 4 --max-backlog 32
+  curl http://127.0.0.1:8046/images/2-bulan_komunikasi_1
+        """,
+    )
+
+    parser.add_argument(
+        "--force", action="store_true", help="Regenerate existing images (overwrite)"
+    )
+
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Limit number of questions to process (for testing)",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what would be generated without calling API",
+    )
+
+    parser.add_argument(
+        "--cluster-only",
+        action="store_true",
+        help="Run semantic clustering without generating images",
+    )
+
+    parser.add_argument(
+        "--skip-clustering",
+        action="store_true",
+        help="Use existing clusters, don't regenerate",
+    )
+
+    parser.add_argument(
+        "--force-cluster",
+        action="store_true",
+        help="Regenerate clusters even if they exist",
+    )
+
+    parser.add_argument(
+        "--cluster-workers",
+        type=int,
+        default=4,
+        help="Domain/age groups clustered concurrently (default: 4)",
+    )
+
+    parser.add_argument(
+        "--cluster-mode",
+        choices=["hybrid", "llm", "local"],
+        default="hybrid",
+        help="hybrid: settle clear cases locally and send only ambiguous questions "
+        "to the model; llm: send every question; local: offline, no API (default: hybrid)",
+    )
+
+    parser.add_argument(
+        "--merge-threshold",
+        type=float,
+        default=DEFAULT_MERGE_THRESHOLD,
+        help=f"Local similarity at or above which questions share an image "
+        f"(default: {DEFAULT_MERGE_THRESHOLD})",
+    )
+
+    parser.add_argument(
+        "--ambiguous-threshold",
+        type=float,
+        default=DEFAULT_AMBIGUOUS_THRESHOLD,
+        help=f"Local similarity below which questions are clearly distinct "
+        f"(default: {DEFAULT_AMBIGUOUS_THRESHOLD})",
+    )
+
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Regenerate only completed images whose question, template or models "
+        "changed, plus their cluster copies (combine with --dry-run to list them)",
+    )
+
+    parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="Only process questions whose last attempt failed",
+    )
+
+    parser.add_argument(
+        "--response-format",
+        choices=["b64_json", "url"],
+        default=None,
+        help="Image API response format; 'url' streams images straight to disk "
+        "(default: IMAGE_RESPONSE_FORMAT or b64_json)",
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join("storage", "app", "public", "asq3-images"),
+        help="Directory for images, state.db and manifest.json "
+        "(default: storage/app/public/asq3-images)",
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="i/N",
+        help="Process only shard i of N (1-based). Clusters and exact-text "
+        "duplicates always land on the same shard",
+    )
+
+    parser.add_argument(
+        "--clusters-from",
+        metavar="CLUSTERS_JSON",
+        help="With --shard, partition by the clusters in this clusters.json "
+        "instead of clustering locally",
+    )
+
+    parser.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="SHARD_DIR",
+        help="Merge the output directories of --shard runs into --output-dir and exit",
+    )
+
+    parser.add_argument(
+        "--link-mode",
+        choices=LINK_MODES,
+        default="hardlink",
+        help="How <question_id>.png aliases point at content-addressed objects "
+        "for legacy consumers (default: hardlink; 'none' relies on manifest.json only)",
+    )
+
+    parser.add_argument(
+        "--variants",
+        action="store_true",
+        help="Render responsive WebP variants and an optimised master PNG (requires Pillow)",
+    )
+
+    parser.add_argument(
+        "--variant-sizes",
+        type=parse_variant_sizes,
+        default=list(DEFAULT_VARIANT_SIZES),
+        help="Comma-separated variant widths in pixels (default: 256,512,1024)",
+    )
+
+    parser.add_argument(
+        "--avif",
+        action="store_true",
+        help="Also render AVIF variants (requires Pillow with AVIF support)",
+    )
+
+    parser.add_argument(
+        "--variant-workers",
+        type=int,
+        default=None,
+        help="Processes used to render variants (default: CPU count)",
+    )
+
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=0,
+        help="Send a duplicate image request once a request runs longer than this "
+        "percentile of observed latency, keeping the first result (e.g. 95; "
+        "default: 0, no hedging)",
+    )
+
+    parser.add_argument(
+        "--hedge-max-rate",
+        type=float,
+        default=0.1,
+        help="Maximum fraction of image requests that may be hedged (default: 0.1)",
+    )
+
+    parser.add_argument(
+        "--prompt-batch-size",
+        type=int,
+        default=1,
+        help="Create prompts for up to N questions of a domain/age group in one "
+        "chat call; missing or malformed entries fall back to single calls "
+        "(default: 1, no batching)",
+    )
+
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="Render cheap drafts (IMAGE_DRAFT_SIZE/IMAGE_DRAFT_QUALITY) for every "
+        "question first and write the manifest, then upgrade the drafts to HD in a "
+        "second pass that starts once every draft is done",
+    )
+
+    parser.add_argument(
+        "--upgrade-drafts",
+        action="store_true",
+        help="Only upgrade existing drafts to HD (resumes an interrupted --progressive run)",
+    )
+
+    parser.add_argument(
+        "--upgrade-workers",
+        type=int,
+        default=1,
+        help="Image workers for the sequential HD upgrade pass; keep it low to "
+        "leave rate-limit headroom for other runs (default: 1)",
+    )
+
+    parser.add_argument(
+        "--no-prompt-cache",
+        action="store_true",
+        help="Bypass the prompt cache (neither read nor write cached prompts)",
+    )
+
+    parser.add_argument(
+        "--invalidate-prompt-cache",
+        choices=["stale", "all"],
+        default=None,
+        help="Drop cached prompts from other template versions (stale) or all of them",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of questions generated at once (default: 4)",
+    )
+
+    parser.add_argument(
+        "--prompt-workers",
+        type=int,
+        default=None,
+        help="Concurrent prompt synthesis calls (default: --concurrency)",
+    )
+
+    parser.add_argument(
+        "--image-workers",
+        type=int,
+        default=None,
+        help="Concurrent image generation calls (default: --concurrency)",
     )
 
-    return clusters_data
+    parser.add_argument(
+        "--save-workers",
+        type=int,
+        default=2,
+        help="Concurrent image writes to disk (default: 2)",
+    )
 
+    parser.add_argument(
+        "--prompt-lookahead",
+        type=int,
+        default=None,
+        help="Prompts buffered ahead of the image stage (default: 2x image workers)",
+    )
 
-def build_cluster_lookup(
-    clusters_data: Optional[dict],
-) -> tuple[dict[str, str], set[str]]:
-    """
-    Build lookup structures from clusters data.
+    parser.add_argument(
+        "--priority-weights",
+        metavar="SOURCE",
+        default=None,
+        help="Generate the most-screened age intervals first (cluster canonicals "
+        "ahead of their copies) and apply --limit after ordering. SOURCE is 'db' "
+        "to count asq3_screenings in the Laravel database, or a JSON/CSV file "
+        "mapping age in months to a weight",
+    )
 
-    Returns:
-        tuple of:
-        - canonical_map: {question_id: canonical_id} for all questions
-        - canonical_set: set of canonical question IDs
-    """
-    if clusters_data is None:
-        return {}, set()
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run as a long-lived worker that generates images for jobs queued "
+        "by `php artisan asq3:queue-images` in the Laravel jobs table",
+    )
 
-    canonical_map: dict[str, str] = {}
-    canonical_set: set[str] = set()
+    parser.add_argument(
+        "--queue",
+        default=DEFAULT_JOB_QUEUE,
+        help=f"Queue name the worker claims jobs from (default: {DEFAULT_JOB_QUEUE})",
+    )
 
-    for cluster in clusters_data.get("clusters", []):
-        canonical_id = cluster["canonical_id"]
-        canonical_set.add(canonical_id)
-        for qid in cluster["question_ids"]:
-            canonical_map[qid] = canonical_id
+    parser.add_argument(
+        "--visibility-timeout",
+        type=int,
+        default=600,
+        help="Seconds before a reserved job whose worker stopped responding is "
+        "claimed again (default: 600)",
+    )
 
-    return canonical_map, canonical_set
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Attempts before a job is moved to failed_jobs (default: 3)",
+    )
 
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=2.0,
+        help="Seconds the worker sleeps when the queue is empty (default: 2)",
+    )
 
-def main() -> int:
-    """
-    Main entry point for the script.
+    parser.add_argument(
+        "--stop-when-empty",
+        action="store_true",
+        help="Exit the worker once the queue is empty",
+    )
 
-    Returns:
-        Exit code (0 for success, 1 for error)
-    """
-    parser = argparse.ArgumentParser(
-        description="Generate images for ASQ-3 screening questions",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
-Examples:
-  # Show help
-  python generate_asq3_images.py --help
-  
-  # Generate images for first 10 questions
-  python generate_asq3_images.py --limit 10
-  
-  # Regenerate all images (overwrite existing)
-  python generate_asq3_images.py --force
-  
-  # Preview what would be generated without calling API
-  python generate_asq3_images.py --dry-run --limit 5
-  
-  # Run clustering only (no image generation)
-  python generate_asq3_images.py --cluster-only
-  
-  # Use existing clusters without regenerating
-  python generate_asq3_images.py --skip-clustering
-  
-  # Force regenerate clusters
-  python generate_asq3_images.py --force-cluster
-        """,
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run a local HTTP service that returns a question's image, "
+        "generating it on demand (GET /images/<question_id>, POST /images)",
     )
 
     parser.add_argument(
-        "--force", action="store_true", help="Regenerate existing images (overwrite)"
+        "--host",
+        default="127.0.0.1",
+        help="Address the --serve service listens on (default: 127.0.0.1)",
     )
 
     parser.add_argument(
-        "--limit",
+        "--port",
         type=int,
-        default=None,
-        help="Limit number of questions to process (for testing)",
+        default=DEFAULT_SERVICE_PORT,
+        help=f"Port the --serve service listens on (default: {DEFAULT_SERVICE_PORT})",
     )
 
     parser.add_argument(
-        "--dry-run",
-        action="store_true",
-        help="Show what would be generated without calling API",
+        "--max-backlog",
+        type=int,
+        default=DEFAULT_SERVICE_BACKLOG,
+        help="Questions the service generates or queues at once before answering "
+        f"new ones with 503 (default: {DEFAULT_SERVICE_BACKLOG})",
     )
 
     parser.add_argument(
-        "--cluster-only",
-        action="store_true",
-        help="Run semantic clustering without generating images",
+        "--report-file",
+        default=None,
+        help="Where to write the JSON run report with latency percentiles, tokens, "
+        "bytes and retries (default: run-report.json in --output-dir)",
     )
 
     parser.add_argument(
-        "--skip-clustering",
-        action="store_true",
-        help="Use existing clusters.json, don't regenerate",
+        "--prometheus-file",
+        default=None,
+        help="Also write the run metrics to this Prometheus textfile",
     )
 
     parser.add_argument(
-        "--force-cluster",
+        "--profile",
         action="store_true",
-        help="Regenerate clusters.json even if it exists",
+        help="Profile the run with cProfile and tracemalloc; writes profile.pstats "
+        "to --output-dir and logs the hottest functions and allocation sites",
     )
 
+    return parser
+
+
+def main() -> int:
+    """
+    Main entry point for the script.
+
+    Returns:
+        Exit code (0 for success, 1 for error)
+    """
+    parser = build_arg_parser()
     args = parser.parse_args()
+    if args.force and args.changed_only:
+        parser.error("--changed-only cannot be combined with --force")
+    if args.progressive and args.upgrade_drafts:
+        parser.error("--upgrade-drafts cannot be combined with --progressive")
+    if args.worker and args.serve:
+        parser.error("--worker cannot be combined with --serve")
+    if (args.worker or args.serve) and (args.dry_run or args.progressive or args.upgrade_drafts):
+        parser.error(
+            f"--{'worker' if args.worker else 'serve'} cannot be combined with --dry-run, "
+            "--progressive or --upgrade-drafts"
+        )
 
     # Setup logging
     logger = setup_logging()
 
+    if args.profile:
+        return run_profiled(run_generation, args, logger)
+    return run_generation(args, logger)
+
+
+def run_generation(args: argparse.Namespace, logger: logging.Logger) -> int:
+    """
+    Run clustering, generation and variant rendering for parsed arguments.
+
+    Args:
+        args: Parsed command-line arguments
+        logger: Logger instance
+
+    Returns:
+        Exit code (0 for success, 1 for error)
+    """
     logger.info("=" * 60)
     logger.info("ASQ-3 Question Image Generator")
     logger.info(f"Started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     logger.info("=" * 60)
 
+    if args.variants:
+        try:
+            from PIL import features
+        except ImportError:
+            logger.error("--variants requires Pillow: pip install -r scripts/requirements.txt")
+            return 1
+        if args.avif and not features.check("avif"):
+            logger.warning("Pillow was built without AVIF support, skipping AVIF variants")
+            args.avif = False
+
+    if args.merge_shards:
+        os.makedirs(args.output_dir, exist_ok=True)
+        store = StateStore(os.path.join(args.output_dir, "state.db"))
+        try:
+            merge_shards(args.merge_shards, args.output_dir, store, args.link_mode, logger)
+        finally:
+            store.close()
+        return 0
+
     # Load configuration
     config = get_config()
-    logger.info(f"LLM Base URL: {config['llm_base_url']}")
+    if args.response_format:
+        config["image_response_format"] = args.response_format
+    try:
+        pool = build_endpoint_pool(config)
+    except ValueError as e:
+        logger.error(f"Invalid endpoint configuration: {e}")
+        return 1
+    for endpoint in pool.endpoints:
+        logger.info(f"LLM endpoint: {endpoint.name} (weight {endpoint.weight:g})")
     logger.info(f"Prompt Model: {config['prompt_model']}")
     logger.info(f"Image Model: {config['image_model']}")
 
@@ -767,8 +6036,24 @@ Examples:
         logger.error(f"Failed to load questions: {e}")
         return 1
 
-    # Apply limit if specified
-    if args.limit:
+    # Clusters always cover the whole CSV so group hashes stay comparable
+    all_questions = questions
+
+    priority_weights = None
+    if args.priority_weights:
+        try:
+            priority_weights = load_priority_weights(args.priority_weights, config)
+        except (OSError, ValueError, RuntimeError, *DB_ERRORS) as e:
+            logger.error(f"Failed to load priority weights: {e}")
+            return 1
+        top = sorted(priority_weights.items(), key=lambda item: -item[1])[:5]
+        logger.info(
+            f"Priority weights from {args.priority_weights}: "
+            + ", ".join(f"{months} Bulan={weight:g}" for months, weight in top)
+        )
+
+    # Apply limit if specified (after prioritizing when weights are given)
+    if args.limit and priority_weights is None:
         questions = questions[: args.limit]
         logger.info(f"Limited to {len(questions)} questions")
 
@@ -793,173 +6078,553 @@ Examples:
     logger.info("Processing questions")
     logger.info("=" * 60)
 
-    output_dir = os.path.join("storage", "app", "public", "asq3-images")
+    output_dir = args.output_dir
     os.makedirs(output_dir, exist_ok=True)
 
-    checkpoint_path = os.path.join(output_dir, "checkpoint.json")
-    errors_path = os.path.join(output_dir, "errors.json")
+    store = StateStore(os.path.join(output_dir, "state.db"))
+    store.import_legacy_json(output_dir, logger)
+    if not args.dry_run:
+        adopt_legacy_images(store, output_dir, args.link_mode, logger)
 
-    checkpoint = load_checkpoint(checkpoint_path)
+    if args.invalidate_prompt_cache:
+        removed = store.invalidate_prompt_cache(args.invalidate_prompt_cache == "stale")
+        logger.info(f"Invalidated {removed} cached prompts ({args.invalidate_prompt_cache})")
+    evicted = store.evict_prompt_cache(
+        config["prompt_cache_max_entries"], config["prompt_cache_max_age_days"]
+    )
+    if evicted:
+        logger.info(f"Evicted {evicted} expired or least recently used cached prompts")
 
     # Handle clustering flags
     csv_path = "asq3.csv"
-    clusters_path = os.path.join(output_dir, "clusters.json")
+
+    if args.shard and args.clusters_from:
+        # Every shard must partition by the same clusters
+        shared_clusters = load_clusters(args.clusters_from)
+        if not shared_clusters:
+            logger.error(f"No clusters found in {args.clusters_from}")
+            store.close()
+            return 1
+        store.save_clusters(shared_clusters)
+        args.skip_clustering = True
+        logger.info(f"Shard mode: using clusters from {args.clusters_from}")
+    elif args.shard and args.cluster_mode != "local":
+        logger.info("Shard mode: clustering locally so every shard gets the same clusters")
+        args.cluster_mode = "local"
 
     # Check if we need to run clustering
     should_cluster = False
+    previous_clusters = None
     if args.force_cluster:
-        logger.info("Force-cluster mode: Will regenerate clusters.json")
+        logger.info("Force-cluster mode: Will regenerate clusters")
         should_cluster = True
-    elif args.cluster_only:
-        if os.path.exists(clusters_path) and not args.force_cluster:
-            logger.info("clusters.json exists. Use --force-cluster to regenerate.")
-        else:
+    elif not store.has_clusters():
+        if args.cluster_only or not args.skip_clustering:
+            logger.info("No clusters found, running clustering...")
             should_cluster = True
-    elif not args.skip_clustering and not os.path.exists(clusters_path):
-        logger.info("No clusters.json found, running clustering...")
-        should_cluster = True
+    elif not args.skip_clustering:
+        previous_clusters = store.load_clusters()
+        group_hashes, changed_groups = diff_cluster_groups(all_questions, previous_clusters)
+        if changed_groups:
+            logger.info(
+                f"{len(changed_groups)} of {len(group_hashes)} domain/age groups changed "
+                f"since clustering: {', '.join(changed_groups)}"
+            )
+            should_cluster = True
+        else:
+            if not previous_clusters.get("group_hashes"):
+                previous_clusters["group_hashes"] = group_hashes
+                store.save_clusters(previous_clusters)
+                save_clusters(os.path.join(output_dir, "clusters.json"), previous_clusters)
+            if args.cluster_only:
+                logger.info("Clusters are up to date. Use --force-cluster to regenerate.")
+
+    if should_cluster and args.cluster_mode != "llm" and np is None:
+        if args.cluster_mode == "local":
+            logger.error("--cluster-mode local requires numpy: pip install -r scripts/requirements.txt")
+            store.close()
+            return 1
+        logger.warning("numpy is not installed, falling back to --cluster-mode llm")
+        args.cluster_mode = "llm"
 
     # Run clustering if needed
     if should_cluster and not args.dry_run:
-        client_for_clustering = get_client(config)
-        cluster_questions(questions, client_for_clustering, config, output_dir, logger)
+
+        async def run_clustering() -> dict:
+            try:
+                return await cluster_questions(
+                    all_questions,
+                    pool,
+                    config,
+                    output_dir,
+                    logger,
+                    store,
+                    args.cluster_workers,
+                    args.cluster_mode,
+                    args.merge_threshold,
+                    args.ambiguous_threshold,
+                    previous_clusters,
+                )
+            finally:
+                await pool.close()
+
+        with pool.metrics.phase("clustering"):
+            asyncio.run(run_clustering())
 
     # Exit early if --cluster-only
     if args.cluster_only:
         logger.info("Clustering complete. Exiting (--cluster-only mode).")
+        store.close()
+        write_run_report(args, pool, logger)
         return 0
 
     # Load clusters (may have just been created)
-    clusters_data = load_clusters(clusters_path)
+    clusters_data = store.load_clusters()
     canonical_map, canonical_set = build_cluster_lookup(clusters_data)
 
     if clusters_data:
-        logger.info(
-            f"Loaded {clusters_data['total_clusters']} clusters from clusters.json"
-        )
+        logger.info(f"Loaded {clusters_data['total_clusters']} clusters from state store")
     else:
-        logger.info("No clusters.json found, will generate all images")
+        logger.info("No clusters found, will generate all images")
 
     # Check for CSV hash mismatch
-    if clusters_data and not args.skip_clustering:
+    if clusters_data and (args.skip_clustering or args.dry_run):
         current_csv_hash = get_csv_hash(csv_path)
         stored_csv_hash = clusters_data.get("csv_hash", "")
         if current_csv_hash != stored_csv_hash:
             logger.warning(
-                "WARNING: CSV file has changed since clusters.json was created. "
-                "Consider running with --force-cluster to regenerate."
+                "WARNING: CSV file has changed since clusters were created. "
+                "Run without --skip-clustering to re-cluster the changed groups."
             )
 
-    client: Optional[OpenAI] = None
-    if not args.dry_run:
-        client = get_client(config)
+    fingerprints = {}
+    for q in all_questions:
+        question_id = get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+        fingerprints[question_id] = (
+            get_question_hash(q["question_text"]),
+            get_input_fingerprint(q, config),
+        )
+    adopted = store.backfill_fingerprints(fingerprints)
+    if adopted:
+        logger.info(f"Recorded input fingerprints for {adopted} earlier completions")
+
+    if args.serve:
+        return run_service(
+            args,
+            config,
+            output_dir,
+            store,
+            canonical_map,
+            canonical_set,
+            all_questions,
+            pool,
+            logger,
+        )
 
-    success_count = 0
-    skip_count = 0
-    error_count = 0
-    duplicate_count = 0
-    cluster_copy_count = 0
+    if args.worker:
+        return run_worker(
+            args,
+            config,
+            output_dir,
+            store,
+            canonical_map,
+            canonical_set,
+            all_questions,
+            pool,
+            logger,
+        )
 
-    for idx, q in enumerate(questions, 1):
-        filename = get_filename(q["age"], q["domain"], q["number"])
-        question_id = filename.replace(".png", "")
+    stale = find_stale_questions(all_questions, store, config, canonical_map)
+    if stale and args.changed_only:
+        logger.info(f"{len(stale)} completed images are stale:")
+        for question_id, reason in stale.items():
+            logger.info(f"  {question_id}: {reason}")
+    elif stale and not args.force:
+        logger.warning(
+            f"{len(stale)} completed images are stale (edited questions, template "
+            f"or model changes). Run with --changed-only to regenerate them."
+        )
 
-        logger.info(f"\n[{idx}/{len(questions)}] {question_id}")
+    if args.changed_only:
+        questions = [
+            q
+            for q in questions
+            if get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+            in stale
+        ]
+        logger.info(f"Changed-only mode: {len(questions)} stale questions selected")
+
+    if args.shard:
+        shard_index, shard_count = args.shard
+        shard_keys = get_shard_keys(all_questions, clusters_data)
+        questions = [
+            q
+            for q in questions
+            if stable_shard(
+                shard_keys[get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")],
+                shard_count,
+            )
+            == shard_index
+        ]
+        logger.info(f"Shard {shard_index}/{shard_count}: {len(questions)} questions selected")
+
+    if args.retry_errors:
+        failed_ids = store.failed_ids()
+        questions = [
+            q
+            for q in questions
+            if get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+            in failed_ids
+        ]
+        logger.info(f"Retry-errors mode: {len(questions)} failed questions selected")
+
+    if priority_weights is not None:
+        questions = prioritize_questions(
+            questions, priority_weights, canonical_map, canonical_set
+        )
+        if args.limit:
+            questions = questions[: args.limit]
+            logger.info(f"Limited to the {len(questions)} highest-priority questions")
+
+    engine_kwargs = dict(
+        config=config,
+        output_dir=output_dir,
+        store=store,
+        canonical_map=canonical_map,
+        canonical_set=canonical_set,
+        logger=logger,
+        pool=pool,
+    )
+    engine = None
+    upgrade_counts = None
+    try:
+        if not args.upgrade_drafts:
+            engine = GenerationEngine(
+                args=args,
+                stale=set(stale) if args.changed_only else None,
+                tier="draft" if args.progressive else "hd",
+                **engine_kwargs,
+            )
+            with pool.metrics.phase("generation"):
+                counts = asyncio.run(engine.run(questions))
+            if args.progressive and not args.dry_run:
+                manifest_path = write_manifest(store, output_dir)
+                logger.info(f"Drafts ready, wrote image manifest to {manifest_path}")
+
+        if args.progressive or args.upgrade_drafts:
+            draft_ids = store.draft_ids()
+            upgrade_questions = [
+                q
+                for q in questions
+                if get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+                in draft_ids
+            ]
+            logger.info("\n" + "=" * 60)
+            # A second pass rather than a concurrent one, so the HD renders
+            # never compete with drafts for the shared rate limits
+            logger.info(
+                f"HD upgrade pass: {len(upgrade_questions)} drafts, "
+                f"{args.upgrade_workers} image workers"
+            )
+            logger.info("=" * 60)
+            upgrade_engine = GenerationEngine(
+                args=argparse.Namespace(**{**vars(args), "image_workers": args.upgrade_workers}),
+                tier="hd",
+                upgrades={
+                    get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+                    for q in upgrade_questions
+                },
+                **engine_kwargs,
+            )
+            with pool.metrics.phase("upgrade"):
+                upgrade_counts = asyncio.run(upgrade_engine.run(upgrade_questions))
+            if engine is None:
+                # --upgrade-drafts: the upgrade pass is the whole run
+                engine, counts, upgrade_counts = upgrade_engine, upgrade_counts, None
+
+        if args.variants and not args.dry_run:
+            formats = ["webp"] + (["avif"] if args.avif else [])
+            with pool.metrics.phase("variants"):
+                variant_counts = build_variants(
+                    store,
+                    output_dir,
+                    args.variant_sizes,
+                    formats,
+                    args.variant_workers,
+                    logger,
+                )
+            for outcome, count in variant_counts.items():
+                pool.metrics.add("variant_objects_total", count, outcome=outcome)
+    finally:
+        if not args.dry_run:
+            manifest_path = write_manifest(store, output_dir)
+            logger.info(f"Wrote image manifest to {manifest_path}")
+        store.close()
+
+    success_count = counts["success"]
+    skip_count = counts["skip"]
+    error_count = counts["error"]
+    duplicate_count = counts["duplicate"]
+    cluster_copy_count = counts["cluster_copy"]
 
-        if not args.force and question_id in checkpoint["completed"]:
-            logger.info(f"  Skipping (already completed)")
-            skip_count += 1
-            continue
+    logger.info("\n" + "=" * 60)
+    logger.info("Generation Complete")
+    logger.info(f"  Success:        {success_count}")
+    logger.info(f"  Skipped:        {skip_count}")
+    logger.info(f"  Duplicates:     {duplicate_count}")
+    logger.info(f"  Cluster copies: {cluster_copy_count}")
+    logger.info(f"  Errors:         {error_count}")
+    logger.info(f"  Total:          {len(questions)}")
+    if upgrade_counts is not None:
+        logger.info(
+            f"HD upgrades: {upgrade_counts['success']} upgraded, "
+            f"{upgrade_counts['error']} failed (rerun with --upgrade-drafts to resume)"
+        )
+        error_count += upgrade_counts["error"]
+    logger.info(
+        f"Prompt cache: {counts['prompt_cache_hit']} hits, "
+        f"{counts['prompt_cache_miss']} misses"
+    )
+    if counts["prompt_batch_calls"]:
+        logger.info(
+            f"Prompt batches: {counts['prompt_batch_calls']} calls, "
+            f"{counts['prompt_batch_hit']} prompts, "
+            f"{counts['prompt_batch_fallback']} single-call fallbacks"
+        )
+    logger.info("Endpoints:")
+    for endpoint in pool.endpoints:
+        logger.info(f"  {endpoint.summary()}")
+    logger.info("Rate limits:")
+    for line in pool.limiter_summaries():
+        logger.info(f"  {line}")
+    logger.info(f"Retries: {pool.retry_policy.summary()}")
+    if engine.hedger is not None:
+        logger.info(f"Hedging: {engine.hedger.summary()}")
+    logger.info("=" * 60)
 
-        # Check if this is a non-canonical question that should copy from canonical
-        if question_id in canonical_map and question_id not in canonical_set:
-            canonical_id = canonical_map[question_id]
-            canonical_filename = f"{canonical_id}.png"
-            canonical_path = os.path.join(output_dir, canonical_filename)
+    question_counts = {**counts, "total": len(questions)}
+    if upgrade_counts is not None:
+        question_counts["upgraded"] = upgrade_counts["success"]
+        question_counts["upgrade_errors"] = upgrade_counts["error"]
+    write_run_report(args, pool, logger, question_counts, engine.hedger)
 
-            if os.path.exists(canonical_path):
-                target_path = os.path.join(output_dir, filename)
-                shutil.copy2(canonical_path, target_path)
-                logger.info(f"  Cluster copy from {canonical_id}")
+    return 0 if error_count == 0 else 1
 
-                checkpoint["completed"].append(question_id)
-                checkpoint.setdefault("cluster_copies", {})[question_id] = canonical_id
-                save_checkpoint(checkpoint_path, checkpoint)
 
-                cluster_copy_count += 1
-                continue
-            else:
-                logger.info(
-                    f"  Canonical image {canonical_id} not yet generated, will generate this one"
-                )
+def run_worker(
+    args: argparse.Namespace,
+    config: dict,
+    output_dir: str,
+    store: StateStore,
+    canonical_map: dict[str, str],
+    canonical_set: set[str],
+    all_questions: list[dict],
+    pool: EndpointPool,
+    logger: logging.Logger,
+) -> int:
+    """
+    Process queued generation jobs until stopped.
 
-        if args.dry_run:
-            logger.info(f"  [DRY-RUN] Would generate: {filename}")
-            logger.info(f"  Question: {q['question_text'][:80]}...")
-            success_count += 1
-            continue
+    Returns:
+        Exit code (0 for success, 1 if the jobs table cannot be opened)
+    """
+    try:
+        conn, driver = connect_laravel_database(config)
+    except (RuntimeError, sqlite3.Error) as e:
+        logger.error(f"Cannot open the jobs database: {e}")
+        store.close()
+        return 1
+    jobs = JobQueue(
+        conn,
+        driver,
+        args.queue,
+        config["queue_table"],
+        args.visibility_timeout,
+        args.max_attempts,
+    )
+    worker = QueueWorker(
+        args,
+        jobs,
+        all_questions,
+        dict(
+            config=config,
+            output_dir=output_dir,
+            store=store,
+            canonical_map=canonical_map,
+            canonical_set=canonical_set,
+            logger=logger,
+            pool=pool,
+        ),
+        logger,
+    )
+    try:
+        counts = asyncio.run(worker.run())
+    except DB_ERRORS as e:
+        logger.error(f"Jobs database error: {e}")
+        return 1
+    finally:
+        jobs.close()
+        store.close()
 
-        question_hash = get_question_hash(q["question_text"])
+    logger.info(
+        f"Worker stopped: {counts['processed']} jobs done, {counts['released']} released, "
+        f"{counts['failed']} failed"
+    )
+    write_run_report(args, pool, logger, counts)
+    return 0
 
-        if question_hash in checkpoint.get("hashes", {}) and not args.force:
-            existing_filename = checkpoint["hashes"][question_hash]
-            existing_path = os.path.join(output_dir, existing_filename)
 
-            if os.path.exists(existing_path):
-                target_path = os.path.join(output_dir, filename)
-                shutil.copy2(existing_path, target_path)
-                logger.info(f"  Duplicate detected, copied from {existing_filename}")
+def run_service(
+    args: argparse.Namespace,
+    config: dict,
+    output_dir: str,
+    store: StateStore,
+    canonical_map: dict[str, str],
+    canonical_set: set[str],
+    all_questions: list[dict],
+    pool: EndpointPool,
+    logger: logging.Logger,
+) -> int:
+    """
+    Serve on-demand generation requests until stopped.
 
-                checkpoint["completed"].append(question_id)
-                checkpoint.setdefault("duplicates", {})[question_id] = existing_filename
-                save_checkpoint(checkpoint_path, checkpoint)
+    Returns:
+        Exit code (0 for success, 1 if the port cannot be bound)
+    """
+    service = ImageService(
+        args,
+        all_questions,
+        dict(
+            config=config,
+            output_dir=output_dir,
+            store=store,
+            canonical_map=canonical_map,
+            canonical_set=canonical_set,
+            logger=logger,
+            pool=pool,
+        ),
+        logger,
+    )
+    try:
+        counts = asyncio.run(service.run(args.host, args.port))
+    except OSError as e:
+        logger.error(f"Cannot serve on {args.host}:{args.port}: {e}")
+        return 1
+    finally:
+        store.close()
 
-                duplicate_count += 1
-                continue
+    logger.info(
+        f"Service stopped: {counts['cached']} cached, {counts['generated']} generated, "
+        f"{counts['coalesced']} coalesced, {counts['shed']} shed, {counts['failed']} failed"
+    )
+    write_run_report(args, pool, logger, counts)
+    return 0
 
-        try:
-            assert client is not None
-            logger.info(f"  Generating prompt via {config['prompt_model']}...")
-            prompt = generate_prompt(
-                client, q["question_text"], q["age"], q["domain"], config
-            )
-            logger.info(f"  Prompt: {prompt[:100]}...")
-            time.sleep(1.5)
-
-            logger.info(f"  Generating image via {config['image_model']}...")
-            image_data = generate_image(client, prompt, config)
-            time.sleep(1.5)
-
-            logger.info(f"  Saving {filename}...")
-            saved = save_image(image_data, output_dir, filename)
-
-            if saved:
-                checkpoint["completed"].append(question_id)
-                checkpoint.setdefault("hashes", {})[question_hash] = filename
-                save_checkpoint(checkpoint_path, checkpoint)
-                success_count += 1
-                logger.info(f"  Done!")
-            else:
-                raise RuntimeError("Failed to save image file")
 
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"  Error: {error_msg}")
-            save_error(errors_path, question_id, error_msg)
-            error_count += 1
-            continue
+def write_run_report(
+    args: argparse.Namespace,
+    pool: EndpointPool,
+    logger: logging.Logger,
+    questions: Optional[dict] = None,
+    hedger: Optional[ImageHedger] = None,
+) -> None:
+    """
+    Write the JSON run report and, if requested, the Prometheus textfile.
 
-    logger.info("\n" + "=" * 60)
-    logger.info("Generation Complete")
-    logger.info(f"  Success:        {success_count}")
-    logger.info(f"  Skipped:        {skip_count}")
-    logger.info(f"  Duplicates:     {duplicate_count}")
-    logger.info(f"  Cluster copies: {cluster_copy_count}")
-    logger.info(f"  Errors:         {error_count}")
-    logger.info(f"  Total:          {len(questions)}")
-    logger.info("=" * 60)
+    Args:
+        args: Parsed command-line arguments
+        pool: Endpoint pool whose metrics and counters are reported
+        logger: Logger instance
+        questions: Engine outcome counts plus the number of questions processed
+        hedger: Image hedger, if hedging was enabled
+    """
+    report = pool.metrics.report(
+        argv=sys.argv[1:],
+        questions=questions or {},
+        endpoints=[
+            {
+                "name": endpoint.name,
+                "weight": endpoint.weight,
+                "requests": endpoint.requests,
+                "failures": endpoint.failures,
+                "ejections": endpoint.breaker.trips,
+            }
+            for endpoint in pool.endpoints
+        ],
+        rate_limits=[
+            {
+                "endpoint": endpoint.name,
+                "model": limiter.model,
+                "throttled": limiter.throttled,
+                "header_pauses": limiter.header_pauses,
+                "wait_seconds": round(limiter.wait_seconds, 3),
+            }
+            for endpoint in pool.endpoints
+            for limiter in endpoint.limiters.values()
+        ],
+        retries={
+            "retries": pool.retry_policy.retries,
+            "timeouts": pool.retry_policy.timeouts,
+            "paused_seconds": round(pool.retry_policy.paused_seconds, 3),
+        },
+        hedging=(
+            {
+                "requests": hedger.requests,
+                "hedged": hedger.hedged,
+                "hedge_wins": hedger.hedge_wins,
+                "capped": hedger.capped,
+            }
+            if hedger is not None
+            else None
+        ),
+    )
 
-    return 0 if error_count == 0 else 1
+    report_path = args.report_file or os.path.join(args.output_dir, RUN_REPORT_FILENAME)
+    try:
+        pool.metrics.write_json(report_path, report)
+        logger.info(f"Wrote run report to {report_path}")
+        if args.prometheus_file:
+            pool.metrics.write_prometheus(args.prometheus_file, report)
+            logger.info(f"Wrote Prometheus metrics to {args.prometheus_file}")
+    except OSError as e:
+        logger.error(f"Failed to write run report: {e}")
+
+
+def run_profiled(func, args: argparse.Namespace, logger: logging.Logger) -> int:
+    """
+    Run func(args, logger) under cProfile and tracemalloc.
+
+    The profile is saved as profile.pstats in the output directory (open it
+    with `python -m pstats` or snakeviz). The hottest functions by cumulative
+    time and the largest allocation sites are logged. Only the main thread
+    is profiled; disk writes in the I/O thread pool are not.
+
+    Returns:
+        The exit code returned by func
+    """
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, args, logger)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        stats_path = os.path.join(args.output_dir, PROFILE_FILENAME)
+        profiler.dump_stats(stats_path)
+
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(
+            PROFILE_TOP_ENTRIES
+        )
+        logger.info(f"Profile written to {stats_path}; top functions by cumulative time:")
+        logger.info(buffer.getvalue())
+
+        logger.info(f"Peak traced memory: {peak / 1024 / 1024:.1f} MiB; top allocation sites:")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ENTRIES]:
+            logger.info(f"  {stat}")
 
 
 if __name__ == "__main__":
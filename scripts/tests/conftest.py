@@ -0,0 +1,104 @@
+"""Shared fixtures for the ASQ-3 image generator tests."""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import benchmark_asq3_images as bench  # noqa: E402
+import generate_asq3_images as gen  # noqa: E402
+
+
+def make_question(age_months: int, domain: str, number: int, text: str = "") -> dict:
+    """Build a question in the load_questions() format."""
+    return {
+        "age": f"{age_months} Bulan",
+        "domain": domain,
+        "number": str(number),
+        "question_text": text or f"Pertanyaan {age_months}/{domain}/{number}",
+        "answer_choices": "Ya|Kadang-kadang|Belum",
+    }
+
+
+def question_id(q: dict) -> str:
+    """Return the generator's ID for a question."""
+    return gen.get_filename(q["age"], q["domain"], q["number"]).replace(".png", "")
+
+
+def make_config(base_url: str = "http://127.0.0.1:9/v1", **overrides) -> dict:
+    """get_config() pointed at one endpoint, without rate limits or long backoffs."""
+    config = gen.get_config()
+    config.update(
+        llm_base_url=base_url,
+        llm_endpoints="",
+        prompt_rpm=0,
+        prompt_tpm=0,
+        image_rpm=0,
+        image_tpm=0,
+        api_max_retries=0,
+        api_backoff_base=0.01,
+        api_backoff_max=0.05,
+        breaker_threshold=0,
+        image_response_format="b64_json",
+    )
+    config.update(overrides)
+    return config
+
+
+def make_args(*argv: str):
+    """Parse generator command-line arguments."""
+    return gen.build_arg_parser().parse_args(list(argv))
+
+
+@pytest.fixture
+def mock_api():
+    """The benchmark's mock OpenAI server with zero latency and tiny images."""
+    server = bench.MockOpenAIServer(
+        bench.parse_latency("fixed:0"), bench.parse_latency("fixed:0"), image_px=8
+    )
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def store(tmp_path):
+    """A fresh state store in a temporary directory."""
+    state = gen.StateStore(str(tmp_path / "state.db"))
+    yield state
+    state.close()
+
+
+@pytest.fixture
+def make_engine(tmp_path, store):
+    """Factory for a GenerationEngine writing into tmp_path/out."""
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    def factory(base_url: str, *argv: str, canonical_map=None, config=None, **kwargs):
+        config = config or make_config(base_url)
+        canonical_map = canonical_map or {}
+        return gen.GenerationEngine(
+            args=make_args("--no-prompt-cache", *argv),
+            config=config,
+            output_dir=str(output_dir),
+            store=store,
+            canonical_map=canonical_map,
+            canonical_set=set(canonical_map.values()),
+            logger=gen.logging.getLogger("test"),
+            pool=gen.build_endpoint_pool(config),
+            **kwargs,
+        )
+
+    return factory
+
+
+def run_engine(engine, questions: list[dict]) -> tuple[dict, float]:
+    """Run an engine to completion and return its counts and wall time."""
+    started = time.monotonic()
+    counts = asyncio.run(engine.run(questions))
+    return counts, time.monotonic() - started
@@ -0,0 +1,181 @@
+"""Tests for local pre-clustering, group diffs and cluster lookups."""
+
+import asyncio
+import json
+import logging
+import os
+
+import pytest
+
+from conftest import gen, make_config, make_question, question_id
+
+MERGE = 0.8
+AMBIGUOUS = 0.3
+
+
+def test_precluster_merges_near_identical_questions():
+    settled, ambiguous = gen.precluster_group(
+        ["a", "b", "c"],
+        [
+            "anak dapat menendang bola ke depan",
+            "anak dapat menendang bola ke depan",
+            "anak menyusun tiga balok menjadi menara",
+        ],
+        MERGE,
+        AMBIGUOUS,
+    )
+
+    assert ambiguous == []
+    assert [c["question_ids"] for c in settled] == [["a", "b"], ["c"]]
+    assert settled[0]["canonical_id"] == "a"
+    assert settled[0]["reason"].startswith("Local: lexical similarity")
+    assert settled[1]["reason"].startswith("Local: unique")
+
+
+def test_precluster_merges_transitively_with_the_lowest_index_as_canonical():
+    # c ~ b and b ~ a, so union-find puts all three under a even though the
+    # first pair to merge may be (b, c).
+    texts = [
+        "anak menunjuk gambar kucing di buku",
+        "anak menunjuk gambar kucing di buku cerita",
+        "anak menunjuk gambar kucing di buku cerita bergambar",
+        "anak berjalan naik tangga sendiri",
+    ]
+    similarity = gen.tfidf_similarity(texts)
+    threshold = min(similarity[0, 1], similarity[1, 2]) - 0.01
+    assert similarity[0, 2] > AMBIGUOUS
+
+    settled, ambiguous = gen.precluster_group(
+        ["a", "b", "c", "d"], texts, threshold, AMBIGUOUS
+    )
+
+    assert ambiguous == []
+    merged = [c for c in settled if len(c["question_ids"]) > 1]
+    assert merged == [
+        {
+            "canonical_id": "a",
+            "question_ids": ["a", "b", "c"],
+            "reason": f"Local: lexical similarity >= {threshold:.2f}",
+        }
+    ]
+
+
+def test_precluster_leaves_borderline_components_to_the_model():
+    settled, ambiguous = gen.precluster_group(
+        ["a", "b", "c"],
+        [
+            "anak dapat melempar bola kecil ke arah orang dewasa",
+            "anak dapat menangkap bola besar dari orang dewasa",
+            "anak mengucapkan dua kata bersama",
+        ],
+        0.99,
+        0.1,
+    )
+
+    assert ["a"] in ambiguous and ["b"] in ambiguous
+    assert [c["question_ids"] for c in settled] == [["c"]]
+
+
+def _clusters_for(questions):
+    current, _ = gen.diff_cluster_groups(questions, {"group_hashes": {"x": "y"}})
+    return {"group_hashes": current}
+
+
+def test_diff_cluster_groups_reports_only_edited_groups():
+    questions = [
+        make_question(2, "Komunikasi", 1),
+        make_question(2, "Komunikasi", 2),
+        make_question(24, "Motorik Kasar", 1),
+    ]
+    stored = _clusters_for(questions)
+    edited = [dict(q) for q in questions]
+    edited[2]["question_text"] = "Teks baru"
+
+    current, changed = gen.diff_cluster_groups(edited, stored)
+
+    assert changed == ["Motorik Kasar/toddler"]
+    assert current["Komunikasi/baby"] == stored["group_hashes"]["Komunikasi/baby"]
+
+
+def test_diff_cluster_groups_reports_added_and_removed_groups():
+    questions = [make_question(2, "Komunikasi", 1), make_question(24, "Motorik Kasar", 1)]
+    stored = _clusters_for(questions)
+
+    _, changed = gen.diff_cluster_groups(
+        [questions[0], make_question(48, "Motorik Halus", 1)], stored
+    )
+
+    assert changed == ["Motorik Halus/preschooler", "Motorik Kasar/toddler"]
+
+
+def test_diff_cluster_groups_detects_reordering():
+    questions = [make_question(2, "Komunikasi", 1), make_question(2, "Komunikasi", 2)]
+    stored = _clusters_for(questions)
+
+    _, changed = gen.diff_cluster_groups(questions[::-1], stored)
+
+    assert changed == ["Komunikasi/baby"]
+
+
+def test_build_cluster_lookup():
+    canonical_map, canonical_set = gen.build_cluster_lookup(
+        {
+            "clusters": [
+                {"canonical_id": "a", "question_ids": ["a", "b"]},
+                {"canonical_id": "c", "question_ids": ["c"]},
+            ]
+        }
+    )
+
+    assert canonical_map == {"a": "a", "b": "a", "c": "c"}
+    assert canonical_set == {"a", "c"}
+    assert gen.build_cluster_lookup(None) == ({}, set())
+
+
+def test_overlapping_model_clusters_keep_a_canonical_inside_each_cluster(
+    store, tmp_path, monkeypatch
+):
+    questions = [make_question(2, "Komunikasi", n) for n in (1, 2, 3, 4)]
+    a, b, c, d = (question_id(q) for q in questions)
+
+    async def overlapping_reply(*args):
+        # b is claimed twice and is the second cluster's canonical
+        return {
+            "clusters": [
+                {"canonical_id": a, "question_ids": [a, b]},
+                {"canonical_id": b, "question_ids": [b, c, d]},
+            ]
+        }
+
+    monkeypatch.setattr(gen, "_cluster_group", overlapping_reply)
+    monkeypatch.setattr(gen, "get_csv_hash", lambda path: "hash")
+    config = make_config()
+
+    async def scenario():
+        pool = gen.build_endpoint_pool(config)
+        try:
+            return await gen.cluster_questions(
+                questions, pool, config, str(tmp_path), logging.getLogger("test"), store
+            )
+        finally:
+            await pool.close()
+
+    clusters = asyncio.run(scenario())["clusters"]
+
+    assert [(cl["canonical_id"], cl["question_ids"]) for cl in clusters] == [
+        (a, [a, b]),
+        (c, [c, d]),
+    ]
+    canonical_map, _ = gen.build_cluster_lookup({"clusters": clusters})
+    assert canonical_map == {a: a, b: a, c: c, d: c}
+
+
+def test_failed_cluster_snapshot_leaves_the_previous_file(tmp_path):
+    path = tmp_path / "clusters.json"
+    gen.save_clusters(str(path), {"clusters": []})
+
+    with pytest.raises(TypeError):
+        gen.save_clusters(str(path), {"clusters": [], "unserializable": {1, 2}})
+
+    assert json.loads(path.read_text()) == {"clusters": []}
+    assert os.listdir(tmp_path) == ["clusters.json"]
@@ -0,0 +1,127 @@
+"""Tests for streamed PNG validation and the content-addressed object store."""
+
+import asyncio
+import base64
+import os
+import struct
+import zlib
+
+import pytest
+
+from conftest import gen, make_config, make_question, question_id, run_engine
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def make_png(width: int = 2, height: int = 2) -> bytes:
+    """A valid grayscale PNG of the given size."""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    rows = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+    return (
+        gen.PNG_SIGNATURE
+        + _chunk(b"IHDR", ihdr)
+        + _chunk(b"IDAT", zlib.compress(rows))
+        + _chunk(b"IEND", b"")
+    )
+
+
+def _feed(data: bytes, step: int) -> gen.PngStreamValidator:
+    validator = gen.PngStreamValidator("test.png")
+    for start in range(0, len(data), step):
+        validator.feed(data[start : start + step])
+    validator.finish()
+    return validator
+
+
+@pytest.mark.parametrize("step", [1, 7, 33, 4096])
+def test_valid_png_passes_in_any_chunking(step):
+    assert _feed(make_png(), step).is_png
+
+
+def test_corrupt_ihdr_crc_is_rejected():
+    data = bytearray(make_png())
+    data[20] ^= 0xFF  # width byte, covered by the CRC
+
+    with pytest.raises(ValueError, match="CRC"):
+        _feed(bytes(data), 5)
+
+
+def test_zero_dimensions_are_rejected():
+    with pytest.raises(ValueError, match="dimensions"):
+        _feed(make_png(width=0), 5)
+
+
+def test_missing_ihdr_is_rejected():
+    data = gen.PNG_SIGNATURE + _chunk(b"IDAT", b"x" * 13) + b"\x00" * 8
+
+    with pytest.raises(ValueError, match="IHDR"):
+        _feed(data, 5)
+
+
+def test_non_png_data_is_accepted_without_checks():
+    validator = _feed(b"GIF89a" + b"\x00" * 100, 3)
+
+    assert validator.checked and not validator.is_png
+
+
+def test_truncated_header_is_rejected_at_finish():
+    with pytest.raises(ValueError, match="too short"):
+        _feed(make_png()[:20], 4)
+
+
+def test_save_image_stores_identical_images_once(tmp_path):
+    data = base64.b64encode(make_png()).decode()
+
+    first = gen.save_image(data, str(tmp_path), "a.png")
+    second = gen.save_image(f"data:image/png;base64,{data}", str(tmp_path), "b.png")
+
+    assert first == second
+    assert first.startswith(f"{gen.OBJECTS_DIRNAME}/")
+    with open(tmp_path / first, "rb") as f:
+        assert f.read() == make_png()
+    assert os.listdir(tmp_path / gen.OBJECTS_DIRNAME) == [os.path.basename(first)]
+
+
+def test_save_image_leaves_no_temp_file_on_corrupt_data(tmp_path):
+    data = bytearray(make_png())
+    data[20] ^= 0xFF
+
+    assert gen.save_image(base64.b64encode(bytes(data)).decode(), str(tmp_path), "a.png") is None
+    assert os.listdir(tmp_path / gen.OBJECTS_DIRNAME) == []
+
+
+def test_download_retries_under_the_pools_policy(tmp_path):
+    pool = gen.build_endpoint_pool(make_config(api_max_retries=2))
+
+    async def scenario():
+        try:
+            # Nothing listens on port 9, so every attempt is a transient connect error
+            url = "http://127.0.0.1:9/a.png"
+            return await gen.download_image(url, str(tmp_path), "a.png", pool)
+        finally:
+            await pool.close()
+
+    assert asyncio.run(scenario()) is None
+    assert pool.retry_policy.retries == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_url_responses_stream_through_the_shared_client(
+    mock_api, make_engine, store, monkeypatch
+):
+    def one_off_connection(*args, **kwargs):
+        raise AssertionError("downloads must reuse the endpoint pool's connections")
+
+    monkeypatch.setattr(gen.httpx, "stream", one_off_connection)
+    config = make_config(mock_api.base_url, image_response_format="url")
+    questions = [make_question(2, "Komunikasi", n) for n in (1, 2, 3)]
+    engine = make_engine(mock_api.base_url, config=config)
+
+    counts, _ = run_engine(engine, questions)
+
+    assert counts["success"] == 3
+    for q in questions:
+        assert store.get_object(question_id(q)).startswith(f"{gen.OBJECTS_DIRNAME}/")
@@ -0,0 +1,158 @@
+"""Tests for TokenBucket, ModelRateLimiter and duration parsing."""
+
+import time
+
+import httpx
+import pytest
+
+from conftest import gen
+
+
+class TestTokenBucket:
+    def test_reserve_within_capacity_does_not_wait(self):
+        bucket = gen.TokenBucket(60)
+        now = bucket.updated_at
+
+        assert bucket.reserve(60, now) == 0.0
+
+    def test_overdraft_waits_for_refill(self):
+        bucket = gen.TokenBucket(60)
+        now = bucket.updated_at
+        bucket.reserve(60, now)
+
+        # 60 per minute refills one unit per second.
+        assert bucket.reserve(3, now) == pytest.approx(3.0)
+
+    def test_refills_over_time(self):
+        bucket = gen.TokenBucket(60)
+        now = bucket.updated_at
+        bucket.reserve(60, now)
+
+        assert bucket.reserve(10, now + 10) == 0.0
+        assert bucket.reserve(1, now + 10) == pytest.approx(1.0)
+
+    def test_amount_is_clamped_to_capacity(self):
+        bucket = gen.TokenBucket(60)
+
+        assert bucket.reserve(1_000, bucket.updated_at) == 0.0
+
+    def test_zero_rate_disables_the_bucket(self):
+        bucket = gen.TokenBucket(0)
+
+        assert bucket.reserve(1_000_000, time.monotonic()) == 0.0
+
+    def test_refund_is_capped_at_capacity(self):
+        bucket = gen.TokenBucket(60)
+        now = bucket.updated_at
+        bucket.reserve(30, now)
+
+        bucket.refund(100)
+
+        assert bucket.tokens == 60
+
+    def test_set_rate_keeps_balance_within_capacity(self):
+        bucket = gen.TokenBucket(60)
+        now = bucket.updated_at
+
+        bucket.set_rate(10, now)
+
+        assert bucket.tokens == 10
+        assert bucket.reserve(10, now) == 0.0
+        assert bucket.reserve(1, now) == pytest.approx(6.0)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("1.5", 1.5),
+        ("500ms", 0.5),
+        ("1m30s", 90.0),
+        ("2h", 7200.0),
+        ("-3", 0.0),
+        ("", None),
+        ("soon", None),
+    ],
+)
+def test_parse_duration(value, expected):
+    assert gen._parse_duration(value) == expected
+
+
+def test_parse_duration_http_date():
+    future = time.time() + 120
+    header = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(future))
+
+    assert gen._parse_duration(header) == pytest.approx(120, abs=2)
+
+
+class TestModelRateLimiter:
+    def test_retry_after_pauses_and_halves_rate(self):
+        limiter = gen.ModelRateLimiter("m", rpm=60, tpm=0)
+
+        paused = limiter.record_throttle(httpx.Headers({"retry-after": "7"}))
+
+        assert paused == pytest.approx(7, abs=0.1)
+        assert limiter.throttled == 1
+        assert limiter.requests.per_minute == 30
+        assert limiter.reserve(1) == pytest.approx(7, abs=0.1)
+
+    def test_retry_after_ms_takes_precedence(self):
+        limiter = gen.ModelRateLimiter("m", rpm=60, tpm=0)
+
+        paused = limiter.record_throttle(
+            httpx.Headers({"retry-after-ms": "250", "retry-after": "30"})
+        )
+
+        assert paused == pytest.approx(0.25, abs=0.05)
+
+    def test_throttle_without_headers_backs_off_exponentially(self):
+        limiter = gen.ModelRateLimiter("m", rpm=0, tpm=0)
+
+        first = limiter.record_throttle(None)
+        second = limiter.record_throttle(None)
+
+        assert first == pytest.approx(2, abs=0.1)
+        assert second == pytest.approx(4, abs=0.1)
+
+    def test_exhausted_quota_headers_pause_until_reset(self):
+        limiter = gen.ModelRateLimiter("m", rpm=0, tpm=0)
+        headers = httpx.Headers(
+            {
+                "x-ratelimit-remaining-requests": "5",
+                "x-ratelimit-reset-requests": "1s",
+                "x-ratelimit-remaining-tokens": "0",
+                "x-ratelimit-reset-tokens": "1m",
+            }
+        )
+
+        limiter.record_success(headers, estimated_tokens=100, used_tokens=None)
+
+        assert limiter.header_pauses == 1
+        assert limiter.reserve(1) == pytest.approx(60, abs=0.1)
+
+    def test_advertised_limit_lowers_request_rate(self):
+        limiter = gen.ModelRateLimiter("m", rpm=60, tpm=0)
+
+        limiter.record_success(
+            httpx.Headers({"x-ratelimit-limit-requests": "20"}), 0, None
+        )
+
+        assert limiter.requests.per_minute == 20
+        assert limiter.min_rpm_seen == 20
+
+    def test_successes_recover_rate_up_to_configured(self):
+        limiter = gen.ModelRateLimiter("m", rpm=100, tpm=0)
+        limiter.record_throttle(httpx.Headers({"retry-after": "0"}))
+        assert limiter.requests.per_minute == 50
+
+        for _ in range(20):
+            limiter.record_success(httpx.Headers(), 0, None)
+
+        assert limiter.requests.per_minute == 100
+
+    def test_used_tokens_refund_the_estimate(self):
+        limiter = gen.ModelRateLimiter("m", rpm=0, tpm=1000)
+        limiter.reserve(800)
+
+        limiter.record_success(httpx.Headers(), estimated_tokens=800, used_tokens=100)
+
+        assert limiter.tokens.tokens == pytest.approx(900, abs=1)
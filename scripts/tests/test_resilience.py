@@ -0,0 +1,274 @@
+"""Tests for CircuitBreaker, RetryPolicy and EndpointPool retries."""
+
+import asyncio
+import logging
+import time
+
+import httpx
+import pytest
+
+from conftest import bench, gen, make_config, make_question, question_id
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold_consecutive_failures(self):
+        breaker = gen.CircuitBreaker(threshold=3, cooldown=30)
+
+        assert breaker.record_failure(probe=False) is False
+        assert breaker.record_failure(probe=False) is False
+        assert breaker.record_failure(probe=False) is True
+        assert breaker.state == "open"
+
+    def test_open_circuit_ejects_endpoint(self):
+        breaker = gen.CircuitBreaker(threshold=2, cooldown=30)
+        breaker.record_failure(False)
+        breaker.record_failure(False)
+
+        now = time.monotonic()
+        assert breaker.state == "open"
+        assert breaker.trips == 1
+        assert not breaker.admits(now)
+        assert breaker.admit() is None
+        assert breaker.ejected_for(now) == pytest.approx(30, abs=0.5)
+
+    def test_success_resets_the_failure_count(self):
+        breaker = gen.CircuitBreaker(threshold=2, cooldown=30)
+        breaker.record_failure(False)
+        breaker.record_success(False)
+        breaker.record_failure(False)
+
+        assert breaker.state == "closed"
+
+    def test_single_probe_after_cooldown(self):
+        breaker = gen.CircuitBreaker(threshold=1, cooldown=30)
+        breaker.record_failure(False)
+        breaker.open_until = time.monotonic()
+
+        assert breaker.admit() is True
+        assert breaker.state == "half-open"
+        assert breaker.admit() is None
+
+    def test_successful_probe_closes_the_circuit(self):
+        breaker = gen.CircuitBreaker(threshold=1, cooldown=30)
+        breaker.record_failure(False)
+        breaker.open_until = time.monotonic()
+        probe = breaker.admit()
+
+        breaker.record_success(probe)
+
+        assert breaker.state == "closed"
+        assert breaker.admit() is False
+
+    def test_failed_probe_doubles_cooldown_up_to_max(self):
+        breaker = gen.CircuitBreaker(threshold=1, cooldown=30, max_cooldown=100)
+        breaker.record_failure(False)
+
+        for expected in (60, 100, 100):
+            breaker.open_until = time.monotonic()
+            probe = breaker.admit()
+            assert breaker.record_failure(probe) is True
+            assert breaker.cooldown == expected
+
+        assert breaker.trips == 4
+
+    def test_released_probe_lets_another_caller_probe(self):
+        breaker = gen.CircuitBreaker(threshold=1, cooldown=30)
+        breaker.record_failure(False)
+        breaker.open_until = time.monotonic()
+        probe = breaker.admit()
+
+        breaker.release_probe(probe)
+
+        assert breaker.admit() is True
+
+    def test_zero_threshold_disables_the_breaker(self):
+        breaker = gen.CircuitBreaker(threshold=0, cooldown=30)
+        for _ in range(10):
+            assert breaker.record_failure(False) is False
+
+        assert breaker.admits(time.monotonic())
+        assert breaker.admit() is False
+
+
+class TestRetryPolicy:
+    def test_backoff_is_full_jitter_within_bounds(self):
+        policy = gen.RetryPolicy(max_retries=4, base_delay=1.0, max_delay=60.0)
+
+        for attempt, ceiling in ((1, 2.0), (3, 8.0), (10, 60.0)):
+            delays = [policy.backoff(attempt) for _ in range(200)]
+            assert all(0 <= d <= ceiling for d in delays)
+            assert max(delays) > ceiling / 2
+
+    def test_negative_retries_are_clamped(self):
+        assert gen.RetryPolicy(max_retries=-1).max_retries == 0
+
+
+class TestImageHedger:
+    def test_hedge_win_records_the_primarys_elapsed_time(self, monkeypatch):
+        durations = iter([5.0, 0.01])  # the primary stalls, the hedge is quick
+
+        async def fake_generate_image(pool, prompt, config, tier):
+            await asyncio.sleep(next(durations))
+            return "image"
+
+        monkeypatch.setattr(gen, "generate_image", fake_generate_image)
+        hedger = gen.ImageHedger(percentile=95, max_rate=1.0)
+        hedger.latencies.extend([0.05] * gen.HEDGE_MIN_SAMPLES)
+
+        assert asyncio.run(hedger.generate(None, "prompt", {})) == "image"
+
+        assert (hedger.hedged, hedger.hedge_wins) == (1, 1)
+        # Sampling the hedge's own 0.01s would drag the threshold down
+        assert hedger.latencies[-1] >= 0.05
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://mock/v1")
+    return httpx.HTTPStatusError(
+        "error", request=request, response=httpx.Response(status, request=request)
+    )
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (_status_error(429), "throttle"),
+        (_status_error(503), "transient"),
+        (_status_error(400), "fatal"),
+        (httpx.ConnectError("refused"), "transient"),
+        (TimeoutError(), "transient"),
+        (asyncio.TimeoutError(), "transient"),
+        (ValueError("bad"), "fatal"),
+    ],
+)
+def test_classify_api_error(error, expected):
+    assert gen.classify_api_error(error) == expected
+
+
+def _failing_server() -> bench.MockOpenAIServer:
+    return bench.MockOpenAIServer(
+        bench.parse_latency("fixed:0"), bench.parse_latency("fixed:0"), error_rate=1.0
+    )
+
+
+def _call_prompt_model(pool, config):
+    return pool.call(
+        config["prompt_model"],
+        10,
+        lambda client: client.chat.completions.with_raw_response.create(
+            model=config["prompt_model"],
+            messages=[{"role": "user", "content": "hello"}],
+            max_tokens=5,
+        ),
+        kind="prompt",
+    )
+
+
+class TestEndpointPoolRetries:
+    def test_transient_errors_retry_until_the_policy_gives_up(self):
+        server = _failing_server()
+        server.start()
+        try:
+            config = make_config(server.base_url, api_max_retries=3)
+            pool = gen.build_endpoint_pool(config)
+
+            async def scenario():
+                try:
+                    await _call_prompt_model(pool, config)
+                finally:
+                    await pool.close()
+
+            with pytest.raises(gen.APIStatusError):
+                asyncio.run(scenario())
+        finally:
+            server.stop()
+
+        assert server.stats["server_errors"] == 4
+        assert pool.retry_policy.retries == 3
+        assert pool.endpoints[0].failures == 4
+
+    def test_open_breaker_reroutes_to_the_healthy_endpoint(self, mock_api):
+        broken = _failing_server()
+        broken.start()
+        try:
+            endpoints = [
+                {"name": "broken", "base_url": broken.base_url},
+                {"name": "healthy", "base_url": mock_api.base_url},
+            ]
+            config = make_config(
+                llm_endpoints=gen.json.dumps(endpoints),
+                breaker_threshold=1,
+                breaker_cooldown=60,
+            )
+            pool = gen.build_endpoint_pool(config)
+
+            async def scenario():
+                try:
+                    return [await _call_prompt_model(pool, config) for _ in range(4)]
+                finally:
+                    await pool.close()
+
+            responses = asyncio.run(scenario())
+        finally:
+            broken.stop()
+
+        assert len(responses) == 4
+        assert broken.stats["server_errors"] == 1
+        assert pool.endpoints[0].breaker.state == "open"
+        assert pool.retry_policy.retries == 0
+        assert mock_api.stats["chat_requests"] == 4
+
+
+def _request_json(pool, config):
+    async def scenario():
+        try:
+            return await gen.request_json_completion(
+                pool, config, "system", "Return JSON", 50, 0.0, "test", logging.getLogger("test")
+            )
+        finally:
+            await pool.close()
+
+    return asyncio.run(scenario())
+
+
+def test_json_completion_leaves_api_retries_to_the_pool():
+    server = _failing_server()
+    server.start()
+    try:
+        config = make_config(server.base_url, api_max_retries=2)
+        result = _request_json(gen.build_endpoint_pool(config), config)
+    finally:
+        server.stop()
+
+    assert result is None
+    assert server.stats["chat_requests"] == 3
+
+
+def test_json_completion_retries_unparseable_replies(mock_api):
+    # The mock answers prompts it does not recognise with plain text
+    config = make_config(mock_api.base_url)
+
+    assert _request_json(gen.build_endpoint_pool(config), config) is None
+    assert mock_api.stats["chat_requests"] == 3
+
+
+def test_prompt_batch_maps_prompts_back_to_question_ids(mock_api):
+    config = make_config(mock_api.base_url)
+    questions = [
+        make_question(2, "Komunikasi", 1, "Apakah anak [tanpa bantuan] tersenyum?"),
+        make_question(24, "Motorik Kasar", 3),
+    ]
+
+    async def scenario():
+        pool = gen.build_endpoint_pool(config)
+        try:
+            return await gen.generate_prompts_batch(
+                pool, questions, config, logging.getLogger("test")
+            )
+        finally:
+            await pool.close()
+
+    prompts = asyncio.run(scenario())
+
+    assert list(prompts) == [question_id(q) for q in questions]
+    assert mock_api.stats["chat_requests"] == 1
@@ -0,0 +1,197 @@
+"""Tests for priority ordering and the engine's dependency scheduling."""
+
+import threading
+
+import pytest
+
+from conftest import bench, gen, make_question, question_id, run_engine
+
+
+def _ids(questions):
+    return [question_id(q) for q in questions]
+
+
+def test_prioritize_questions_orders_by_age_weight_then_csv_order():
+    questions = [
+        make_question(2, "Komunikasi", 1),
+        make_question(24, "Komunikasi", 1),
+        make_question(2, "Komunikasi", 2),
+        make_question(60, "Komunikasi", 1),
+    ]
+
+    ordered = gen.prioritize_questions(questions, {24: 10, 2: 5}, {}, set())
+
+    assert _ids(ordered) == [
+        "24-bulan_komunikasi_1",
+        "2-bulan_komunikasi_1",
+        "2-bulan_komunikasi_2",
+        "60-bulan_komunikasi_1",
+    ]
+
+
+def test_prioritize_questions_credits_canonicals_with_their_whole_cluster():
+    questions = [
+        make_question(24, "Komunikasi", 1),
+        make_question(2, "Komunikasi", 1),
+        make_question(2, "Komunikasi", 2),
+    ]
+    canonical = "2-bulan_komunikasi_2"
+    canonical_map = {
+        canonical: canonical,
+        "2-bulan_komunikasi_1": canonical,
+        "60-bulan_komunikasi_1": canonical,
+    }
+
+    ordered = gen.prioritize_questions(
+        questions, {2: 4, 24: 10, 60: 8}, canonical_map, {canonical}
+    )
+
+    # The canonical unlocks 4 + 4 + 8 = 16 > 10; its member ties at 4 and
+    # would wait for it anyway, so it sorts last.
+    assert _ids(ordered) == [canonical, "24-bulan_komunikasi_1", "2-bulan_komunikasi_1"]
+
+
+def test_plan_dependencies_moves_canonicals_ahead_of_their_members(make_engine):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 6)]
+    ids = _ids(questions)
+    canonical_map = {ids[1]: ids[3], ids[3]: ids[3], ids[4]: ids[3]}
+    engine = make_engine("http://127.0.0.1:9/v1", canonical_map=canonical_map)
+
+    ordered = engine._plan_dependencies(questions)
+
+    assert _ids(ordered) == [ids[0], ids[3], ids[1], ids[2], ids[4]]
+
+
+def test_engine_renders_each_cluster_and_text_once(mock_api, make_engine, store):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 9)]
+    questions[7]["question_text"] = questions[6]["question_text"]
+    ids = _ids(questions)
+    # Two clusters of three; the second canonical comes after its members
+    canonical_map = {qid: ids[0] for qid in ids[:3]}
+    canonical_map.update({qid: ids[5] for qid in ids[3:6]})
+    engine = make_engine(mock_api.base_url, "--concurrency", "8", canonical_map=canonical_map)
+
+    counts, _ = run_engine(engine, questions)
+
+    # Two canonicals, the first of the same-text pair
+    assert mock_api.stats["image_requests"] == 3
+    assert (counts["success"], counts["cluster_copy"], counts["duplicate"]) == (3, 4, 1)
+    assert counts["error"] == 0
+    assert store.get_object(ids[4]) == store.get_object(ids[5])
+    assert store.get_object(ids[7]) == store.get_object(ids[6])
+    assert len({store.get_object(qid) for qid in ids}) == 3
+
+
+def test_engine_promotes_a_member_when_the_canonical_has_no_image(
+    mock_api, make_engine, store
+):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 5)]
+    ids = _ids(questions)
+    # The canonical is outside the run and has no image
+    canonical_map = {qid: "2-bulan_komunikasi_99" for qid in ids}
+    engine = make_engine(mock_api.base_url, "--concurrency", "4", canonical_map=canonical_map)
+
+    counts, _ = run_engine(engine, questions)
+
+    assert mock_api.stats["image_requests"] == 1
+    assert (counts["success"], counts["cluster_copy"]) == (1, 3)
+    assert len({store.get_object(qid) for qid in ids}) == 1
+
+
+def test_force_regenerates_each_text_once(mock_api, make_engine, store):
+    questions = [make_question(2, "Komunikasi", n, "Teks sama") for n in range(1, 4)]
+    run_engine(make_engine(mock_api.base_url), questions)
+    assert mock_api.stats["image_requests"] == 1
+
+    counts, _ = run_engine(make_engine(mock_api.base_url, "--force"), questions)
+
+    # Only the text root is rendered again; its duplicates copy the new image
+    assert mock_api.stats["image_requests"] == 2
+    assert (counts["success"], counts["duplicate"]) == (1, 2)
+    assert len({store.get_object(qid) for qid in _ids(questions)}) == 1
+
+
+def test_failures_are_recorded_off_the_event_loop(make_engine, store, monkeypatch):
+    server = bench.MockOpenAIServer(
+        bench.parse_latency("fixed:0"), bench.parse_latency("fixed:0"), error_rate=1.0
+    )
+    server.start()
+    recorded_on = []
+    record_error = store.record_error
+
+    def tracking_record_error(question_id, error):
+        recorded_on.append(threading.current_thread())
+        record_error(question_id, error)
+
+    monkeypatch.setattr(store, "record_error", tracking_record_error)
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 4)]
+    try:
+        engine = make_engine(server.base_url, "--concurrency", "3")
+        counts, _ = run_engine(engine, questions)
+    finally:
+        server.stop()
+
+    assert counts["error"] == 3
+    assert store.failed_ids() == set(_ids(questions))
+    assert threading.main_thread() not in recorded_on
+
+
+IMAGE_LATENCY = 0.4
+
+
+@pytest.fixture
+def slow_images():
+    """Mock server with instant prompts and a fixed image latency."""
+    server = bench.MockOpenAIServer(
+        bench.parse_latency("fixed:0"),
+        bench.parse_latency(f"fixed:{IMAGE_LATENCY}"),
+        image_px=8,
+    )
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize("cluster_size", [4, 8])
+def test_waiting_members_do_not_hold_resolvers(slow_images, make_engine, cluster_size):
+    # With 8 workers per stage every canonical of 64 questions can render at
+    # once, so the run takes about ceil(clusters / 8) image round trips no
+    # matter how many members are waiting to copy from them.
+    workers = 8
+    questions = [make_question(age, "Komunikasi", n) for age in (2, 4, 6, 8) for n in range(1, 17)]
+    ids = _ids(questions)
+    canonical_map = {qid: ids[i - i % cluster_size] for i, qid in enumerate(ids)}
+    clusters = len(ids) // cluster_size
+    engine = make_engine(
+        slow_images.base_url, "--concurrency", str(workers), canonical_map=canonical_map
+    )
+
+    counts, elapsed = run_engine(engine, questions)
+
+    assert slow_images.stats["image_requests"] == clusters
+    assert counts["cluster_copy"] == len(ids) - clusters
+    rounds = -(-clusters // workers)
+    assert elapsed < (rounds + 1.5) * IMAGE_LATENCY
+
+
+def test_store_reads_run_off_the_event_loop(mock_api, make_engine, store, monkeypatch):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 6)]
+    questions[4]["question_text"] = questions[3]["question_text"]
+    ids = _ids(questions)
+    canonical_map = {qid: ids[0] for qid in ids[:3]}
+    read_on = []
+    for name in ("is_completed", "hash_source", "get_object"):
+        read = getattr(store, name)
+
+        def tracking_read(*args, read=read):
+            read_on.append(threading.current_thread())
+            return read(*args)
+
+        monkeypatch.setattr(store, name, tracking_read)
+
+    run_engine(make_engine(mock_api.base_url, canonical_map=canonical_map), questions)
+    counts, _ = run_engine(make_engine(mock_api.base_url, canonical_map=canonical_map), questions)
+
+    assert counts["skip"] == len(questions)
+    assert read_on
+    assert threading.main_thread() not in read_on
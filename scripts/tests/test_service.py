@@ -0,0 +1,143 @@
+"""Tests for the on-demand ImageService's single-flight coalescing."""
+
+import asyncio
+import logging
+
+import pytest
+
+from conftest import bench, gen, make_args, make_config, make_question, question_id
+
+
+@pytest.fixture
+def slow_api():
+    """Mock server whose image calls take long enough for requests to overlap."""
+    server = bench.MockOpenAIServer(
+        bench.parse_latency("fixed:0"), bench.parse_latency("fixed:0.3"), image_px=8
+    )
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_service(tmp_path, store):
+    def factory(base_url, questions, canonical_map=None, *argv):
+        config = make_config(base_url)
+        canonical_map = canonical_map or {}
+        output_dir = tmp_path / "out"
+        output_dir.mkdir(exist_ok=True)
+        return gen.ImageService(
+            make_args("--no-prompt-cache", *argv),
+            questions,
+            dict(
+                config=config,
+                output_dir=str(output_dir),
+                store=store,
+                canonical_map=canonical_map,
+                canonical_set=set(canonical_map.values()),
+                logger=logging.getLogger("test"),
+                pool=gen.build_endpoint_pool(config),
+            ),
+            logging.getLogger("test"),
+        )
+
+    return factory
+
+
+def _serve(service, question_ids):
+    async def scenario():
+        service.slots = asyncio.Semaphore(max(1, service.args.concurrency))
+        try:
+            return await asyncio.gather(*(service.request(qid) for qid in question_ids))
+        finally:
+            await service.engine_kwargs["pool"].close()
+
+    return asyncio.run(scenario())
+
+
+def test_concurrent_requests_share_one_generation(slow_api, make_service):
+    questions = [make_question(2, "Komunikasi", 1)]
+    qid = question_id(questions[0])
+    service = make_service(slow_api.base_url, questions)
+
+    responses = _serve(service, [qid] * 5)
+
+    assert [status for status, _ in responses] == [200] * 5
+    assert len({body["object"] for _, body in responses}) == 1
+    assert slow_api.stats["image_requests"] == 1
+    assert (service.counts["generated"], service.counts["coalesced"]) == (1, 4)
+
+    # Later requests are answered from the store
+    status, body = _serve(service, [qid])[0]
+    assert (status, body["source"]) == (200, "cache")
+    assert slow_api.stats["image_requests"] == 1
+
+
+def test_cluster_members_join_their_canonicals_flight(slow_api, make_service, store):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 4)]
+    ids = [question_id(q) for q in questions]
+    service = make_service(slow_api.base_url, questions, {qid: ids[0] for qid in ids})
+
+    responses = _serve(service, ids[::-1])
+
+    assert [status for status, _ in responses] == [200] * 3
+    assert slow_api.stats["image_requests"] == 1
+    assert len({body["object"] for _, body in responses}) == 1
+    assert store.is_completed(ids[0])
+
+
+def test_same_text_requests_render_once(slow_api, make_service):
+    questions = [make_question(2, "Komunikasi", 1), make_question(24, "Komunikasi", 1)]
+    questions[1]["question_text"] = questions[0]["question_text"]
+
+    responses = _serve(
+        make_service(slow_api.base_url, questions), [question_id(q) for q in questions]
+    )
+
+    assert slow_api.stats["image_requests"] == 1
+    assert len({body["object"] for _, body in responses}) == 1
+
+
+def test_requests_beyond_the_backlog_are_shed(slow_api, make_service):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 4)]
+    service = make_service(slow_api.base_url, questions, None, "--max-backlog", "1")
+
+    responses = _serve(service, [question_id(q) for q in questions])
+
+    assert [status for status, _ in responses] == [200, 503, 503]
+    assert responses[1][1]["retry_after"] >= 1
+    assert service.counts["shed"] == 2
+    assert slow_api.stats["image_requests"] == 1
+
+
+def test_a_canonical_started_by_a_member_takes_the_members_backlog_slot(
+    slow_api, make_service
+):
+    questions = [make_question(2, "Komunikasi", n) for n in range(1, 5)]
+    ids = [question_id(q) for q in questions]
+    service = make_service(
+        slow_api.base_url, questions, {ids[1]: ids[0]}, "--max-backlog", "2"
+    )
+
+    async def scenario():
+        service.slots = asyncio.Semaphore(max(1, service.args.concurrency))
+        try:
+            member = asyncio.ensure_future(service.request(ids[1]))
+            await asyncio.sleep(0.05)  # the member has started its canonical's flight
+            assert (len(service.flights), service._backlog()) == (2, 1)
+            others = await asyncio.gather(service.request(ids[2]), service.request(ids[3]))
+            return [await member, *others]
+        finally:
+            await service.engine_kwargs["pool"].close()
+
+    responses = asyncio.run(scenario())
+
+    assert [status for status, _ in responses] == [200, 200, 503]
+    assert slow_api.stats["image_requests"] == 2
+    assert service._backlog() == 0
+
+
+def test_unknown_questions_are_not_found(make_service):
+    service = make_service("http://127.0.0.1:9/v1", [make_question(2, "Komunikasi", 1)])
+
+    assert _serve(service, ["2-bulan_komunikasi_99"])[0][0] == 404
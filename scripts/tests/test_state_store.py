@@ -0,0 +1,160 @@
+"""Tests for StateStore schema migrations, completions and shard merges."""
+
+import sqlite3
+
+from conftest import gen
+
+OLD_SCHEMA = """
+CREATE TABLE completed (
+    question_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    question_hash TEXT,
+    completed_at TEXT NOT NULL
+);
+CREATE TABLE hashes (
+    question_hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL
+);
+"""
+
+
+def _columns(store, table):
+    return {row["name"] for row in store.conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_opening_an_old_database_adds_missing_columns(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(OLD_SCHEMA)
+    conn.execute(
+        "INSERT INTO completed VALUES ('q1', 'q1.png', 'generated', NULL, 'h1', '2024-01-01')"
+    )
+    conn.commit()
+    conn.close()
+
+    store = gen.StateStore(db_path)
+    try:
+        assert {"object", "fingerprint", "tier"} <= _columns(store, "completed")
+        assert "object" in _columns(store, "hashes")
+        assert store.is_completed("q1")
+        assert store.completed_without_object() == [("q1", "q1.png")]
+        row = store.conn.execute("SELECT tier FROM completed").fetchone()
+        assert row["tier"] == "hd"
+    finally:
+        store.close()
+
+    # Reopening a migrated database is a no-op
+    gen.StateStore(db_path).close()
+
+
+def test_mark_generated_resolves_errors_and_registers_the_hash(store):
+    store.record_error("q1", "boom")
+    assert store.failed_ids() == {"q1"}
+
+    store.mark_generated("q1", "q1.png", "h1", "objects/ab/abc.png", "fp", tier="draft")
+
+    assert store.failed_ids() == set()
+    assert store.get_object("q1") == "objects/ab/abc.png"
+    assert store.hash_source("h1") == ("q1.png", "objects/ab/abc.png")
+    assert store.draft_ids() == {"q1"}
+
+
+def test_copies_inherit_the_tier_of_their_source(store):
+    store.mark_generated("q1", "q1.png", "h1", "objects/a.png", tier="draft")
+
+    store.mark_copy("q2", "q2.png", "cluster_copy", "q1", "h2", "objects/a.png")
+    store.mark_copy("q3", "q3.png", "duplicate", "x.png", "h3", "objects/other.png")
+
+    tiers = dict(store.conn.execute("SELECT question_id, tier FROM completed").fetchall())
+    assert tiers == {"q1": "draft", "q2": "draft", "q3": "hd"}
+
+
+def test_clusters_round_trip(store):
+    clusters = {
+        "version": 2,
+        "csv_hash": "abc",
+        "created_at": "2024-01-01T00:00:00",
+        "group_hashes": {"Komunikasi/baby": "h"},
+        "clusters": [
+            {
+                "cluster_id": "c1",
+                "domain": "Komunikasi",
+                "age_category": "baby",
+                "canonical_id": "q1",
+                "question_ids": ["q1", "q2"],
+                "reason": "same scene",
+            }
+        ],
+    }
+
+    store.save_clusters(clusters)
+    loaded = store.load_clusters()
+
+    assert loaded["clusters"] == clusters["clusters"]
+    assert loaded["group_hashes"] == clusters["group_hashes"]
+    assert (loaded["version"], loaded["csv_hash"], loaded["total_questions"]) == (2, "abc", 2)
+
+
+def _set_completed_at(store, question_id, value):
+    with store.transaction() as conn:
+        conn.execute(
+            "UPDATE completed SET completed_at = ? WHERE question_id = ?", (value, question_id)
+        )
+
+
+def test_merge_from_keeps_the_newer_completion(store, tmp_path):
+    shard = gen.StateStore(str(tmp_path / "shard.db"))
+    store.mark_generated("old", "old.png", "h1", "objects/main-old.png")
+    store.mark_generated("new", "new.png", "h2", "objects/main-new.png")
+    shard.mark_generated("old", "old.png", "h1", "objects/shard-old.png")
+    shard.mark_generated("new", "new.png", "h2", "objects/shard-new.png")
+    shard.mark_generated("only", "only.png", "h3", "objects/shard-only.png")
+    _set_completed_at(store, "old", "2024-01-01")
+    _set_completed_at(shard, "old", "2024-06-01")
+    _set_completed_at(store, "new", "2024-06-01")
+    _set_completed_at(shard, "new", "2024-01-01")
+    shard.close()
+
+    store.merge_from(str(tmp_path / "shard.db"))
+
+    assert store.get_object("old") == "objects/shard-old.png"
+    assert store.get_object("new") == "objects/main-new.png"
+    assert store.get_object("only") == "objects/shard-only.png"
+
+
+def test_merge_from_is_idempotent_and_resolves_errors(store, tmp_path):
+    shard = gen.StateStore(str(tmp_path / "shard.db"))
+    shard.record_error("q1", "timeout")
+    shard.record_error("q2", "timeout")
+    shard.close()
+    store.mark_generated("q1", "q1.png", "h1", "objects/a.png")
+
+    first = store.merge_from(str(tmp_path / "shard.db"))
+    second = store.merge_from(str(tmp_path / "shard.db"))
+
+    assert first["errors"] == 2
+    assert second == {"completed": 0, "errors": 0}
+    assert store.failed_ids() == {"q2"}
+
+
+def test_merge_from_takes_clusters_only_when_missing(store, tmp_path):
+    cluster = {
+        "cluster_id": "c1",
+        "domain": "Komunikasi",
+        "age_category": "baby",
+        "canonical_id": "q1",
+        "question_ids": ["q1"],
+        "reason": "",
+    }
+    shard = gen.StateStore(str(tmp_path / "shard.db"))
+    shard.save_clusters({"clusters": [cluster]})
+    shard.close()
+
+    store.merge_from(str(tmp_path / "shard.db"))
+    assert store.load_clusters()["clusters"] == [cluster]
+
+    store.save_clusters({"clusters": [dict(cluster, canonical_id="q9", question_ids=["q9"])]})
+    store.merge_from(str(tmp_path / "shard.db"))
+    assert store.load_clusters()["clusters"][0]["canonical_id"] == "q9"
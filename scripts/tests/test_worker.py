@@ -0,0 +1,240 @@
+"""Tests for the Laravel jobs table queue and the --worker loop."""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+import pytest
+
+from conftest import gen, make_args, make_config, make_question, question_id
+
+QUEUE = "asq3-images"
+
+# database/migrations/0001_01_01_000002_create_jobs_table.php
+JOBS_SCHEMA = """
+CREATE TABLE jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue VARCHAR NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    reserved_at INTEGER,
+    available_at INTEGER NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE failed_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid VARCHAR NOT NULL UNIQUE,
+    connection TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    exception TEXT NOT NULL,
+    failed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def job_payload(age_months=2, domain_code="communication", number=1, **data) -> str:
+    """A payload shaped like the one asq3:queue-images pushes."""
+    return json.dumps(
+        {
+            "uuid": f"uuid-{age_months}-{domain_code}-{number}",
+            "displayName": gen.JOB_DISPLAY_NAME,
+            "job": "App\\Jobs\\Asq3ImageGeneratorJob",
+            "data": {
+                "age_months": age_months,
+                "domain_code": domain_code,
+                "question_number": number,
+                **data,
+            },
+        }
+    )
+
+
+@pytest.fixture
+def db_config(tmp_path):
+    path = str(tmp_path / "database.sqlite")
+    conn = sqlite3.connect(path)
+    conn.executescript(JOBS_SCHEMA)
+    conn.close()
+    return {"db_connection": "sqlite", "db_database": path}
+
+
+@pytest.fixture
+def make_jobs(db_config):
+    queues = []
+
+    def factory(**kwargs) -> gen.JobQueue:
+        conn, driver = gen.connect_laravel_database(db_config)
+        jobs = gen.JobQueue(conn, driver, QUEUE, **kwargs)
+        queues.append(jobs)
+        return jobs
+
+    yield factory
+    for jobs in queues:
+        jobs.close()
+
+
+def push(jobs, payload=None, queue=QUEUE, available_in=0) -> int:
+    now = int(time.time())
+    cursor = jobs.conn.execute(
+        "INSERT INTO jobs (queue, payload, attempts, available_at, created_at) "
+        "VALUES (?, ?, 0, ?, ?)",
+        (queue, payload or job_payload(), now + available_in, now),
+    )
+    return cursor.lastrowid
+
+
+def row(jobs, job_id):
+    return jobs.conn.execute(
+        "SELECT attempts, reserved_at, available_at FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+
+
+def test_claim_reserves_due_jobs_of_its_queue_oldest_first(make_jobs):
+    jobs = make_jobs()
+    first = push(jobs)
+    second = push(jobs)
+    push(jobs, queue="default")
+    push(jobs, available_in=60)
+
+    claimed = jobs.claim(5)
+
+    assert [job["id"] for job in claimed] == [first, second]
+    assert [job["attempts"] for job in claimed] == [1, 1]
+    attempts, reserved_at, _ = row(jobs, first)
+    assert attempts == 1 and reserved_at == pytest.approx(time.time(), abs=2)
+    assert jobs.claim(5) == []
+
+
+def test_claim_respects_the_limit(make_jobs):
+    jobs = make_jobs()
+    ids = [push(jobs) for _ in range(3)]
+
+    assert [job["id"] for job in jobs.claim(2)] == ids[:2]
+    assert [job["id"] for job in jobs.claim(2)] == ids[2:]
+
+
+def test_expired_reservations_are_reclaimed(make_jobs):
+    jobs = make_jobs(visibility_timeout=600)
+    job_id = push(jobs)
+    jobs.claim(1)
+
+    # Another worker sees the job again once the reservation times out
+    jobs.conn.execute(
+        "UPDATE jobs SET reserved_at = ? WHERE id = ?", (int(time.time()) - 601, job_id)
+    )
+    reclaimed = make_jobs(visibility_timeout=600).claim(1)
+
+    assert [(job["id"], job["attempts"]) for job in reclaimed] == [(job_id, 2)]
+
+
+def test_heartbeat_keeps_a_reservation_alive(make_jobs):
+    jobs = make_jobs(visibility_timeout=600)
+    job_id = push(jobs)
+    jobs.claim(1)
+    jobs.conn.execute(
+        "UPDATE jobs SET reserved_at = ? WHERE id = ?", (int(time.time()) - 500, job_id)
+    )
+
+    jobs.heartbeat([job_id])
+    jobs.conn.execute(
+        "UPDATE jobs SET reserved_at = reserved_at - 200 WHERE id = ?", (job_id,)
+    )
+
+    assert jobs.claim(1) == []
+
+
+def test_release_delays_the_next_attempt(make_jobs):
+    jobs = make_jobs(max_attempts=3)
+    job_id = push(jobs)
+    job = jobs.claim(1)[0]
+
+    assert jobs.release(job, "timeout") is True
+
+    attempts, reserved_at, available_at = row(jobs, job_id)
+    assert (attempts, reserved_at) == (1, None)
+    assert available_at == pytest.approx(time.time() + gen.JOB_RELEASE_DELAY, abs=2)
+    assert jobs.claim(1) == []
+
+
+def test_release_after_max_attempts_moves_the_job_to_failed_jobs(make_jobs):
+    jobs = make_jobs(max_attempts=2)
+    job_id = push(jobs)
+    for _ in range(2):
+        job = jobs.claim(1)[0]
+        released = jobs.release(job, "still failing")
+        jobs.conn.execute("UPDATE jobs SET available_at = 0 WHERE id = ?", (job_id,))
+
+    assert released is False
+    assert row(jobs, job_id) is None
+    failed = jobs.conn.execute("SELECT uuid, queue, exception FROM failed_jobs").fetchall()
+    assert failed == [("uuid-2-communication-1", QUEUE, "still failing")]
+
+
+def test_ack_deletes_finished_jobs(make_jobs):
+    jobs = make_jobs()
+    ids = [push(jobs) for _ in range(3)]
+    jobs.claim(3)
+
+    jobs.ack(ids[:2])
+    jobs.ack([])
+
+    assert [r[0] for r in jobs.conn.execute("SELECT id FROM jobs")] == ids[2:]
+
+
+def test_question_from_job_uses_the_payload_text():
+    q = make_question(2, "Komunikasi", 1)
+    by_key = gen.index_questions_by_key([q])
+
+    found, force = gen.question_from_job(job_payload(question_text="Teks baru"), by_key)
+    assert (question_id(found), found["question_text"], force) == (
+        question_id(q),
+        "Teks baru",
+        False,
+    )
+
+    new, _ = gen.question_from_job(job_payload(number=9, question_text="Baru"), by_key)
+    assert question_id(new) == "2-bulan_komunikasi_9"
+
+    with pytest.raises(ValueError, match="Unknown question"):
+        gen.question_from_job(job_payload(number=9), by_key)
+    with pytest.raises(ValueError, match="Malformed"):
+        gen.question_from_job('{"data": {}}', by_key)
+
+
+def test_worker_processes_jobs_and_fails_bad_payloads(mock_api, make_jobs, store, tmp_path):
+    questions = [make_question(2, "Komunikasi", n) for n in (1, 2)]
+    jobs = make_jobs()
+    for number in (1, 2):
+        push(jobs, job_payload(number=number))
+    push(jobs, job_payload(number=1))  # a second job for the same question
+    push(jobs, job_payload(domain_code="unknown"))
+    config = make_config(mock_api.base_url)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    worker = gen.QueueWorker(
+        make_args("--worker", "--stop-when-empty", "--no-prompt-cache"),
+        jobs,
+        questions,
+        dict(
+            config=config,
+            output_dir=str(output_dir),
+            store=store,
+            canonical_map={},
+            canonical_set=set(),
+            logger=logging.getLogger("test"),
+            pool=gen.build_endpoint_pool(config),
+        ),
+        logging.getLogger("test"),
+    )
+
+    counts = asyncio.run(worker.run())
+
+    assert counts == {"processed": 3, "failed": 1, "released": 0}
+    assert mock_api.stats["image_requests"] == 2
+    assert jobs.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
+    assert jobs.conn.execute("SELECT COUNT(*) FROM failed_jobs").fetchone()[0] == 1
+    assert all(store.is_completed(question_id(q)) for q in questions)
+    assert (output_dir / gen.MANIFEST_FILENAME).exists()
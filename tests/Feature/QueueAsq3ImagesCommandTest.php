@@ -0,0 +1,143 @@
+<?php
+
+namespace Tests\Feature;
+
+use App\Models\Asq3Question;
+use Database\Seeders\Asq3AgeIntervalSeeder;
+use Database\Seeders\Asq3DomainSeeder;
+use Database\Seeders\Asq3QuestionSeeder;
+use Illuminate\Foundation\Testing\RefreshDatabase;
+use Illuminate\Support\Facades\DB;
+use Illuminate\Support\Facades\Process;
+use Tests\TestCase;
+
+class QueueAsq3ImagesCommandTest extends TestCase
+{
+    use RefreshDatabase;
+
+    /**
+     * Parses a job payload with the generator's own question_from_job() and
+     * prints the question it resolves to as JSON.
+     */
+    private const PARSE_PAYLOAD = <<<'PY'
+import json, sys
+import generate_asq3_images as g
+questions = g.load_questions(sys.argv[1])
+q, force = g.question_from_job(sys.argv[2], g.index_questions_by_key(questions))
+print(json.dumps({
+    "filename": g.get_filename(q["age"], q["domain"], q["number"]),
+    "question_text": q["question_text"],
+    "force": force,
+}))
+PY;
+
+    protected function setUp(): void
+    {
+        parent::setUp();
+
+        $this->seed([
+            Asq3DomainSeeder::class,
+            Asq3AgeIntervalSeeder::class,
+            Asq3QuestionSeeder::class,
+        ]);
+    }
+
+    private function question(int $ageMonths, string $domainCode, int $number): Asq3Question
+    {
+        return Asq3Question::query()
+            ->whereHas('ageInterval', fn ($q) => $q->where('age_months', $ageMonths))
+            ->whereHas('domain', fn ($q) => $q->where('code', $domainCode))
+            ->where('question_number', $number)
+            ->firstOrFail();
+    }
+
+    /**
+     * Run a payload through the Python worker's parser, skipping the test
+     * when the generator's dependencies are not installed.
+     */
+    private function parseWithWorker(string $payload): array
+    {
+        $result = Process::path(base_path('scripts'))->run([
+            env('PYTHON', 'python3'), '-c', self::PARSE_PAYLOAD, base_path('asq3.csv'), $payload,
+        ]);
+
+        if ($result->failed() && str_contains($result->errorOutput(), 'ModuleNotFoundError')) {
+            $this->markTestSkipped('Generator dependencies are not installed: pip install -r scripts/requirements.txt');
+        }
+        $this->assertTrue($result->successful(), $result->errorOutput());
+
+        return json_decode($result->output(), true);
+    }
+
+    public function test_pushes_one_job_per_question_without_an_image(): void
+    {
+        Asq3Question::query()->update(['image_url' => '/storage/asq3-images/existing.png']);
+        $first = $this->question(2, 'communication', 1);
+        $second = $this->question(24, 'gross_motor', 3);
+        Asq3Question::whereKey([$first->id, $second->id])->update(['image_url' => null]);
+
+        $this->artisan('asq3:queue-images')
+            ->expectsOutput('Queued: 2')
+            ->assertSuccessful();
+
+        $jobs = DB::table('jobs')->where('queue', 'asq3-images')->orderBy('id')->get();
+        $this->assertCount(2, $jobs);
+        $payload = json_decode($jobs[0]->payload, true);
+        $this->assertSame('asq3-images:generate', $payload['displayName']);
+        $this->assertSame(0, $jobs[0]->attempts);
+        $this->assertNull($jobs[0]->reserved_at);
+    }
+
+    public function test_payload_parses_in_the_generator_worker(): void
+    {
+        $question = $this->question(2, 'communication', 1);
+        $question->update(['question_text' => 'Teks yang diubah di panel admin']);
+
+        $this->artisan('asq3:queue-images', ['ids' => [$question->id], '--force' => true])
+            ->assertSuccessful();
+
+        $payload = DB::table('jobs')->where('queue', 'asq3-images')->value('payload');
+        $parsed = $this->parseWithWorker($payload);
+
+        $this->assertSame('2-bulan_komunikasi_1.png', $parsed['filename']);
+        $this->assertSame('Teks yang diubah di panel admin', $parsed['question_text']);
+        $this->assertTrue($parsed['force']);
+    }
+
+    public function test_refuses_the_queue_laravel_workers_read(): void
+    {
+        $this->artisan('asq3:queue-images', ['--queue' => config('queue.connections.database.queue')])
+            ->assertFailed();
+
+        $this->assertSame(0, DB::table('jobs')->count());
+    }
+
+    public function test_laravel_worker_fails_the_job_with_a_clear_message(): void
+    {
+        $question = $this->question(2, 'communication', 1);
+        $this->artisan('asq3:queue-images', ['ids' => [$question->id]])->assertSuccessful();
+
+        $this->artisan('queue:work', [
+            'connection' => 'database',
+            '--queue' => 'asq3-images',
+            '--once' => true,
+        ])->assertSuccessful();
+
+        $this->assertSame(0, DB::table('jobs')->count());
+        $this->assertStringContainsString(
+            'generate_asq3_images.py --worker',
+            DB::table('failed_jobs')->value('exception')
+        );
+    }
+
+    public function test_dry_run_pushes_nothing(): void
+    {
+        $question = $this->question(2, 'communication', 1);
+
+        $this->artisan('asq3:queue-images', ['ids' => [$question->id], '--dry-run' => true])
+            ->expectsOutput('Queued: 1')
+            ->assertSuccessful();
+
+        $this->assertSame(0, DB::table('jobs')->count());
+    }
+}
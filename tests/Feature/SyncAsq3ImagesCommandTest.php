@@ -0,0 +1,157 @@
+<?php
+
+namespace Tests\Feature;
+
+use App\Models\Asq3Question;
+use Database\Seeders\Asq3AgeIntervalSeeder;
+use Database\Seeders\Asq3DomainSeeder;
+use Database\Seeders\Asq3QuestionSeeder;
+use Illuminate\Database\Schema\Blueprint;
+use Illuminate\Foundation\Testing\RefreshDatabase;
+use Illuminate\Support\Carbon;
+use Illuminate\Support\Facades\DB;
+use Illuminate\Support\Facades\File;
+use Illuminate\Support\Facades\Schema;
+use Tests\TestCase;
+
+class SyncAsq3ImagesCommandTest extends TestCase
+{
+    use RefreshDatabase;
+
+    private string $storagePath;
+
+    protected function setUp(): void
+    {
+        parent::setUp();
+
+        $this->seed([
+            Asq3DomainSeeder::class,
+            Asq3AgeIntervalSeeder::class,
+            Asq3QuestionSeeder::class,
+        ]);
+
+        // Keep the manifest out of the real storage/app/public
+        $this->storagePath = sys_get_temp_dir().'/asq3-sync-'.uniqid();
+        File::ensureDirectoryExists("{$this->storagePath}/app/public/asq3-images");
+        $this->app->useStoragePath($this->storagePath);
+    }
+
+    protected function tearDown(): void
+    {
+        File::deleteDirectory($this->storagePath);
+
+        parent::tearDown();
+    }
+
+    private function question(int $ageMonths, string $domainCode, int $number): Asq3Question
+    {
+        return Asq3Question::query()
+            ->whereHas('ageInterval', fn ($q) => $q->where('age_months', $ageMonths))
+            ->whereHas('domain', fn ($q) => $q->where('code', $domainCode))
+            ->where('question_number', $number)
+            ->firstOrFail();
+    }
+
+    /**
+     * Write a manifest.json in the generator's version 2 format.
+     *
+     * @param  array<string, array<string, mixed>>  $entries
+     */
+    private function writeManifest(array $entries): void
+    {
+        File::put(
+            "{$this->storagePath}/app/public/asq3-images/manifest.json",
+            json_encode([
+                'version' => 2,
+                'objects_dir' => 'objects',
+                'total_entries' => count($entries),
+                'entries' => $entries,
+            ])
+        );
+    }
+
+    public function test_updates_image_urls_from_the_manifest(): void
+    {
+        $missing = $this->question(2, 'communication', 1);
+        $handSet = $this->question(2, 'communication', 2);
+        $stale = $this->question(24, 'gross_motor', 3);
+        $current = $this->question(24, 'gross_motor', 4);
+        $missing->update(['image_url' => null]);
+        $handSet->update(['image_url' => '/images/asq3/custom.png']);
+        $stale->update(['image_url' => '/storage/asq3-images/objects/old.png']);
+        $current->update(['image_url' => '/storage/asq3-images/objects/dddd.png']);
+
+        $this->writeManifest([
+            // Resolved fields, as written by the current generator
+            '2-bulan_komunikasi_1' => [
+                'object' => 'objects/aaaa.png',
+                'age_months' => 2,
+                'domain_code' => 'communication',
+                'question_number' => 1,
+            ],
+            '2-bulan_komunikasi_2' => [
+                'object' => 'objects/bbbb.png',
+                'age_months' => 2,
+                'domain_code' => 'communication',
+                'question_number' => 2,
+            ],
+            // Older entries are resolved from the question ID
+            '24-bulan_motorik-kasar_3' => ['object' => 'objects/cccc.png'],
+            '24-bulan_motorik-kasar_4' => ['object' => 'objects/dddd.png'],
+        ]);
+
+        $this->artisan('asq3:sync-images')
+            ->expectsOutput('Found 4 questions in manifest.json')
+            ->expectsOutput('Synced: 2')
+            ->expectsOutput('Already had image: 2')
+            ->expectsOutput('Errors: 0')
+            ->assertSuccessful();
+
+        $this->assertSame('/storage/asq3-images/objects/aaaa.png', $missing->fresh()->image_url);
+        $this->assertSame('/images/asq3/custom.png', $handSet->fresh()->image_url);
+        $this->assertSame('/storage/asq3-images/objects/cccc.png', $stale->fresh()->image_url);
+        $this->assertSame('/storage/asq3-images/objects/dddd.png', $current->fresh()->image_url);
+    }
+
+    public function test_touches_updated_at_when_the_table_has_one(): void
+    {
+        Schema::table('asq3_questions', fn (Blueprint $table) => $table->timestamp('updated_at')->nullable());
+        $stale = $this->question(2, 'communication', 1);
+        $handSet = $this->question(2, 'communication', 2);
+        DB::table('asq3_questions')->update(['updated_at' => now()->subDay()]);
+        DB::table('asq3_questions')->where('id', $stale->id)
+            ->update(['image_url' => '/storage/asq3-images/objects/old.png']);
+        DB::table('asq3_questions')->where('id', $handSet->id)
+            ->update(['image_url' => '/images/asq3/custom.png']);
+        $this->writeManifest([
+            '2-bulan_komunikasi_1' => ['object' => 'objects/aaaa.png'],
+            '2-bulan_komunikasi_2' => ['object' => 'objects/bbbb.png'],
+        ]);
+
+        $this->artisan('asq3:sync-images')
+            ->expectsOutput('Synced: 1')
+            ->assertSuccessful();
+
+        // The bulk update bypasses Eloquent, so it sets updated_at itself
+        $updatedAt = DB::table('asq3_questions')->whereIn('id', [$stale->id, $handSet->id])
+            ->pluck('updated_at', 'id')
+            ->map(fn ($value) => Carbon::parse($value));
+        $this->assertTrue($updatedAt[$stale->id]->gt(now()->subHour()));
+        $this->assertTrue($updatedAt[$handSet->id]->lt(now()->subHour()));
+    }
+
+    public function test_dry_run_leaves_image_urls_unchanged(): void
+    {
+        $question = $this->question(2, 'communication', 1);
+        $question->update(['image_url' => null]);
+        $this->writeManifest([
+            '2-bulan_komunikasi_1' => ['object' => 'objects/aaaa.png'],
+        ]);
+
+        $this->artisan('asq3:sync-images', ['--dry-run' => true])
+            ->expectsOutput('Synced: 1')
+            ->assertSuccessful();
+
+        $this->assertNull($question->fresh()->image_url);
+    }
+}